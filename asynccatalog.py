@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# read catalogs for lots of databases at once, for when there are too
+# many to diff one after another.
+#
+# threads with blocking MySQLdb cursors don't get far past a few dozen
+# connections, so this runs each query in a greenlet over PyMySQL, a
+# pure python client that gevent can make non-blocking.  a semaphore
+# keeps at most max_in_flight queries (and connections) going at once.
+#
+# the catalogs it builds are the same schemamodel objects the
+# SnapshotCatalog in schemadiff builds, from the same queries, so the
+# diffs come out the same.
+#
+# needs gevent and PyMySQL:  pip install gevent PyMySQL
+#
+# PyMySQL only yields to other greenlets once socket is patched, and
+# patching can't be undone, so that's left to the program using this:
+# call gevent.monkey.patch_socket() (or patch_all()) first thing in its
+# main, before any connections are made.  without it the queries still
+# work, just one at a time.
+
+import logging
+import dsn
+import schemadiff
+import schemamodel
+
+try:
+    import gevent
+    import gevent.lock
+    import gevent.monkey
+    import pymysql
+except ImportError:
+    gevent = None
+
+DEFAULT_MAX_IN_FLIGHT = 200
+
+def _connect():
+    if schemadiff.SANDBOX is not None:
+        return pymysql.connect(unix_socket=schemadiff.SANDBOX.socket,
+                               user=schemadiff.SANDBOX.user,
+                               passwd=schemadiff.SANDBOX.passwd,
+                               use_unicode=False)
+    return pymysql.connect(host=getattr(dsn, 'host', 'localhost'),
+                           user=dsn.user, passwd=dsn.passwd,
+                           use_unicode=False)
+
+class AsyncCatalogReader(object):
+    """
+    connect:  function returning a new PyMySQL connection.  the default
+    goes to the same server schemadiff.get_connection() does.
+
+    the caller has to have patched socket already; see the top of this
+    file.
+    """
+    def __init__(self, connect=None, max_in_flight=None):
+        if gevent is None:
+            raise RuntimeError("AsyncCatalogReader needs gevent and PyMySQL")
+        if connect is None:
+            connect = _connect
+        if max_in_flight is None:
+            max_in_flight = DEFAULT_MAX_IN_FLIGHT
+
+        if not gevent.monkey.is_module_patched('socket'):
+            logging.warning("socket isn't patched by gevent, so catalog "
+                            "queries will run one at a time")
+
+        self.connect = connect
+        self.semaphore = gevent.lock.BoundedSemaphore(max_in_flight)
+        self.idle = []
+        self.connections = []
+
+    def query(self, q):
+        """
+        rows for one query.  blocks only the calling greenlet.
+        """
+        with self.semaphore:
+            if self.idle:
+                conn = self.idle.pop()
+            else:
+                conn = self.connect()
+                self.connections.append(conn)
+            try:
+                cursor = conn.cursor()
+                cursor.execute(q)
+                rows = cursor.fetchall()
+                cursor.close()
+            except:
+                # don't hand out a connection in an unknown state
+                self.connections.remove(conn)
+                conn.close()
+                raise
+            self.idle.append(conn)
+            return rows
+
+    def query_all(self, queries):
+        """
+        rows for each of queries, in order, all run at once.
+        """
+        greenlets = [gevent.spawn(self.query, q) for q in queries]
+        gevent.joinall(greenlets, raise_error=True)
+        return [g.value for g in greenlets]
+
+    def snapshot(self, dbs, table=None):
+        """
+        dict of db -> schemamodel.Schema, like
+        schemadiff.snapshot_schemas().
+        """
+        results = self.query_all(schemadiff.snapshot_queries(dbs, table))
+        return schemadiff.build_schemas(dbs, results)
+
+    def catalog(self, dbs):
+        """
+        a catalog over snapshots of dbs, for schemadiff.diff_databases()
+        or diff_table().
+        """
+        return AsyncCatalog(self, self.snapshot(dbs))
+
+    def diff_databases(self, pairs, digests=None):
+        """
+        diff many pairs of databases at once.  pairs is a list of
+        (db1, db2); digests, if given, a matching list of (digests1,
+        digests2).  returns the DML lists in the same order.
+        """
+        if digests is None:
+            digests = [(None, None)] * len(pairs)
+
+        dbs = []
+        for (db1, db2) in pairs:
+            for db in (db1, db2):
+                if db not in dbs:
+                    dbs.append(db)
+        logging.debug("reading catalogs for %d databases" % len(dbs))
+        catalog = self.catalog(dbs)
+
+        # the diffs themselves don't touch the server except for SHOW
+        # CREATE TABLE on added tables, which is where running them in
+        # greenlets pays off
+        greenlets = [gevent.spawn(schemadiff.diff_databases, catalog, db1, db2,
+                                  digests1, digests2)
+                     for ((db1, db2), (digests1, digests2)) in zip(pairs, digests)]
+        gevent.joinall(greenlets, raise_error=True)
+        return [g.value for g in greenlets]
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+        self.idle = []
+
+class AsyncCatalog(schemamodel.ModelCatalog):
+    def __init__(self, reader, schemas):
+        schemamodel.ModelCatalog.__init__(self, schemas)
+        self.reader = reader
+
+    def create_table(self, db, table):
+        for row in self.reader.query("show create table %s.%s;" % (db, table)):
+            return row[1]
@@ -9,6 +9,7 @@ import logging
 import re
 import P4
 import schemadiff
+import sandbox
 import dsn
 import string
 import p4credentials
@@ -75,9 +76,10 @@ def get_schema_for_branch(p4, filespec, branch):
     logging.debug("filespec:  %s" % version)
     return schemadiff.get_schema_from_filespec(p4, version)
 
-def diff_branches(p4, cursor, filespec, frombranch, tobranch, database, dmlfile, validate):
+def diff_branches(p4, cursor, filespec, frombranch, tobranch, database, **kwargs):
     """
     show the changes needed to turn the schema in frombranch to the one in tobranch.
+    kwargs are as for schemadiff.diff_schemas().
     """
 
     fromschema = get_schema_for_branch(p4, filespec, frombranch)
@@ -100,8 +102,7 @@ def diff_branches(p4, cursor, filespec, frombranch, tobranch, database, dmlfile,
 
     schemadiff.diff_schemas(cursor, fromschema, toschema,
                             db1, db2,
-                            dmlfile=dmlfile,
-                            validate=validate)
+                            **kwargs)
 
 if __name__ == '__main__':
     filterwarnings('ignore', category = MySQLdb.Warning)
@@ -115,20 +116,16 @@ if __name__ == '__main__':
                         help="branch from which we will apply diffs")
     parser.add_argument("--database",
                         help="service or trio")
-    parser.add_argument("--dmlfile", help="file to write dml statements")
-    parser.add_argument("--validate", help="verify that the changes work",
-                        action="store_true")
+    schemadiff.add_diff_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.offline and args.validate:
+        parser.error("--offline and --validate don't go together")
+
     oldbranch = args.oldbranch
     newbranch = args.newbranch
     database = args.database
-    dmlfile = args.dmlfile
-
-    validate = False
-    if args.validate:
-        validate = True
 
     if database not in ('service', 'trio'):
         print "bogus database \"%s\".  use service or trio" % (
@@ -147,8 +144,11 @@ if __name__ == '__main__':
     try:
         schemadiff.log_in_to_p4(p4)
 
-        conn = dsn.getConnection()
-        cursor = conn.cursor()
+        if args.sandbox and not args.offline:
+            schemadiff.SANDBOX = sandbox.Sandbox().start()
+        if not args.offline:
+            conn = schemadiff.get_connection()
+            cursor = conn.cursor()
 
         diff_branches(p4, 
                       cursor,
@@ -156,8 +156,7 @@ if __name__ == '__main__':
                       oldbranch,
                       newbranch,
                       database,
-                      dmlfile,
-                      validate)
+                      **schemadiff.diff_kwargs(args, cursor))
 
     except P4.P4Exception as p4e:
         logging.error(p4e)
@@ -178,4 +177,6 @@ if __name__ == '__main__':
             conn.close()
         if cursor:
             cursor.close()
+        if schemadiff.SANDBOX:
+            schemadiff.SANDBOX.stop()
 
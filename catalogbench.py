@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# time how long each of the catalogs in schemadiff.CATALOGS takes to
+# read some databases, and check they agree about what's in them.
+#
+#   catalogbench.py [--workers N] [--repeat N] db [db ...]
+
+import argparse
+import logging
+import time
+import schemadiff
+
+def read_all(catalog, dbs):
+    """
+    dict of (db, table) -> Table, everything catalog has for dbs.
+    """
+    if hasattr(catalog, 'prefetch'):
+        catalog.prefetch(dbs)
+    tables = {}
+    for db in dbs:
+        for table in catalog.tables(db):
+            tables[(db, table)] = catalog.table(db, table)
+    return tables
+
+def bench(cursor, dbs, workers=None, repeat=1):
+    """
+    list of (catalog name, best time in seconds), and whether they all
+    read the same tables.
+    """
+    timings = []
+    results = []
+    for name in sorted(schemadiff.CATALOGS.keys()):
+        best = None
+        for i in range(repeat):
+            pool = None
+            if workers > 1:
+                pool = schemadiff.ConnectionPool(workers)
+            try:
+                start = time.time()
+                tables = read_all(schemadiff.CATALOGS[name](cursor, pool), dbs)
+                elapsed = time.time() - start
+            finally:
+                if pool:
+                    pool.close()
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append((name, best))
+        results.append(tables)
+
+    same = all(r == results[0] for r in results[1:])
+    return (timings, same)
+
+if __name__ == '__main__':
+    FORMAT = "%(asctime)-15s %(funcName)s %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int,
+                        help="extra connections to read with")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per catalog; the best one counts")
+    parser.add_argument("dbs", nargs='+', help="databases to read")
+    args = parser.parse_args()
+
+    conn = schemadiff.get_connection()
+    cursor = conn.cursor()
+
+    (timings, same) = bench(cursor, args.dbs, args.workers, args.repeat)
+    for (name, elapsed) in timings:
+        print "%-20s %8.3fs" % (name, elapsed)
+    if not same:
+        print "catalogs disagree!"
+
+    cursor.close()
+    conn.close()
@@ -0,0 +1,672 @@
+#!/usr/bin/env python
+
+# parse CREATE TABLE statements into schemamodel objects, without a
+# server.
+#
+# the point is to end up with exactly what information_schema would
+# say about the table after mysql had created it, so this has to know
+# about the things mysql fills in for you:  integer display widths,
+# names for unnamed indexes and foreign keys, the index mysql adds for
+# a foreign key, implicit NOT NULL on primary key columns, and the
+# timestamp defaults you get when explicit_defaults_for_timestamp is
+# off (the default through 5.7).
+
+import decimal
+import re
+import schemamodel
+import schemastatements
+
+# set to True to model a server running with
+# explicit_defaults_for_timestamp=ON
+EXPLICIT_DEFAULTS_FOR_TIMESTAMP = False
+
+class ParseError(Exception):
+    pass
+
+_token_re = re.compile(r"""
+      (?P<space>\s+)
+    | (?P<comment>(?:--(?=\s)|\#)[^\n]*|/\*(?!!).*?\*/)
+    | (?P<version>/\*!\d*|\*/)
+    | `(?P<id>(?:[^`]|``)*)`
+    | '(?P<str>(?:[^'\\]|\\.|'')*)'
+    | "(?P<dstr>(?:[^"\\]|\\.|"")*)"
+    | (?P<num>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?(?![\w$]))
+    | (?P<word>[\w$]+)
+    | (?P<punct>.)
+""", re.VERBOSE | re.DOTALL)
+
+_escapes = {
+    '0' : '\0', 'b' : '\b', 'n' : '\n', 'r' : '\r', 't' : '\t', 'Z' : '\x1a',
+    }
+
+def _unescape(s, quote):
+    """
+    the value of a mysql string literal, given what's between the quotes.
+    """
+    s = s.replace(quote + quote, quote)
+    if '\\' not in s:
+        return s
+    return re.sub(r'\\(.)', lambda m: _escapes.get(m.group(1), m.group(1)), s)
+
+class Token(object):
+    """
+    kind is one of 'id' (a backquoted identifier), 'str', 'num', 'word'
+    or 'punct'.
+    """
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+
+    def __repr__(self):
+        return 'Token(%r, %r)' % (self.kind, self.value)
+
+def tokenize(statement):
+    tokens = []
+    for m in _token_re.finditer(statement):
+        kind = m.lastgroup
+        if kind in ('space', 'comment', 'version'):
+            continue
+        value = m.group(kind)
+        if kind == 'id':
+            value = value.replace('``', '`')
+        elif kind == 'str':
+            value = _unescape(value, "'")
+        elif kind == 'dstr':
+            kind = 'str'
+            value = _unescape(value, '"')
+        tokens.append(Token(kind, value))
+    return tokens
+
+class _Parser(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return None
+
+    def next(self):
+        t = self.peek()
+        if t is None:
+            raise ParseError("unexpected end of statement")
+        self.pos += 1
+        return t
+
+    def at(self, *words):
+        """
+        true if the next tokens are the given keywords (or punctuation).
+        """
+        for (i, w) in enumerate(words):
+            t = self.peek(i)
+            if t is None or t.kind not in ('word', 'punct'):
+                return False
+            if t.value.upper() != w:
+                return False
+        return True
+
+    def accept(self, *words):
+        if self.at(*words):
+            self.pos += len(words)
+            return True
+        return False
+
+    def expect(self, *words):
+        if not self.accept(*words):
+            raise ParseError("expected %s at %r" % (' '.join(words), self.peek()))
+
+    def identifier(self):
+        t = self.next()
+        if t.kind not in ('id', 'word', 'str'):
+            raise ParseError("expected an identifier, got %r" % t)
+        return t.value
+
+    def qualified_identifier(self):
+        """
+        db.name or name.  returns name.
+        """
+        name = self.identifier()
+        if self.accept('.'):
+            name = self.identifier()
+        return name
+
+    def skip_parens(self):
+        """
+        skip a parenthesized group, returning its tokens.
+        """
+        self.expect('(')
+        depth = 1
+        start = self.pos
+        while depth > 0:
+            t = self.next()
+            if t.kind == 'punct' and t.value == '(':
+                depth += 1
+            elif t.kind == 'punct' and t.value == ')':
+                depth -= 1
+        return self.tokens[start:self.pos - 1]
+
+    def skip_to_comma(self):
+        """
+        skip up to the next top-level , or ) in a table definition.
+        """
+        while True:
+            t = self.peek()
+            if t is None or (t.kind == 'punct' and t.value in (',', ')')):
+                return
+            if t.kind == 'punct' and t.value == '(':
+                self.skip_parens()
+            else:
+                self.pos += 1
+
+# integer types, with the display width mysql gives them when you don't
+# (signed, unsigned)
+_int_widths = {
+    'tinyint' : (4, 3),
+    'smallint' : (6, 5),
+    'mediumint' : (9, 8),
+    'int' : (11, 10),
+    'bigint' : (20, 20),
+    }
+
+_type_synonyms = {
+    'integer' : 'int',
+    'int1' : 'tinyint',
+    'int2' : 'smallint',
+    'int3' : 'mediumint',
+    'int4' : 'int',
+    'int8' : 'bigint',
+    'middleint' : 'mediumint',
+    'numeric' : 'decimal',
+    'dec' : 'decimal',
+    'fixed' : 'decimal',
+    'real' : 'double',
+    'float4' : 'float',
+    'float8' : 'double',
+    'character' : 'char',
+    'nchar' : 'char',
+    'nvarchar' : 'varchar',
+    'varcharacter' : 'varchar',
+    }
+
+_temporal_types = ('timestamp', 'datetime', 'time', 'date', 'year')
+
+def _parse_type(p):
+    """
+    parse a data type.  returns (base type, column_type).
+    """
+    base = p.next().value.lower()
+
+    if base == 'national':
+        base = p.next().value.lower()
+    if base == 'long':
+        if p.accept('VARBINARY'):
+            base = 'mediumblob'
+        else:
+            p.accept('VARCHAR')
+            base = 'mediumtext'
+    if base == 'double':
+        p.accept('PRECISION')
+    if base in ('char', 'character') and p.accept('VARYING'):
+        base = 'varchar'
+    if base in ('bool', 'boolean'):
+        return 'tinyint', 'tinyint(1)'
+
+    base = _type_synonyms.get(base, base)
+
+    args = None
+    if p.at('('):
+        args = p.skip_parens()
+
+    unsigned = False
+    zerofill = False
+    while True:
+        if p.accept('UNSIGNED'):
+            unsigned = True
+        elif p.accept('SIGNED'):
+            pass
+        elif p.accept('ZEROFILL'):
+            unsigned = True
+            zerofill = True
+        else:
+            break
+
+    if base in ('enum', 'set'):
+        values = ','.join("'%s'" % t.value.replace("'", "''")
+                          for t in args if t.kind == 'str')
+        return base, '%s(%s)' % (base, values)
+
+    numbers = []
+    if args:
+        numbers = [t.value for t in args if t.kind == 'num']
+
+    if base in _int_widths:
+        if numbers:
+            width = numbers[0]
+        else:
+            width = _int_widths[base][unsigned and 1 or 0]
+        column_type = '%s(%s)' % (base, width)
+    elif base == 'decimal':
+        if len(numbers) == 0:
+            numbers = ['10', '0']
+        elif len(numbers) == 1:
+            numbers.append('0')
+        column_type = 'decimal(%s,%s)' % tuple(numbers)
+    elif base in ('float', 'double'):
+        if base == 'float' and len(numbers) == 1:
+            if int(numbers[0]) > 24:
+                base = 'double'
+            numbers = []
+        if numbers:
+            column_type = '%s(%s)' % (base, ','.join(numbers))
+        else:
+            column_type = base
+    elif base in ('char', 'binary', 'bit'):
+        column_type = '%s(%s)' % (base, numbers and numbers[0] or '1')
+    elif base == 'year':
+        column_type = 'year(4)'
+    elif numbers and base not in ('text', 'blob'):
+        column_type = '%s(%s)' % (base, ','.join(numbers))
+    else:
+        column_type = base
+
+    if unsigned and (base in _int_widths or base in ('decimal', 'float', 'double')):
+        column_type += ' unsigned'
+    if zerofill:
+        column_type += ' zerofill'
+
+    return base, column_type
+
+_current_timestamp = ('CURRENT_TIMESTAMP', 'NOW', 'LOCALTIME', 'LOCALTIMESTAMP')
+
+def _parse_default(p):
+    """
+    parse the value after DEFAULT.  returns the literal as a string,
+    'CURRENT_TIMESTAMP', or None for NULL.
+    """
+    sign = ''
+    if p.at('-') or p.at('+'):
+        sign = p.next().value
+
+    t = p.next()
+    if t.kind == 'word' and t.value.upper() in _current_timestamp:
+        if p.at('('):
+            p.skip_parens()
+        return 'CURRENT_TIMESTAMP'
+    if t.kind == 'word' and t.value.upper() == 'NULL':
+        return None
+    if t.kind == 'word' and t.value.upper() in ('TRUE', 'FALSE'):
+        return t.value.upper() == 'TRUE' and '1' or '0'
+    if (t.kind == 'word' and t.value.lower() in ('b', 'x') and
+        p.peek() is not None and p.peek().kind == 'str'):
+        return "%s'%s'" % (t.value.lower(), p.next().value)
+    if sign == '-':
+        return '-' + t.value
+    return t.value
+
+def _default_value(base, column_type, value):
+    """
+    what information_schema.columns.column_default shows for a default
+    value, which isn't always what you wrote.
+    """
+    if value is None or value == 'CURRENT_TIMESTAMP':
+        return value
+
+    try:
+        if base in _int_widths:
+            d = decimal.Decimal(value)
+            return str(d.quantize(decimal.Decimal(1), decimal.ROUND_HALF_UP))
+        if base == 'decimal':
+            scale = int(column_type.split(',')[1].split(')')[0])
+            d = decimal.Decimal(value)
+            return str(d.quantize(decimal.Decimal(1).scaleb(-scale),
+                                  decimal.ROUND_HALF_UP))
+    except decimal.InvalidOperation:
+        pass
+
+    return value
+
+class _Column(object):
+    """
+    a column while we're still parsing the table.  explicit_null and
+    explicit_default are needed for the timestamp rules.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.base = None
+        self.column_type = None
+        self.nullable = True
+        self.explicit_null = False
+        self.default = None
+        self.explicit_default = False
+        self.extra = ''
+        self.comment = ''
+
+def _parse_column(p, table, pending_indexes):
+    c = _Column(p.identifier())
+    (c.base, c.column_type) = _parse_type(p)
+
+    while True:
+        if p.accept('NOT', 'NULL'):
+            c.nullable = False
+        elif p.accept('NULL'):
+            c.nullable = True
+            c.explicit_null = True
+        elif p.accept('DEFAULT'):
+            c.default = _parse_default(p)
+            c.explicit_default = True
+        elif p.accept('AUTO_INCREMENT'):
+            c.extra = 'auto_increment'
+        elif p.accept('ON', 'UPDATE'):
+            _parse_default(p)
+            c.extra = 'on update CURRENT_TIMESTAMP'
+        elif p.accept('PRIMARY', 'KEY') or p.accept('KEY'):
+            pending_indexes.append(('PRIMARY', None, [(c.name, None)]))
+        elif p.accept('UNIQUE'):
+            p.accept('KEY')
+            pending_indexes.append(('UNIQUE', None, [(c.name, None)]))
+        elif p.accept('COMMENT'):
+            c.comment = p.next().value
+        elif p.accept('CHARACTER', 'SET') or p.accept('CHARSET'):
+            p.next()
+        elif p.accept('COLLATE'):
+            p.next()
+        elif p.accept('BINARY') or p.accept('ASCII') or p.accept('UNICODE'):
+            pass
+        elif p.accept('COLUMN_FORMAT') or p.accept('STORAGE'):
+            p.next()
+        elif p.accept('REFERENCES'):
+            # column-level REFERENCES is parsed and thrown away by mysql
+            p.qualified_identifier()
+            if p.at('('):
+                p.skip_parens()
+            p.skip_to_comma()
+        elif p.accept('GENERATED', 'ALWAYS') or p.accept('AS'):
+            p.accept('AS')
+            p.skip_parens()
+        elif p.accept('VIRTUAL') or p.accept('STORED') or p.accept('PERSISTENT'):
+            pass
+        elif p.accept('CHECK'):
+            p.skip_parens()
+        else:
+            break
+
+    c.default = _default_value(c.base, c.column_type, c.default)
+    return c
+
+def _parse_key_parts(p):
+    """
+    (col, col(len) ASC, ...) -> list of (name, prefix length or None)
+    """
+    parts = []
+    p.expect('(')
+    while True:
+        name = p.identifier()
+        sub_part = None
+        if p.accept('('):
+            sub_part = p.next().value
+            p.expect(')')
+        p.accept('ASC') or p.accept('DESC')
+        parts.append((name, sub_part))
+        if p.accept(')'):
+            return parts
+        p.expect(',')
+
+def _skip_index_options(p):
+    while True:
+        if p.accept('USING'):
+            p.next()
+        elif p.accept('KEY_BLOCK_SIZE'):
+            p.accept('=')
+            p.next()
+        elif p.accept('COMMENT'):
+            p.next()
+        elif p.accept('WITH', 'PARSER'):
+            p.next()
+        else:
+            return
+
+def _parse_fk_action(p):
+    for action in (('RESTRICT',), ('CASCADE',), ('SET', 'NULL'),
+                   ('NO', 'ACTION'), ('SET', 'DEFAULT')):
+        if p.accept(*action):
+            return ' '.join(action)
+    raise ParseError("bad foreign key action at %r" % p.peek())
+
+def _parse_fk(p, symbol):
+    index_name = None
+    if not p.at('('):
+        index_name = p.identifier()
+    columns = [name for (name, sub_part) in _parse_key_parts(p)]
+
+    p.expect('REFERENCES')
+    ref_table = p.qualified_identifier()
+    ref_columns = [name for (name, sub_part) in _parse_key_parts(p)]
+
+    on_delete = None
+    on_update = None
+    while True:
+        if p.accept('MATCH'):
+            p.next()
+        elif p.accept('ON', 'DELETE'):
+            on_delete = _parse_fk_action(p)
+        elif p.accept('ON', 'UPDATE'):
+            on_update = _parse_fk_action(p)
+        else:
+            break
+
+    return (symbol, index_name, columns, ref_table, ref_columns,
+            on_delete, on_update)
+
+def _parse_table_options(p, table):
+    while p.peek() is not None:
+        if p.accept(','):
+            continue
+        if p.accept('ENGINE') or p.accept('TYPE'):
+            p.accept('=')
+            table.engine = schemamodel.canonical_engine(p.next().value)
+        elif (p.accept('DEFAULT', 'CHARACTER', 'SET') or p.accept('DEFAULT', 'CHARSET') or
+              p.accept('CHARACTER', 'SET') or p.accept('CHARSET')):
+            p.accept('=')
+            table.options['DEFAULT CHARSET'] = p.next().value
+        elif p.accept('DEFAULT', 'COLLATE') or p.accept('COLLATE'):
+            p.accept('=')
+            table.options['COLLATE'] = p.next().value
+        elif p.accept('COMMENT'):
+            p.accept('=')
+            table.comment = p.next().value
+        elif p.accept('PARTITION') or p.accept('AS') or p.accept('SELECT'):
+            # partitioning doesn't show up in anything we diff
+            return
+        else:
+            # AUTO_INCREMENT=n, ROW_FORMAT=x and friends
+            p.next()
+            if p.accept('='):
+                p.next()
+
+def _unique_name(name, taken):
+    """
+    mysql's naming for unnamed indexes:  the first column's name, then
+    name_2, name_3...
+    """
+    if name.lower() not in taken:
+        return name
+    n = 2
+    while ('%s_%d' % (name, n)).lower() in taken:
+        n += 1
+    return '%s_%d' % (name, n)
+
+def parse_create_table(statement, explicit_defaults=None):
+    """
+    parse one CREATE TABLE statement into a schemamodel.Table.
+
+    explicit_defaults:  overrides EXPLICIT_DEFAULTS_FOR_TIMESTAMP.  pass
+    True for SHOW CREATE TABLE output, which already spells out every
+    timestamp default.
+    """
+    if explicit_defaults is None:
+        explicit_defaults = EXPLICIT_DEFAULTS_FOR_TIMESTAMP
+
+    p = _Parser(tokenize(statement))
+    p.expect('CREATE')
+    p.accept('TEMPORARY')
+    p.expect('TABLE')
+    p.accept('IF', 'NOT', 'EXISTS')
+    table = schemamodel.Table(p.qualified_identifier())
+
+    if not p.at('('):
+        raise ParseError("can't model CREATE TABLE %s without column definitions" %
+                         table.name)
+
+    columns = []
+    # (kind, name, key parts), in definition order; named later
+    pending_indexes = []
+    pending_fks = []
+
+    p.expect('(')
+    while True:
+        symbol = None
+        if p.accept('CONSTRAINT'):
+            if not (p.at('PRIMARY') or p.at('UNIQUE') or p.at('FOREIGN') or
+                    p.at('CHECK')):
+                symbol = p.identifier()
+
+        if p.accept('PRIMARY', 'KEY'):
+            _skip_index_options(p)
+            pending_indexes.append(('PRIMARY', None, _parse_key_parts(p)))
+            _skip_index_options(p)
+        elif p.accept('UNIQUE'):
+            p.accept('KEY') or p.accept('INDEX')
+            name = symbol
+            if not p.at('(') and not p.at('USING'):
+                name = p.identifier()
+            _skip_index_options(p)
+            pending_indexes.append(('UNIQUE', name, _parse_key_parts(p)))
+            _skip_index_options(p)
+        elif p.accept('FOREIGN', 'KEY'):
+            pending_fks.append(_parse_fk(p, symbol))
+        elif p.accept('CHECK'):
+            p.skip_parens()
+        elif (p.at('KEY') or p.at('INDEX') or p.at('FULLTEXT') or p.at('SPATIAL')):
+            kind = ''
+            if p.accept('FULLTEXT'):
+                kind = 'FULLTEXT'
+            elif p.accept('SPATIAL'):
+                kind = 'SPATIAL'
+            p.accept('KEY') or p.accept('INDEX')
+            name = None
+            if not p.at('(') and not p.at('USING'):
+                name = p.identifier()
+            _skip_index_options(p)
+            pending_indexes.append((kind, name, _parse_key_parts(p)))
+            _skip_index_options(p)
+        else:
+            columns.append(_parse_column(p, table, pending_indexes))
+
+        if p.accept(')'):
+            break
+        p.expect(',')
+
+    _parse_table_options(p, table)
+
+    # primary key columns are NOT NULL whether you say so or not
+    pk_columns = set()
+    for (kind, name, parts) in pending_indexes:
+        if kind == 'PRIMARY':
+            pk_columns.update(n.lower() for (n, sub_part) in parts)
+    for c in columns:
+        if c.name.lower() in pk_columns:
+            c.nullable = False
+
+    if not explicit_defaults:
+        _timestamp_defaults(columns)
+
+    table.columns = tuple(schemamodel.Column(c.name, c.column_type, c.nullable,
+                                             c.default, c.extra, c.comment)
+                          for c in columns)
+
+    # name the indexes the way mysql does, then add an index for every
+    # foreign key that no existing index already covers.
+    indexes = []
+    taken = set()
+    for (kind, name, parts) in pending_indexes:
+        if kind == 'PRIMARY':
+            name = 'PRIMARY'
+        elif name is None:
+            name = _unique_name(parts[0][0], taken)
+        taken.add(name.lower())
+
+        constraint_type = None
+        if kind == 'PRIMARY':
+            constraint_type = 'PRIMARY KEY'
+        elif kind == 'UNIQUE':
+            constraint_type = 'UNIQUE'
+        indexes.append(schemamodel.Index(name, parts, constraint_type, kind))
+
+    fks = []
+    fk_number = 0
+    for (symbol, index_name, fk_columns, ref_table, ref_columns,
+         on_delete, on_update) in pending_fks:
+        covered = False
+        for index in indexes:
+            names = []
+            for (n, sub_part) in index.columns:
+                if sub_part:
+                    break
+                names.append(n.lower())
+            if names[:len(fk_columns)] == [c.lower() for c in fk_columns]:
+                covered = True
+                break
+        if not covered:
+            name = index_name or symbol or _unique_name(fk_columns[0], taken)
+            taken.add(name.lower())
+            indexes.append(schemamodel.Index(name, [(c, None) for c in fk_columns]))
+
+        # only InnoDB keeps foreign keys.  everybody else parses them
+        # and throws them away, after adding the index.
+        if table.engine not in ('InnoDB', 'ndbcluster'):
+            continue
+
+        if symbol is None:
+            fk_number += 1
+            symbol = '%s_ibfk_%d' % (table.name, fk_number)
+        fks.append(schemamodel.ForeignKey(symbol, fk_columns, ref_table,
+                                          ref_columns, on_delete, on_update))
+
+    table.indexes = tuple(indexes)
+    table.fks = tuple(fks)
+    return table
+
+def _timestamp_defaults(columns):
+    """
+    with explicit_defaults_for_timestamp off, timestamp columns are NOT
+    NULL unless you say NULL.  the first one, if you didn't give it a
+    default or ON UPDATE, gets DEFAULT CURRENT_TIMESTAMP ON UPDATE
+    CURRENT_TIMESTAMP, and the rest default to zero.
+    """
+    first = True
+    for c in columns:
+        if c.base != 'timestamp':
+            continue
+
+        if not c.explicit_null:
+            c.nullable = False
+
+        if first and not c.explicit_null and not c.explicit_default and not c.extra:
+            c.default = 'CURRENT_TIMESTAMP'
+            c.extra = 'on update CURRENT_TIMESTAMP'
+        elif not c.nullable and not c.explicit_default:
+            c.default = '0000-00-00 00:00:00'
+        first = False
+
+def parse_schema(src):
+    """
+    parse the CREATE TABLE statements in a schema (a string or an open
+    file) into a schemamodel.Schema.  everything else is ignored.
+    """
+    schema = schemamodel.Schema()
+    for ddl in schemastatements.iter_statements(src):
+        if schemastatements.statement_table(ddl) is None:
+            continue
+        schema.add(parse_create_table(ddl))
+    return schema
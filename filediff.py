@@ -5,6 +5,7 @@ import os
 import sys
 import logging
 import schemadiff
+import sandbox
 import dsn
 from warnings import filterwarnings
 
@@ -21,22 +22,17 @@ if __name__ == '__main__':
     logging.basicConfig(format=FORMAT, level=logging.DEBUG)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--validate", help="verify that the changes work",
-                        action="store_true")
-    parser.add_argument("--dmlfile", help="file to write dml statements")
+    schemadiff.add_diff_arguments(parser)
     parser.add_argument("file1", help="input file")
     parser.add_argument("file2", help="input file")
     args = parser.parse_args()
-    
+
+    if args.offline and args.validate:
+        parser.error("--offline and --validate don't go together")
+
     file1 = args.file1
     file2 = args.file2
 
-    validate = False
-    if args.validate:
-        validate = True
-
-    dmlfile = args.dmlfile
-        
     if not os.path.exists(file1):
         print '%s does not exist' % file1
         sys.exit(1)
@@ -81,11 +77,21 @@ if __name__ == '__main__':
     schema1 = read_schema_from_file(file1)
     schema2 = read_schema_from_file(file2)
 
-    conn = dsn.getConnection()
-    cursor = conn.cursor()
-    
-    schemadiff.diff_schemas(cursor, schema1, schema2, db1, db2, 
-                            dmlfile=dmlfile, validate=validate)
+    conn = None
+    cursor = None
+    try:
+        if args.sandbox and not args.offline:
+            schemadiff.SANDBOX = sandbox.Sandbox().start()
+        if not args.offline:
+            conn = schemadiff.get_connection()
+            cursor = conn.cursor()
 
-    cursor.close()
-    conn.close()
+        schemadiff.diff_schemas(cursor, schema1, schema2, db1, db2,
+                                **schemadiff.diff_kwargs(args, cursor))
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+        if schemadiff.SANDBOX:
+            schemadiff.SANDBOX.stop()
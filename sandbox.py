@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# throwaway mysqld instances for scratch work, so diffs and tests don't
+# have to use (and leave databases behind on) the shared server in dsn.
+#
+# a sandbox runs out of a data directory on tmpfs with durability
+# turned off, since nothing in it has to survive.  initializing a data
+# directory takes a while, so it's done once into a pristine copy under
+# the base directory, and each sandbox starts from a copy of that.
+#
+# the server is set up to behave like the 5.6 servers the schemas are
+# written for:  no strict mode, and the old timestamp defaults.
+
+import argparse
+import errno
+import fcntl
+import getpass
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import MySQLdb
+
+MYSQLD = os.environ.get('SCHEMADIFF_MYSQLD', 'mysqld')
+
+DEFAULT_BASE_DIR = os.environ.get('SCHEMADIFF_SANDBOX_DIR',
+                                  '/dev/shm/schemadiff-sandbox')
+
+# seconds to wait for a sandbox to accept connections
+START_TIMEOUT = 60
+
+SERVER_OPTIONS = [
+    '--skip-networking',
+    '--innodb_flush_log_at_trx_commit=0',
+    '--sync_binlog=0',
+    '--innodb_doublewrite=0',
+    '--skip-log-bin',
+    '--innodb_buffer_pool_size=64M',
+    '--performance_schema=0',
+    '--sql-mode=NO_ENGINE_SUBSTITUTION',
+    '--explicit_defaults_for_timestamp=0',
+    '--loose-mysqlx=0',
+    ]
+
+# databases a sandbox starts with, which reset() leaves alone
+SYSTEM_DATABASES = set(['information_schema', 'mysql', 'performance_schema', 'sys'])
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _pristine(basedir):
+    """
+    path of an initialized data directory under basedir, creating it if
+    it isn't there yet.  the lock keeps concurrent runs from
+    initializing it twice.
+    """
+    _makedirs(basedir)
+    pristine = os.path.join(basedir, 'pristine')
+
+    with open(os.path.join(basedir, 'pristine.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(pristine):
+            logging.debug("initializing %s" % pristine)
+            tmp = tempfile.mkdtemp(dir=basedir, prefix='.init')
+            datadir = os.path.join(tmp, 'data')
+            with open(os.path.join(tmp, 'init.log'), 'w') as log:
+                subprocess.check_call([MYSQLD, '--no-defaults',
+                                       '--initialize-insecure',
+                                       '--datadir=%s' % datadir,
+                                       '--user=%s' % getpass.getuser()],
+                                      stdout=log, stderr=subprocess.STDOUT)
+            # each copy makes its own server uuid
+            try:
+                os.remove(os.path.join(datadir, 'auto.cnf'))
+            except OSError:
+                pass
+            os.rename(datadir, pristine)
+            shutil.rmtree(tmp)
+
+    return pristine
+
+class Sandbox(object):
+    """
+    one mysqld, listening only on a unix socket, with root and no
+    password.  call start() before using it and stop() when done;
+    stop() throws the data away.
+    """
+    user = 'root'
+    passwd = ''
+
+    def __init__(self, basedir=None):
+        if basedir is None:
+            basedir = DEFAULT_BASE_DIR
+        self.basedir = basedir
+        self.dir = None
+        self.process = None
+
+    @property
+    def socket(self):
+        return os.path.join(self.dir, 'mysql.sock')
+
+    def start(self):
+        pristine = _pristine(self.basedir)
+        self.dir = tempfile.mkdtemp(dir=self.basedir, prefix='sandbox')
+        datadir = os.path.join(self.dir, 'data')
+        shutil.copytree(pristine, datadir)
+
+        logging.debug("starting sandbox in %s" % self.dir)
+        self.process = subprocess.Popen(
+            [MYSQLD, '--no-defaults',
+             '--datadir=%s' % datadir,
+             '--socket=%s' % self.socket,
+             '--pid-file=%s' % os.path.join(self.dir, 'mysqld.pid'),
+             '--log-error=%s' % os.path.join(self.dir, 'error.log'),
+             '--user=%s' % getpass.getuser()] + SERVER_OPTIONS)
+
+        deadline = time.time() + START_TIMEOUT
+        while True:
+            try:
+                self.connect().close()
+                return self
+            except MySQLdb.Error:
+                if self.process.poll() is not None or time.time() > deadline:
+                    log = os.path.join(self.dir, 'error.log')
+                    self.stop()
+                    raise RuntimeError("sandbox didn't start, see %s" % log)
+                time.sleep(0.1)
+
+    def connect(self):
+        return MySQLdb.connect(unix_socket=self.socket, user=self.user,
+                               passwd=self.passwd)
+
+    def dump_args(self):
+        """
+        arguments telling mysqldump how to reach the sandbox.
+        """
+        return '-u %s --socket=%s' % (self.user, self.socket)
+
+    def reset(self):
+        """
+        drop everything we created, so the next user starts clean.
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("show databases")
+        for (db,) in cursor.fetchall():
+            if db not in SYSTEM_DATABASES:
+                cursor.execute("drop database `%s`" % db)
+        cursor.close()
+        conn.close()
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                self.process.wait()
+            self.process = None
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+if __name__ == '__main__':
+    FORMAT = "%(asctime)-15s %(funcName)s %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", help="base directory for sandboxes")
+    parser.add_argument("command", choices=['init', 'clean'],
+                        help="init:  create the pristine data directory.  "
+                        "clean:  remove everything under the base directory")
+    args = parser.parse_args()
+
+    basedir = args.dir or DEFAULT_BASE_DIR
+    if args.command == 'init':
+        print _pristine(basedir)
+    else:
+        shutil.rmtree(basedir, ignore_errors=True)
+        print "removed %s" % basedir
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+# on-disk cache of the things we compute from a schema:  the normalized
+# text, the checksum, and the per-table digests.  entries are keyed by
+# the sha1 of the raw schema, so a schema we've seen before never gets
+# normalized again.
+#
+# layout:
+#
+#   <dir>/v<CACHE_VERSION>/<key>.json   checksum and table digests
+#   <dir>/v<CACHE_VERSION>/<key>.nml    normalized text
+#   <dir>/v<CACHE_VERSION>/stats.json   hit/miss counters
+#
+# the mtime of the .json file is the last time the entry was used;
+# eviction throws out the least recently used entries until the cache
+# is back under its size limit.  bump CACHE_VERSION whenever the
+# normalizer changes what it produces.
+#
+# PlanCache and TableDiffCache keep whole diffs and single table diffs
+# the same way; see below.
+
+import argparse
+import errno
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import StringIO
+import schemadiff
+
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.schemadiff', 'cache')
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+TABLE_CACHE_VERSION = 1
+
+DEFAULT_TABLE_MAX_BYTES = 256 * 1024 * 1024
+
+# bump when the layout of a plan cache entry changes.  changes to the
+# plans themselves go in schemadiff.PLAN_VERSION.
+PLAN_CACHE_VERSION = 1
+
+DEFAULT_PLAN_MAX_BYTES = 256 * 1024 * 1024
+
+def _cache_dir(directory):
+    if directory is None:
+        directory = os.environ.get('SCHEMADIFF_CACHE', DEFAULT_CACHE_DIR)
+    return directory
+
+class DiskCache(object):
+    """
+    a directory of entries, each made of files <key>.<ext> for ext in
+    exts.  the mtime of the first one is the last time the entry was
+    used.
+    """
+    exts = ('json',)
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, '%s.%s' % (key, ext))
+
+    def _write(self, path, data):
+        # write to a temp file and rename, so concurrent runs never see
+        # half an entry.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def _hit(self, key):
+        os.utime(self._path(key, self.exts[0]), None)
+        self.hits += 1
+        self._count('hits')
+
+    def _miss(self):
+        self.misses += 1
+        self._count('misses')
+
+    def _entries(self):
+        """
+        list of (last used, bytes, key) for every entry, oldest first.
+        """
+        index = '.' + self.exts[0]
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(index) or name == 'stats.json':
+                continue
+            key = name[:-len(index)]
+            try:
+                st = os.stat(self._path(key, self.exts[0]))
+                size = sum(os.path.getsize(self._path(key, ext))
+                           for ext in self.exts)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, size, key))
+
+        entries.sort()
+        return entries
+
+    def _remove(self, key):
+        for ext in self.exts:
+            try:
+                os.remove(self._path(key, ext))
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        for (mtime, size, key) in entries:
+            if total <= self.max_bytes:
+                break
+            logging.debug("evicting %s from %s" % (key, self.directory))
+            self._remove(key)
+            total -= size
+
+    def clear(self):
+        for (mtime, size, key) in self._entries():
+            self._remove(key)
+        try:
+            os.remove(self._path('stats', 'json'))
+        except OSError:
+            pass
+
+    def _counters(self):
+        try:
+            with open(self._path('stats', 'json'), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _count(self, counter, n=1):
+        # best effort.  concurrent runs can lose an increment here and
+        # there, which is fine for a stats display.
+        counters = self._counters()
+        counters[counter] = counters.get(counter, 0) + n
+        try:
+            self._write(self._path('stats', 'json'), json.dumps(counters))
+        except (IOError, OSError) as e:
+            logging.warning("couldn't update cache stats: %s" % e)
+
+    def stats(self):
+        entries = self._entries()
+        counters = self._counters()
+        return {
+            'directory' : self.directory,
+            'entries' : len(entries),
+            'bytes' : sum(e[1] for e in entries),
+            'max_bytes' : self.max_bytes,
+            'hits' : counters.get('hits', 0),
+            'misses' : counters.get('misses', 0),
+            }
+
+class SchemaCache(DiskCache):
+    exts = ('json', 'nml')
+
+    def __init__(self, directory=None, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = DEFAULT_MAX_BYTES
+        DiskCache.__init__(self, os.path.join(_cache_dir(directory),
+                                              'v%d' % CACHE_VERSION),
+                           max_bytes)
+
+    def key(self, schema):
+        hash = hashlib.sha1()
+        hash.update(schema)
+        return hash.hexdigest()
+
+    def get(self, key):
+        """
+        return the entry for key as a dict with 'checksum' and 'digests',
+        or None if we don't have it.
+        """
+        try:
+            with open(self._path(key, 'json'), 'r') as f:
+                entry = json.load(f)
+            self._hit(key)
+        except (IOError, OSError, ValueError):
+            self._miss()
+            return None
+
+        return entry
+
+    def normalized(self, key):
+        """
+        the normalized text for key, or None.
+        """
+        try:
+            with open(self._path(key, 'nml'), 'r') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, schema, key=None):
+        """
+        normalize schema, store the results, and return the new entry.
+        """
+        if key is None:
+            key = self.key(schema)
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'w') as nmlfile:
+            (checksum, digests) = schemadiff.schemamanifest(schema, nmlfile)
+        os.rename(tmp, self._path(key, 'nml'))
+
+        entry = {
+            'checksum' : checksum,
+            'digests' : digests,
+            }
+        self._write(self._path(key, 'json'), json.dumps(entry))
+        self.evict()
+        return entry
+
+    def manifest(self, schema):
+        """
+        (checksum, digests) for schema, as schemadiff.schemamanifest()
+        would return them.
+        """
+        key = self.key(schema)
+        entry = self.get(key)
+        if entry is None:
+            logging.debug("schema cache miss %s" % key)
+            entry = self.put(schema, key)
+        else:
+            logging.debug("schema cache hit %s" % key)
+
+        digests = dict((str(t), str(d)) for t, d in entry['digests'].iteritems())
+        return str(entry['checksum']), digests
+
+    def checksum(self, schema):
+        return self.manifest(schema)[0]
+
+class PlanCache(DiskCache):
+    """
+    whole plans, as the lists of schemadiff.plan_record()s that
+    iter_plan() gave, one ndjson file per pair of schemas.
+
+    layout:
+
+      <dir>/plans/v<PLAN_CACHE_VERSION>/<key>.ndjson
+      <dir>/plans/v<PLAN_CACHE_VERSION>/stats.json
+    """
+    exts = ('ndjson',)
+
+    def __init__(self, directory=None, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = DEFAULT_PLAN_MAX_BYTES
+        DiskCache.__init__(self, os.path.join(_cache_dir(directory), 'plans',
+                                              'v%d' % PLAN_CACHE_VERSION),
+                           max_bytes)
+
+    def key(self, checksum1, checksum2, **options):
+        """
+        key for the plan from the schema with checksum1 to the one with
+        checksum2.  options are whatever else changes the plan, like
+        offline=True.
+        """
+        hash = hashlib.sha1()
+        hash.update(json.dumps([checksum1, checksum2, schemadiff.PLAN_VERSION,
+                                sorted(options.items())]))
+        return hash.hexdigest()
+
+    def get(self, key):
+        """
+        the plan records for key, or None.
+        """
+        try:
+            with open(self._path(key, 'ndjson'), 'r') as f:
+                records = [schemadiff.read_plan_record(line) for line in f]
+            self._hit(key)
+        except (IOError, OSError, ValueError):
+            self._miss()
+            return None
+
+        return records
+
+    def put(self, key, records):
+        f = StringIO.StringIO()
+        for record in records:
+            schemadiff.write_plan_record(f, record)
+        self._write(self._path(key, 'ndjson'), f.getvalue())
+        self.evict()
+
+class TableDiffCache(DiskCache):
+    """
+    the ALTER TABLEs for one table, keyed by its digests in the two
+    schemas (see schemadiff.schemamanifest()), so a table that's the
+    same in some other pair of schemas isn't diffed again.  entries are
+    lists of (statement, plan operations).
+
+    there's a lookup for every common table, so hits and misses are
+    only counted in memory until flush(), which also does the eviction.
+
+    layout:
+
+      <dir>/tables/v<TABLE_CACHE_VERSION>/<key>.json
+      <dir>/tables/v<TABLE_CACHE_VERSION>/stats.json
+    """
+    def __init__(self, directory=None, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = DEFAULT_TABLE_MAX_BYTES
+        DiskCache.__init__(self, os.path.join(_cache_dir(directory), 'tables',
+                                              'v%d' % TABLE_CACHE_VERSION),
+                           max_bytes)
+        self.flushed = { 'hits' : 0, 'misses' : 0 }
+
+    def key(self, table, digest1, digest2, prettyprint, **options):
+        """
+        options are whatever else changes the diff, as for PlanCache.key():
+        where the definitions came from, say.
+        """
+        hash = hashlib.sha1()
+        hash.update(json.dumps([table, digest1, digest2, prettyprint,
+                                schemadiff.PLAN_VERSION,
+                                sorted(options.items())]))
+        return hash.hexdigest()
+
+    def _hit(self, key):
+        os.utime(self._path(key, 'json'), None)
+        self.hits += 1
+
+    def _miss(self):
+        self.misses += 1
+
+    def get(self, key):
+        try:
+            with open(self._path(key, 'json'), 'r') as f:
+                steps = schemadiff.json_bytes(json.load(f))
+            self._hit(key)
+        except (IOError, OSError, ValueError):
+            self._miss()
+            return None
+
+        return [tuple(step) for step in steps]
+
+    def put(self, key, steps):
+        self._write(self._path(key, 'json'), json.dumps(steps))
+
+    def flush(self):
+        """
+        add this run's hits and misses to the stats on disk, and evict.
+        """
+        for counter in ('hits', 'misses'):
+            n = getattr(self, counter) - self.flushed[counter]
+            if n > 0:
+                self._count(counter, n)
+            self.flushed[counter] = getattr(self, counter)
+        self.evict()
+
+if __name__ == '__main__':
+    FORMAT = "%(asctime)-15s %(funcName)s %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", help="cache directory")
+    parser.add_argument("--plans", help="the plan cache instead of the schema cache",
+                        action="store_true")
+    parser.add_argument("--tables", help="the table diff cache instead of the schema cache",
+                        action="store_true")
+    parser.add_argument("command", choices=['stats', 'clear'])
+    args = parser.parse_args()
+
+    if args.plans:
+        cache = PlanCache(args.cache_dir)
+    elif args.tables:
+        cache = TableDiffCache(args.cache_dir)
+    else:
+        cache = SchemaCache(args.cache_dir)
+
+    if args.command == 'clear':
+        cache.clear()
+        print "cleared %s" % cache.directory
+        sys.exit(0)
+
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    print "directory:  %s" % stats['directory']
+    print "entries:    %d" % stats['entries']
+    print "size:       %d of %d bytes" % (stats['bytes'], stats['max_bytes'])
+    print "hits:       %d" % stats['hits']
+    print "misses:     %d" % stats['misses']
+    if lookups > 0:
+        print "hit rate:   %.1f%%" % (100.0 * stats['hits'] / lookups)
@@ -31,7 +31,18 @@ import os
 import hashlib
 import string
 import subprocess
+import tempfile
+import heapq
+import itertools
+import threading
+import Queue
+import collections
+import json
 import dsn
+import schemamodel
+import ddlparse
+from schemastatements import schema_lines, iter_statements, statement_table, \
+     statement_tables
 
 from warnings import filterwarnings
 
@@ -55,7 +66,26 @@ from warnings import filterwarnings
 #     sed "s/ comment '.*'//g"
 # }
 
-def normalize(s):
+# set to True to run normalize() through the shell pipeline above
+# instead of the in-process version.  only here while we make sure the
+# two agree; see TestNormalize.
+SHELL_NORMALIZE = False
+
+# a sandbox.Sandbox to do scratch work in instead of the server in dsn.
+# get_connection() and dbdump() go there when it's set.
+SANDBOX = None
+
+# set to True to have dbdump() run mysqldump instead of reading the
+# CREATE TABLE statements itself.  only here while we make sure the two
+# agree; see TestDump.
+MYSQLDUMP = False
+
+def get_connection():
+    if SANDBOX is not None:
+        return SANDBOX.connect()
+    return dsn.getConnection()
+
+def _normalize_shell(s):
     lines = s.split('\n')
     lines = [l + '\n' for l in lines]
     lines.insert(0, 'echo')
@@ -87,16 +117,99 @@ def normalize(s):
 
     return '\n'.join(lines)
 
+# compiled equivalents of the pipeline stages, in pipeline order.  a
+# few quirks of the pipeline have to be reproduced exactly:
+#
+# - echo puts a space in front of every line but the first, which is
+#   what lets " AUTO_INCREMENT=" match at the start of a line.
+# - the \1 in the punctuation sed is a python octal escape, so sed
+#   replaces the punctuation with \x01 rather than keeping it.  that
+#   means no '=' or ',' survive it, so the "s/,//g" and
+#   "s/ comment='.*'//g" stages never match anything.
+
+_nml_skip = re.compile(r'^\s*--|^\s*SET|^\s*\$')
+_nml_auto_increment = re.compile(r' AUTO_INCREMENT=([0-9]+)')
+_nml_lower = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_nml_default_collate = re.compile(r'\s?default\s+collate[=\s]+[a-z0-9_]+')
+_nml_collate = re.compile(r'\s?collate[=\s]+[a-z0-9_]+')
+_nml_percent = re.compile(r'\s?[%][a-z0-9_]+[%]')
+_nml_space = re.compile(r'\s+')
+_nml_punct = re.compile(r'\s*[=,()]\s*')
+_nml_comment = re.compile(r" comment '.*'")
+_nml_nonword = re.compile(r'[^\w]+')
+
+def _normalize_line(l):
+    """
+    run one line through the normalizer.  returns None if the line
+    gets dropped.
+    """
+    if _nml_skip.match(l):
+        return None
+
+    l = _nml_auto_increment.sub('', l, 1)
+    l = l.translate(_nml_lower)
+    l = _nml_default_collate.sub('', l, 1)
+    l = _nml_collate.sub('', l, 1)
+    l = _nml_percent.sub('', l, 1)
+
+    if 'set character_set_client' in l or 'saved_cs_client' in l:
+        return None
+
+    l = _nml_space.sub(' ', l.strip())
+    if len(l) == 0:
+        return None
+
+    l = _nml_punct.sub('\x01', l)
+    l = _nml_comment.sub('', l)
+    return _nml_nonword.sub('', l)
+
+def iter_normalized(src):
+    """
+    generate the normalized lines of a schema, without newlines.  src is
+    either a string or an open file; files are read a line at a time.
+    """
+    first = True
+    for l in schema_lines(src):
+        if not first:
+            l = ' ' + l
+        first = False
+
+        l = _normalize_line(l)
+        if l is not None:
+            yield l
+
+def _normalize_inprocess(s):
+    return ''.join(l + '\n' for l in iter_normalized(s))
+
+def normalize(s, shell=None):
+    """
+    strip out everything in a schema dump that doesn't matter for
+    comparison purposes.  see the shell function above for what that
+    means.
+
+    shell:  True to use the shell pipeline, False for the in-process
+    normalizer.  defaults to SHELL_NORMALIZE.
+    """
+    if shell is None:
+        shell = SHELL_NORMALIZE
+
+    if shell:
+        return _normalize_shell(s)
+    return _normalize_inprocess(s)
+
 def shacmd(s):
     hash = hashlib.sha1()
     hash.update(s)
     return hash.hexdigest()
 
-def dbdump(dbname):
+def _mysqldump(dbname):
     try:
-        dumpcmd = "mysqldump -u %(user)s -p%(passwd)s --no-data --skip-add-drop-table %(dbname)s" % {
-            "user" : dsn.user,
-            "passwd" : dsn.passwd,
+        if SANDBOX is not None:
+            login = SANDBOX.dump_args()
+        else:
+            login = "-u %s -p%s" % (dsn.user, dsn.passwd)
+        dumpcmd = "mysqldump %(login)s --no-data --skip-add-drop-table %(dbname)s" % {
+            "login" : login,
             "dbname" : dbname
             }
     
@@ -107,18 +220,291 @@ def dbdump(dbname):
         logging.error(e)
         raise
 
+def dbdump(dbname, cursor=None, workers=None):
+    """
+    the schema of dbname, in a form normalize() takes; see
+    dump_schema().
+
+    cursor:  what to read it with.  by default we use a connection of
+    our own.
+    workers:  if more than 1, spread the reading over this many extra
+    connections.
+    """
+    if MYSQLDUMP:
+        return _mysqldump(dbname)
+
+    conn = None
+    if cursor is None:
+        conn = get_connection()
+        cursor = conn.cursor()
+    pool = None
+    if workers > 1:
+        pool = ConnectionPool(workers)
+
+    try:
+        return dump_schema(cursor, dbname, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+        if conn is not None:
+            cursor.close()
+            conn.close()
+
+# how many bytes of normalized lines _sorted_lines() keeps in memory
+# before it starts spilling sorted runs to temp files.
+SORT_BUFFER_BYTES = 64 * 1024 * 1024
+
+def _spill(chunk):
+    run = tempfile.TemporaryFile()
+    run.writelines(l + '\n' for l in chunk)
+    run.seek(0)
+    return run
+
+def _sorted_lines(lines, bufsize=None):
+    """
+    generate lines in sorted order.  up to bufsize bytes are sorted in
+    memory; past that, sorted runs go to temp files and get merged at
+    the end.  normalized lines never contain newlines, so the runs can
+    be plain text files.
+    """
+    if bufsize is None:
+        bufsize = SORT_BUFFER_BYTES
+
+    runs = []
+    try:
+        chunk = []
+        size = 0
+        for l in lines:
+            chunk.append(l)
+            size += len(l) + 1
+            if size >= bufsize:
+                chunk.sort()
+                runs.append(_spill(chunk))
+                chunk = []
+                size = 0
+
+        chunk.sort()
+        if len(runs) == 0:
+            for l in chunk:
+                yield l
+            return
+
+        sources = [(l[:-1] for l in run) for run in runs]
+        sources.append(iter(chunk))
+        for l in heapq.merge(*sources):
+            yield l
+    finally:
+        for run in runs:
+            run.close()
+
+def _checksum_lines(lines):
+    """
+    same as shacmd('\\n'.join(lines)) but without building the string.
+    """
+    hash = hashlib.sha1()
+    sep = ''
+    for l in lines:
+        hash.update(sep)
+        hash.update(l)
+        sep = '\n'
+    return hash.hexdigest()
+
 def schemachecksum(dbschema):
-    nized = normalize(dbschema)
-    lines = nized.split('\n')
-    sortedlines = sorted(lines)
-    return shacmd('\n'.join(sortedlines))
+    """
+    checksum of the sorted, normalized lines of a schema.  dbschema is
+    either a string or an open file.  memory use doesn't depend on the
+    size of the schema; see _sorted_lines().
+    """
+    if SHELL_NORMALIZE and isinstance(dbschema, basestring):
+        lines = normalize(dbschema).split('\n')
+    else:
+        # normalize() output ends with a newline, and the empty line
+        # after it has always been part of the checksum.
+        lines = itertools.chain([''], iter_normalized(dbschema))
+
+    return _checksum_lines(_sorted_lines(lines))
+
+# matches the line that starts a CREATE TABLE statement in a schema
+# file or dump, and picks out the table name.
+def _table_lines(src):
+    """
+    like iter_normalized(), but generates (tables, line) pairs, where
+    tables lists the tables changed by the statement the line came from
+    (see statement_tables()):  the one a CREATE TABLE creates, or the
+    ones a later ALTER TABLE, CREATE INDEX and so on changes.  it's
+    empty for lines of any other statement.
+    """
+    tables = []
+    first = True
+    for raw in schema_lines(src):
+        found = statement_tables(raw)
+        if found:
+            tables = found
+
+        l = raw
+        if not first:
+            l = ' ' + l
+        first = False
+
+        l = _normalize_line(l)
+        if l is not None:
+            yield tables, l
+
+        if raw.rstrip().endswith(';'):
+            tables = []
+
+def schemamanifest(dbschema, nmlfile=None, multiset=None):
+    """
+    normalize a schema once and return (checksum, digests).  checksum is
+    what schemachecksum() returns; digests maps each table name to the
+    sha1 of that table's normalized lines, in order, including those of
+    any statements after its CREATE TABLE that change it.  if nmlfile is an
+    open file the normalized text is written to it as we go.  if
+    multiset is a MultisetChecksum, the normalized lines are added to it.
+    """
+    digests = {}
+
+    def normalized():
+        for tables, l in _table_lines(dbschema):
+            for table in tables:
+                if table not in digests:
+                    digests[table] = hashlib.sha1()
+                digests[table].update(l + '\n')
+            if nmlfile:
+                nmlfile.write(l + '\n')
+            if multiset is not None:
+                multiset.add_line(l)
+            yield l
+
+    lines = itertools.chain([''], normalized())
+    checksum = _checksum_lines(_sorted_lines(lines))
+    if SHELL_NORMALIZE and isinstance(dbschema, basestring):
+        checksum = schemachecksum(dbschema)
+
+    return checksum, dict((t, h.hexdigest()) for t, h in digests.iteritems())
+
+# set to False to stop diff_schemas() computing a MultisetChecksum of
+# each schema alongside schemachecksum() and complaining when the two
+# disagree.  only here until the multiset checksum has proven itself.
+CHECK_MULTISET = True
+
+# MultisetChecksum sums sha1 digests, which are 160 bits
+_MULTISET_MODULUS = 1 << 160
+
+def _line_hash(l):
+    return int(hashlib.sha1(l).hexdigest(), 16)
+
+def _statement_lines(ddl):
+    """
+    the normalized lines of one statement, the way they'd come out of
+    the middle of a schema.
+    """
+    for l in schema_lines(ddl):
+        l = _normalize_line(' ' + l)
+        if l is not None:
+            yield l
+
+class MultisetChecksum(object):
+    """
+    an order-independent checksum of a schema's normalized lines:  the
+    sum of their sha1s, mod 2**160.  two schemas have the same one when
+    they have the same lines, which is when schemachecksum() says
+    they're the same.
+
+    unlike schemachecksum(), nothing has to be sorted, and lines or
+    whole tables can be added and removed in time proportional to their
+    size, so a tool changing a schema can keep its checksum current and
+    compare it with a target without normalizing the schema again.
+    removing something that was never added gives a meaningless value.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value=0):
+        self.value = value
+
+    def add_line(self, l):
+        self.value = (self.value + _line_hash(l)) % _MULTISET_MODULUS
+
+    def remove_line(self, l):
+        self.value = (self.value - _line_hash(l)) % _MULTISET_MODULUS
+
+    def add_lines(self, lines):
+        for l in lines:
+            self.add_line(l)
+
+    def remove_lines(self, lines):
+        for l in lines:
+            self.remove_line(l)
+
+    def add_table(self, ddl):
+        """
+        add the lines of a CREATE TABLE statement, normalized.
+        """
+        self.add_lines(_statement_lines(ddl))
+
+    def remove_table(self, ddl):
+        self.remove_lines(_statement_lines(ddl))
+
+    def add(self, other):
+        """
+        add everything in another MultisetChecksum, e.g. one table's
+        from schemamultiset().
+        """
+        self.value = (self.value + other.value) % _MULTISET_MODULUS
+
+    def remove(self, other):
+        self.value = (self.value - other.value) % _MULTISET_MODULUS
+
+    def copy(self):
+        return MultisetChecksum(self.value)
+
+    def hexdigest(self):
+        return '%040x' % self.value
+
+    def __eq__(self, other):
+        return isinstance(other, MultisetChecksum) and self.value == other.value
+
+    def __ne__(self, other):
+        return not self == other
 
-def dbchecksum(dbname):
-    return schemachecksum(dbdump(dbname))
+    def __repr__(self):
+        return 'MultisetChecksum(%s)' % self.hexdigest()
 
-def disgorge(dbname):
+def schemamultiset(dbschema):
+    """
+    (checksum, tables) for a schema:  a MultisetChecksum of all its
+    normalized lines, and a dict of table name -> MultisetChecksum of
+    that table's lines, for taking a whole table out again.
+    """
+    checksum = MultisetChecksum()
+    tables = {}
+    for names, l in _table_lines(dbschema):
+        checksum.add_line(l)
+        for table in names:
+            if table not in tables:
+                tables[table] = MultisetChecksum()
+            tables[table].add_line(l)
+    return checksum, tables
+
+def filechecksum(filename):
+    """
+    schemachecksum() of a file, reading it a line at a time.
+    """
+    with open(filename, 'r') as f:
+        return schemachecksum(f)
+
+def dbchecksum(dbname, cache=None, cursor=None, workers=None):
+    """
+    cache:  optional schemacache.SchemaCache
+    cursor, workers:  as for dbdump()
+    """
+    if cache:
+        return cache.checksum(dbdump(dbname, cursor, workers))
+    return schemachecksum(dbdump(dbname, cursor, workers))
+
+def disgorge(dbname, cursor=None, workers=None):
     # write out the raw db schema
-    schema = dbdump(dbname)
+    schema = dbdump(dbname, cursor, workers)
     f = open('%s.sql' % dbname, 'w')
     f.write(schema)
     f.close()
@@ -165,585 +551,1550 @@ def _format_dmls(table, db1, db2, clauses, prettyprint):
 
     return dmls
 
-def diff_fks(cursor, table, db1, db2):
-    query = """
-select
-	local_part.constraint_name,
-concat (
-'ADD CONSTRAINT ',
-local_part.constraint_name,
-' FOREIGN KEY (',
-local_part.columns,
-') REFERENCES ',
-ref_part.referenced_table_name,
-'(',
-ref_part.referenced_columns,
-')'
-) expr
-from
-(
-    select
-    
-    -- table_constraints
-    c.TABLE_SCHEMA       ,
-    c.TABLE_NAME         ,
-    c.CONSTRAINT_NAME    ,
-    
-    -- key_column_usage
-    group_concat(k.column_name order by k.ordinal_position) columns
-    
-    from information_schema.table_constraints c
-    inner join information_schema.key_column_usage k
-    on
-    c.constraint_name = k.constraint_name and
-    c.table_schema = k.table_schema and
-    c.table_name = k.table_name
-    
-    where 
-    c.constraint_type = 'FOREIGN KEY'
-    
-    group by c.table_schema, c.table_name, c.constraint_name
-) local_part
-inner join
-(
-    select
-    
-    -- table_constraints
-    c.TABLE_SCHEMA       ,
-    c.TABLE_NAME         ,
-    c.CONSTRAINT_NAME    ,
-    
-    k.REFERENCED_TABLE_NAME         ,
-    group_concat(k.referenced_column_name order by k.ordinal_position) referenced_columns
-    
-    from information_schema.table_constraints c
-    inner join information_schema.key_column_usage k
-    on
-    c.constraint_name = k.constraint_name and
-    c.table_schema = k.table_schema and
-    c.table_name = k.table_name
-    
-    where 
-    c.constraint_type = 'FOREIGN KEY'
-    
-    group by c.table_schema, c.table_name, c.constraint_name
-) ref_part
+_snapshot_queries = {
+    'tables' : """
+select table_name, engine
+ from information_schema.tables
+ where table_schema = '%(db)s'%(and_table)s
+""",
+    'columns' : """
+select table_name, column_name, column_type, is_nullable, column_default,
+       extra, column_comment
+ from information_schema.columns
+ where table_schema = '%(db)s'%(and_table)s
+ order by table_name, ordinal_position
+""",
+    'statistics' : """
+select table_name, index_name, column_name, sub_part
+ from information_schema.statistics
+ where table_schema = '%(db)s'%(and_table)s
+ order by table_name, index_name, seq_in_index
+""",
+    'constraints' : """
+select table_name, constraint_name, constraint_type
+ from information_schema.table_constraints
+ where table_schema = '%(db)s'%(and_table)s
+""",
+    'fk_columns' : """
+select table_name, constraint_name, column_name, referenced_table_name,
+       referenced_column_name
+ from information_schema.key_column_usage
+ where table_schema = '%(db)s'%(and_table)s
+ and referenced_table_name is not null
+ order by table_name, constraint_name, ordinal_position
+""",
+    }
+
+def _map_pool(pool, fn, items):
+    """
+    [fn(cursor, item) for item in items], each call on its own
+    connection from pool, all at once.
+    """
+    results = [None] * len(items)
+    errors = []
+
+    def run(i):
+        conn = pool.get()
+        try:
+            c = conn.cursor()
+            results[i] = fn(c, items[i])
+            c.close()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pool.put(conn)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(items))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+def _fetch(cursor, query):
+    cursor.execute(query)
+    return cursor.fetchall()
+
+def _query_rows(cursor, queries, pool=None):
+    """
+    run queries and return a list of their rows, in the same order.
+    with a ConnectionPool, they run at once, each on its own connection.
+    """
+    if pool is None:
+        return [_fetch(cursor, q) for q in queries]
+    return _map_pool(pool, _fetch, queries)
 
-on  local_part.table_schema = ref_part.table_schema
-and local_part.table_name = ref_part.table_name
-and local_part.constraint_name = ref_part.constraint_name
+_snapshot_order = ['tables', 'columns', 'constraints', 'statistics', 'fk_columns']
 
-where local_part.table_schema = '%(db)s'
-and local_part.table_name = '%(table)s'
-;
-"""
-    q1 = query % { "db" : db1, "table" : table }
-    q2 = query % { "db" : db2, "table" : table }
+def snapshot_queries(dbs, table=None):
+    """
+    the queries snapshot_schemas() runs, for anybody who wants to run
+    them some other way.  hand their rows, in the same order, to
+    build_schemas().
+    """
+    and_table = ''
+    if table is not None:
+        and_table = " and table_name = '%s'" % table
+
+    queries = []
+    for db in dbs:
+        for name in _snapshot_order:
+            queries.append(_snapshot_queries[name] % {
+                    "db" : db, "and_table" : and_table })
+    return queries
+
+def build_schemas(dbs, results):
+    """
+    dict of db -> schemamodel.Schema from the rows of snapshot_queries(dbs).
+    """
+    schemas = {}
+    n = len(_snapshot_order)
+    for (i, db) in enumerate(dbs):
+        schemas[db] = _build_schema(*results[i * n:(i + 1) * n])
+    return schemas
 
-    select_columns = ['constraint_name', 'expr']
-    indexdefs1 = {}
-    cursor.execute(q1)
-    for row in cursor.fetchall():
-        d = dict(zip(select_columns,
-                     row))
-        indexdefs1[d['constraint_name']] = d
+def snapshot_schemas(cursor, dbs, table=None, pool=None):
+    """
+    read every table in each of dbs into a schemamodel.Schema, in a
+    fixed number of queries no matter how many tables there are.
+    returns a dict of db -> Schema.  if table is given, read just that
+    one.  with a ConnectionPool, all the queries run at once.
+    """
+    results = _query_rows(cursor, snapshot_queries(dbs, table), pool)
+    return build_schemas(dbs, results)
+
+def snapshot_schema(cursor, db, table=None):
+    return snapshot_schemas(cursor, [db], table)[db]
+
+# Index.kind for each constraint type.  information_schema doesn't tell
+# fulltext and spatial indexes apart from plain ones here.
+_index_kinds = {
+    'PRIMARY KEY' : 'PRIMARY',
+    'UNIQUE' : 'UNIQUE',
+    }
+
+def _build_schema(table_rows, column_rows, constraint_rows, statistics_rows,
+                  fk_rows):
+    engines = collections.OrderedDict(table_rows)
+
+    # table name -> list of Columns, OrderedDict of index name ->
+    # (constraint type, [(column, sub_part)]), OrderedDict of fk name ->
+    # (columns, referenced table, referenced columns)
+    columns = dict((t, []) for t in engines)
+    indexes = dict((t, collections.OrderedDict()) for t in engines)
+    fks = dict((t, collections.OrderedDict()) for t in engines)
+
+    for (t, name, column_type, is_nullable, default, extra,
+         comment) in column_rows:
+        columns[t].append(schemamodel.Column(
+                name, column_type, is_nullable != 'NO', default, extra, comment))
+
+    # a PRIMARY KEY or UNIQUE constraint has the same name as its index
+    constraint_types = {}
+    for (t, name, constraint_type) in constraint_rows:
+        if constraint_type != 'FOREIGN KEY':
+            constraint_types[(t, name)] = constraint_type
+
+    for (t, name, column, sub_part) in statistics_rows:
+        if name not in indexes[t]:
+            indexes[t][name] = (constraint_types.get((t, name)), [])
+        indexes[t][name][1].append((column, sub_part))
+
+    for (t, name, column, ref_table, ref_column) in fk_rows:
+        if name not in fks[t]:
+            fks[t][name] = ([], ref_table, [])
+        fks[t][name][0].append(column)
+        fks[t][name][2].append(ref_column)
+
+    schema = schemamodel.Schema()
+    for (t, engine) in engines.iteritems():
+        schema.add(schemamodel.Table(
+                t, columns[t],
+                [schemamodel.Index(name, parts, constraint_type,
+                                   _index_kinds.get(constraint_type, ''))
+                 for (name, (constraint_type, parts)) in indexes[t].iteritems()],
+                [schemamodel.ForeignKey(name, cols, ref_table, ref_cols)
+                 for (name, (cols, ref_table, ref_cols)) in fks[t].iteritems()],
+                engine))
+    return schema
+
+class ServerCatalog(schemamodel.Catalog):
+    """
+    a catalog that asks information_schema on a live server, one table
+    at a time.  a table is only read once per catalog.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.cache = {}
+
+    def tables(self, db):
+        self.cursor.execute("select table_name from information_schema.tables where table_schema = '%s'" % db)
+        return set(row[0] for row in self.cursor.fetchall())
+
+    def table(self, db, table):
+        if (db, table) not in self.cache:
+            schema = snapshot_schema(self.cursor, db, table)
+            self.cache[(db, table)] = schema.tables.get(table)
+        return self.cache[(db, table)]
+
+    def create_table(self, db, table):
+        self.cursor.execute("show create table %s.%s;" % (db, table))
+        for row in self.cursor.fetchall():
+            return row[1]
+
+class SnapshotCatalog(schemamodel.ModelCatalog):
+    """
+    a catalog that reads each database from the server once, with
+    snapshot_schemas(), and answers everything else from memory.
+    pool:  optional ConnectionPool to run the snapshot queries on.
+    """
+    def __init__(self, cursor, pool=None):
+        schemamodel.ModelCatalog.__init__(self, {})
+        self.cursor = cursor
+        self.pool = pool
+
+    def prefetch(self, dbs):
+        """
+        read several databases at once.
+        """
+        dbs = [db for db in dbs if db not in self.schemas]
+        if len(dbs) > 0:
+            logging.debug("reading catalogs for %s" % ', '.join(dbs))
+            self.schemas.update(snapshot_schemas(self.cursor, dbs, pool=self.pool))
+
+    def _schema(self, db):
+        self.prefetch([db])
+        return self.schemas[db]
+
+    def create_table(self, db, table):
+        # the server's own version, not our approximation of it
+        return ServerCatalog(self.cursor).create_table(db, table)
+
+# how many SHOW CREATE TABLE statements ShowCreateCatalog sends per
+# round trip
+SHOW_CREATE_BATCH = 100
+
+def _quote(name):
+    return '`%s`' % name.replace('`', '``')
+
+def _show_create(cursor, (db, tables)):
+    """
+    CREATE TABLE statements for tables, in one round trip.
+    """
+    conn = cursor.connection
+    conn.set_server_option(MYSQL_OPTION_MULTI_STATEMENTS_ON)
+    try:
+        cursor.execute(';\n'.join("show create table %s.%s" % (_quote(db), _quote(t))
+                                  for t in tables))
+        ddls = []
+        while True:
+            for row in cursor.fetchall():
+                ddls.append(row[1])
+            if not cursor.nextset():
+                break
+    finally:
+        conn.set_server_option(MYSQL_OPTION_MULTI_STATEMENTS_OFF)
+    return ddls
+
+def _list_tables(cursor, db):
+    """
+    (name, table type) for everything in db, by name.
+    """
+    cursor.execute("show full tables from %s" % _quote(db))
+    return sorted(cursor.fetchall())
 
-    indexdefs2 = {}
-    cursor.execute(q2)
-    for row in cursor.fetchall():
-        d = dict(zip(select_columns,
-                     row))
-        indexdefs2[d['constraint_name']] = d
+def show_create_tables(cursor, db, tables, pool=None, batch_size=None):
+    """
+    dict of table -> what SHOW CREATE TABLE says about it, for tables in
+    db.  the statements go batch_size to a round trip, and with a pool
+    the batches run at once.
+    """
+    if batch_size is None:
+        batch_size = SHOW_CREATE_BATCH
+
+    batches = [(db, tables[i:i + batch_size])
+               for i in range(0, len(tables), batch_size)]
+    if pool is None:
+        results = [_show_create(cursor, batch) for batch in batches]
+    else:
+        results = _map_pool(pool, _show_create, batches)
+
+    ddls = {}
+    for ((db, names), statements) in zip(batches, results):
+        ddls.update(zip(names, statements))
+    return ddls
+
+class ShowCreateCatalog(schemamodel.ModelCatalog):
+    """
+    a catalog that reads SHOW CREATE TABLE for every table and parses
+    it with ddlparse, instead of going through information_schema.
+    the statements go batch_size to a round trip, and with a pool the
+    batches run at once.
 
-    indexes_1 = set(indexdefs1.keys())
-    indexes_2 = set(indexdefs2.keys())
+    views have no CREATE TABLE to parse, so their columns are read from
+    information_schema, as SnapshotCatalog would.
+    """
+    def __init__(self, cursor, pool=None, batch_size=None):
+        schemamodel.ModelCatalog.__init__(self, {})
+        self.cursor = cursor
+        self.pool = pool
+        self.batch_size = batch_size
+        # (db, table) -> what the server said
+        self.ddls = {}
+
+    def _read(self, db):
+        logging.debug("reading create statements for %s" % db)
+        rows = _list_tables(self.cursor, db)
+        tables = [name for (name, table_type) in rows if table_type == 'BASE TABLE']
+        ddls = show_create_tables(self.cursor, db, tables, self.pool,
+                                  self.batch_size)
+
+        views = self._read_views(db, [name for (name, table_type) in rows
+                                      if table_type != 'BASE TABLE'])
+
+        schema = schemamodel.Schema()
+        for (name, table_type) in rows:
+            if table_type == 'BASE TABLE':
+                self.ddls[(db, name)] = ddls[name]
+                schema.add(ddlparse.parse_create_table(ddls[name],
+                                                       explicit_defaults=True))
+            else:
+                schema.add(views.tables[name])
+        return schema
+
+    def _read_views(self, db, views):
+        if len(views) == 0:
+            return schemamodel.Schema()
+        column_rows = _fetch(self.cursor, _snapshot_queries['columns'] % {
+                "db" : db,
+                "and_table" : " and table_name in (%s)" % ', '.join(
+                    "'%s'" % v for v in views) })
+        return _build_schema([(v, None) for v in views], column_rows, [], [], [])
+
+    def prefetch(self, dbs):
+        for db in dbs:
+            self._schema(db)
+
+    def _schema(self, db):
+        if db not in self.schemas:
+            self.schemas[db] = self._read(db)
+        return self.schemas[db]
+
+    def create_table(self, db, table):
+        self._schema(db)
+        if (db, table) in self.ddls:
+            return self.ddls[(db, table)]
+        return ServerCatalog(self.cursor).create_table(db, table)
+
+def dump_schema(cursor, db, pool=None, batch_size=None):
+    """
+    what mysqldump --no-data says about db, as far as normalize() is
+    concerned:  the CREATE statement for each table, in name order.
+    pool and batch_size are as for show_create_tables().
 
-    add = indexes_2 - indexes_1
-    drop = indexes_1 - indexes_2
-    common = indexes_1 & indexes_2
+    views come out as the server's CREATE VIEW, where mysqldump would
+    also put a placeholder table first, so their lines don't match.
+    """
+    rows = _list_tables(cursor, db)
+    ddls = show_create_tables(cursor, db, [name for (name, table_type) in rows],
+                              pool, batch_size)
+    return ''.join('%s;\n\n' % ddls[name] for (name, table_type) in rows)
+
+# catalogs diff_databases() can read a server with
+CATALOGS = {
+    'information_schema' : SnapshotCatalog,
+    'show_create' : ShowCreateCatalog,
+    }
+
+def _catalog(cursor):
+    """
+    the diff functions take either a cursor or a schemamodel.Catalog.
+    """
+    if isinstance(cursor, schemamodel.Catalog):
+        return cursor
+    return ServerCatalog(cursor)
 
-    drop_clauses = []
-    add_clauses = []
+def _tables(cursor, table, db1, db2):
+    """
+    the two versions of table.  a table that isn't there comes back
+    empty.
+    """
+    catalog = _catalog(cursor)
+    return (catalog.table(db1, table) or schemamodel.Table(table, engine=None),
+            catalog.table(db2, table) or schemamodel.Table(table, engine=None))
 
-    for k in drop:
-        drop_clauses.append("DROP FOREIGN KEY %s" % k)
+# one clause of an ALTER TABLE, or a whole CREATE or DROP TABLE (with
+# no clause).  kind is a key of _change_costs; source and target are the
+# definitions before and after, None where there isn't one.
+Change = collections.namedtuple('Change', 'clause kind name source target')
 
-    for k in add:
-        add_clauses.append(indexdefs2[k]['expr'])
+def _clauses(*changes):
+    return tuple([c.clause for c in cs] for cs in changes)
 
-    for k in common:
-        if indexdefs1[k]['expr'] != indexdefs2[k]['expr']:
-            drop_clauses.append("DROP FOREIGN KEY %s" % k)
-            add_clauses.append(indexdefs2[k]['expr'])
+def _diff_defs(defs1, defs2, drop_clause, kind):
+    """
+    compare two dicts of name -> definition.  drop_clause(name) gives
+    the clause that drops one; a definition's expr() adds it.  returns
+    lists of Changes dropping and adding definitions, of kinds drop_kind
+    and add_kind.
+    """
+    names1 = set(defs1.keys())
+    names2 = set(defs2.keys())
 
-    return drop_clauses, add_clauses
+    drops = []
+    adds = []
 
-def diff_plain_indexes(cursor, table, db1, db2):
-    query = """
-select
-    s.index_name,
-concat (
-'ADD KEY ',
-s.index_name,
-'(',
-group_concat(s.column_name, if(s.sub_part, concat('(', s.sub_part, ')'), '') order by s.seq_in_index),
-')'
-) expr
-from
-     information_schema.statistics s
-left join
-(
-    select distinct
-    s.table_catalog,
-    s.table_schema,
-    s.table_name,
-    s.index_name,
-    1
-    
-    from information_schema.statistics s
-    
-    inner join information_schema.key_column_usage k
-    on s.table_catalog = k.table_catalog
-    and s.table_schema = k.table_schema
-    and s.table_name = k.table_name
-    and s.index_name = k.constraint_name
-    
-    left join information_schema.table_constraints c
-    on k.table_schema = c.table_schema
-    and k.table_name = c.table_name
-    and k.constraint_name = c.constraint_name
-    
-    where 
-        s.table_schema = '%(db)s' and
-        s.table_name = '%(table)s' and
-        c.constraint_type <> 'foreign key'
-
-) t
-on
-t.table_catalog = s.table_catalog and
-t.table_schema = s.table_schema and
-t.table_name = s.table_name and
-t.index_name = s.index_name
-
-where t.table_catalog is null and
-s.table_schema = '%(db)s' and
-s.table_name = '%(table)s'
-
-group by s.table_catalog, s.table_schema, s.table_name, s.index_name
-"""
-    q1 = query % { "db" : db1, "table" : table }
-    q2 = query % { "db" : db2, "table" : table }
+    def drop(k):
+        drops.append(Change(drop_clause(k), 'drop_' + kind, k, defs1[k], None))
 
-    select_columns = ['index_name', 'expr']
-    indexdefs1 = {}
-    cursor.execute(q1)
-    for row in cursor.fetchall():
-        d = dict(zip(select_columns,
-                     row))
-        indexdefs1[d['index_name']] = d
+    def add(k):
+        adds.append(Change(defs2[k].expr(), 'add_' + kind, k, None, defs2[k]))
 
-    indexdefs2 = {}
-    cursor.execute(q2)
-    for row in cursor.fetchall():
-        d = dict(zip(select_columns,
-                     row))
-        indexdefs2[d['index_name']] = d
+    for k in sorted(names1 - names2):
+        drop(k)
 
-    indexes_1 = set(indexdefs1.keys())
-    indexes_2 = set(indexdefs2.keys())
+    for k in sorted(names2 - names1):
+        add(k)
 
-    add = indexes_2 - indexes_1
-    drop = indexes_1 - indexes_2
-    common = indexes_1 & indexes_2
+    for k in sorted(names1 & names2):
+        if defs1[k] != defs2[k]:
+            drop(k)
+            add(k)
 
-    drop_clauses = []
-    add_clauses = []
+    return drops, adds
 
-    for k in drop:
-        drop_clauses.append("DROP INDEX %s" % k)
+def _fk_changes(cursor, table, db1, db2):
+    (t1, t2) = _tables(cursor, table, db1, db2)
+    return _diff_defs(t1.fks_by_name(), t2.fks_by_name(),
+                      lambda k: "DROP FOREIGN KEY %s" % k, 'fk')
 
-    for k in add:
-        add_clauses.append(indexdefs2[k]['expr'])
+def diff_fks(cursor, table, db1, db2):
+    return _clauses(*_fk_changes(cursor, table, db1, db2))
 
-    for k in common:
-        if indexdefs1[k]['expr'] != indexdefs2[k]['expr']:
-            drop_clauses.append("DROP INDEX %s" % k)
-            add_clauses.append(indexdefs2[k]['expr'])
+def _plain_index_changes(cursor, table, db1, db2):
+    (t1, t2) = _tables(cursor, table, db1, db2)
+    return _diff_defs(t1.plain_indexes(), t2.plain_indexes(),
+                      lambda k: "DROP INDEX %s" % k, 'index')
 
-    return drop_clauses, add_clauses
+def diff_plain_indexes(cursor, table, db1, db2):
+    return _clauses(*_plain_index_changes(cursor, table, db1, db2))
 
-def diff_constrained_indexes(cursor, table, db1, db2):
-    # UNIQUE or PRIMARY KEY indexes
-    query = """
-
-select
-    index_name,
-    constraint_type,
-concat (
-'ADD ',
-case constraint_type
-when 'PRIMARY KEY' then constraint_type
-when 'UNIQUE'      then concat('UNIQUE KEY ', index_name)
-end,
-'(',
-group_concat(column_name, if(sub_part, concat('(', sub_part, ')'), '') order by seq_in_index),
-')'
-) expr
-from
-(
-    select distinct
-           s.table_catalog,
-           s.table_schema,
-           s.table_name,
-           s.index_name,
-           s.column_name, 
-           s.seq_in_index,
-           s.sub_part,
-           c.constraint_type
-    
-    from information_schema.statistics s
-    
-    inner join information_schema.key_column_usage k
-    on s.table_catalog = k.table_catalog
-    and s.table_schema = k.table_schema
-    and s.table_name = k.table_name
-    and s.index_name = k.constraint_name
-    
-    left join information_schema.table_constraints c
-    on k.table_schema = c.table_schema
-    and k.table_name = c.table_name
-    and k.constraint_name = c.constraint_name
-    
-    where 
-        s.table_schema = '%(db)s' and
-        s.table_name = '%(table)s' and
-        c.constraint_type <> 'foreign key'  -- constraint_type is never null
-) t
-group by
-	table_catalog,
-	table_schema,
-	table_name,
-	index_name,
-	constraint_type
-"""
+def _constrained_index_changes(cursor, table, db1, db2):
+    (t1, t2) = _tables(cursor, table, db1, db2)
+    indexes1 = t1.constrained_indexes()
 
-    q1 = query % { "db" : db1, "table" : table }
-    q2 = query % { "db" : db2, "table" : table }
-
-    select_columns = ['index_name', 'constraint_type', 'expr']
-    indexdefs1 = {}
-    cursor.execute(q1)
-    for row in cursor.fetchall():
-        d = dict(zip(select_columns,
-                     row))
-        indexdefs1[d['index_name']] = d
-
-    indexdefs2 = {}
-    cursor.execute(q2)
-    for row in cursor.fetchall():
-        d = dict(zip(select_columns,
-                     row))
-        indexdefs2[d['index_name']] = d
-
-    indexes_1 = set(indexdefs1.keys())
-    indexes_2 = set(indexdefs2.keys())
-
-    add = indexes_2 - indexes_1
-    drop = indexes_1 - indexes_2
-    common = indexes_1 & indexes_2
-
-    drop_clauses = []
-    add_clauses = []
-
-    for k in drop:
-        if indexdefs1[k]['constraint_type'] == 'PRIMARY KEY':
-            drop_clauses.append("DROP PRIMARY KEY")
-        else:
-            drop_clauses.append("DROP INDEX %s" % k)
+    def drop_clause(k):
+        if indexes1[k].constraint_type == 'PRIMARY KEY':
+            return "DROP PRIMARY KEY"
+        return "DROP INDEX %s" % k
 
-    for k in add:
-        add_clauses.append(indexdefs2[k]['expr'])
+    return _diff_defs(indexes1, t2.constrained_indexes(), drop_clause, 'index')
 
-    for k in common:
-        if indexdefs1[k]['expr'] != indexdefs2[k]['expr']:
-            if indexdefs1[k]['constraint_type'] == 'PRIMARY KEY':
-                drop_clauses.append("DROP PRIMARY KEY")
-            else:
-                drop_clauses.append("DROP INDEX %s" % k)
-            add_clauses.append(indexdefs2[k]['expr'])
+def diff_constrained_indexes(cursor, table, db1, db2):
+    return _clauses(*_constrained_index_changes(cursor, table, db1, db2))
+
+def _index_changes(cursor, table, db1, db2):
+    catalog = _catalog(cursor)
+    drops = []
+    adds = []
 
-    return drop_clauses, add_clauses
+    for changes in (_plain_index_changes, _constrained_index_changes,
+                    _fk_changes):
+        (drop, add) = changes(catalog, table, db1, db2)
+        drops += drop
+        adds += add
+
+    return drops, adds
 
 def diff_table_indexes(cursor, table, db1, db2):
-    drop_clauses = []
-    add_clauses = []
+    return _clauses(*_index_changes(cursor, table, db1, db2))
 
-    (drop, add) = diff_plain_indexes(cursor, table, db1, db2)
-    drop_clauses += drop
-    add_clauses += add
+def _column_changes(cursor, table, db1, db2):
+    (t1, t2) = _tables(cursor, table, db1, db2)
+    columns1 = dict((c.name, c) for c in t1.columns)
+    names2 = set(c.name for c in t2.columns)
 
-    (drop, add) = diff_constrained_indexes(cursor, table, db1, db2)
-    drop_clauses += drop
-    add_clauses += add
+    drops = []
+    adds = []
+    modifies = []
 
-    (drop, add) = diff_fks(cursor, table, db1, db2)
-    drop_clauses += drop
-    add_clauses += add
+    for c in t1.columns:
+        if c.name not in names2:
+            drops.append(Change("DROP COLUMN %s" % c.name, 'drop_column', c.name,
+                                c, None))
 
-    return drop_clauses, add_clauses
+    for c in t2.columns:
+        if c.name not in columns1:
+            adds.append(Change("ADD COLUMN %s" % c.definition(), 'add_column',
+                               c.name, None, c))
+        elif columns1[c.name] != c:
+            modifies.append(Change("MODIFY COLUMN %s" % c.definition(),
+                                   'modify_column', c.name, columns1[c.name], c))
 
-def diff_table_columns(cursor, table, db1, db2):
-    query = "select column_name from information_schema.columns where table_schema = '%s' and table_name = '%s'"
-    q1 = query % (db1, table)
-    q2 = query % (db2, table)
-
-    columns1 = set()
-    cursor.execute(q1)
-    for row in cursor.fetchall():
-        d = dict(zip(['column_name'],
-                     row))
-        columns1.add(d['column_name'])
-
-    columns2 = set()
-    cursor.execute(q2)
-    for row in cursor.fetchall():
-        d = dict(zip(['column_name'],
-                     row))
-        columns2.add(d['column_name'])
-
-    common = columns1 & columns2
-    columns_to_drop = columns1 - columns2
-    columns_to_add = columns2 - columns1
-
-    query = """
-select
-column_name,
-concat(
-    column_name,
-    ' ',
-    column_type,
-    if(is_nullable = 'NO', ' NOT NULL', ''),
-    case
-    when column_default is null then ''
-    when column_type like '%%char%%' then concat(' DEFAULT ''', column_default, '''')
-    when column_type like '%%text' then concat(' DEFAULT ''', column_default, '''')
-    when column_type = 'timestamp' and column_default <> 'current_timestamp' then concat(' DEFAULT ''', column_default, '''')
-    when column_type = 'datetime' and column_default <> 'current_timestamp' then concat(' DEFAULT ''', column_default, '''')
-    when column_type = 'date' and column_default <> 'current_timestamp' then concat(' DEFAULT ''', column_default, '''')
-    when column_type = 'time' and column_default <> 'current_timestamp' then concat(' DEFAULT ''', column_default, '''')
-    else concat(' DEFAULT ', column_default)
-    end,
-    if(extra = '', '', concat(' ', extra)),
-    if(column_comment = '', '', concat(' COMMENT ''',
-                                       replace(column_comment, '''', ''''''),
-                                       ''''))
-) column_def
- from information_schema.columns
- where table_schema = '%(db)s'
- and table_name = '%(table)s'
- and column_name in (%(columns)s)
-"""
+    return drops, adds, modifies
 
-    drop_clauses = []
-    add_clauses = []
-    modify_clauses = []
-
-    for d in columns_to_drop:
-        drop_clauses.append("DROP COLUMN %s" % d)
-
-    if len(columns_to_add) > 0:
-        column_list = "'" + "','".join(columns_to_add) + "'"
-        q = query % {
-            "db" : db2,
-            "table" : table,
-            "columns" : column_list }
-        cursor.execute(q)
-        for row in cursor.fetchall():
-            d = dict(zip(['column_name', 'column_def'],
-                         row))
-            add_clauses.append("ADD COLUMN %s" % d['column_def'])
-            
-    if len(common) > 0:
-        column_list = "'" + "','".join(common) + "'"
-        q1 = query % {
-            "db" : db1,
-            "table" : table,
-            "columns" : column_list }
-        cursor.execute(q1)
-        d1 = {}
-        for row in cursor.fetchall():
-            d1[row[0]] = row[1]
-
-        q2 = query % {
-            "db" : db2,
-            "table" : table,
-            "columns" : column_list }
-        cursor.execute(q2)
-        d2 = {}
-        for row in cursor.fetchall():
-            d2[row[0]] = row[1]
-
-        for c in common:
-            if d1[c] != d2[c]:
-                modify_clauses.append("MODIFY COLUMN %s" % d2[c])
-
-    return drop_clauses, add_clauses, modify_clauses
+def diff_table_columns(cursor, table, db1, db2):
+    return _clauses(*_column_changes(cursor, table, db1, db2))
 
-def diff_table_engines(cursor, table, db1, db2):
-    query = """
-select engine
- from information_schema.tables
- where table_schema = '%(db)s'
- and table_name = '%(table)s'
-"""
+def _engine_changes(cursor, table, db1, db2):
+    (t1, t2) = _tables(cursor, table, db1, db2)
+    changes = []
 
-    q1 = query % { "db" : db1, "table" : table }
-    q2 = query % { "db" : db2, "table" : table }
+    if t1.engine != t2.engine:
+        changes.append(Change("ENGINE = %s" % t2.engine, 'engine', table,
+                              t1.engine, t2.engine))
 
-    select_columns = ['engine']
-    clauses = []
+    return changes
 
-    cursor.execute(q1)
-    engine1 = None
-    for row in cursor.fetchall():
-        engine1 = row[0]
+def diff_table_engines(cursor, table, db1, db2):
+    return _clauses(_engine_changes(cursor, table, db1, db2))[0]
 
-    engine2 = None
-    cursor.execute(q2)
-    for row in cursor.fetchall():
-        engine2 = row[0]
+def _table_statements(cursor, table, db1, db2, prettyprint=False):
+    """
+    list of (statement, Changes in it) for the ALTER TABLEs that turn
+    table in db1 into table in db2.
+    """
+    catalog = _catalog(cursor)
+    (column_drop, column_add, column_modify) = _column_changes(catalog, table, db1, db2)
+    (index_drop, index_add) = _index_changes(catalog, table, db1, db2)
+    engines = _engine_changes(catalog, table, db1, db2)
 
-    if engine1 != engine2:
-        clauses.append("ENGINE = %s" % engine2)
+    statements = []
+    for changes in (column_drop + index_drop,
+                    column_add + index_add + column_modify + engines):
+        for dml in _format_dmls(table, db1, db2, [c.clause for c in changes],
+                                prettyprint):
+            statements.append((dml, changes))
 
-    return clauses
+    return statements
 
 def diff_table(cursor, table, db1, db2, prettyprint=False):
 #    logging.debug("diffing table %s" % table)
-    (column_drop, column_add, column_modify) = diff_table_columns(cursor, table, db1, db2)
-    (index_drop, index_add) = diff_table_indexes(cursor, table, db1, db2)
-    (engines) = diff_table_engines(cursor, table, db1, db2)
+    return [dml for (dml, changes)
+            in _table_statements(cursor, table, db1, db2, prettyprint)]
 
-    dmls = []
-    dmls += _format_dmls(table, db1, db2, (column_drop + index_drop), prettyprint)
-    dmls += _format_dmls(table, db1, db2, (column_add +
-                                           index_add + column_modify + engines),
-                         prettyprint)
+def unchanged_tables(digests1, digests2):
+    """
+    set of tables whose digests (from schemamanifest()) match.
+    """
+    if not digests1 or not digests2:
+        return set()
 
-    return dmls
+    return set(t for t in digests1
+               if t in digests2 and digests1[t] == digests2[t])
 
-def diff_databases(cursor, db1, db2):
-    tquery = "select table_name from information_schema.tables where table_schema = '%s'"
-    q1 = tquery % db1
-    q2 = tquery % db2
+def _iter_steps(cursor, db1, db2, digests1, digests2, workers, catalog, use,
+                table_cache=None):
+    """
+    (table, statement, operations) for each statement
+    iter_diff_databases() yields, where operations are _operation()s of
+    the Changes in it.  table is None for the USE.
+    """
+    # catalogs don't all describe a table quite the same way (index
+    # names ddlparse makes up, views), so cached table diffs are kept
+    # apart by where they came from, as in the plan cache
+    pool = None
+    if isinstance(cursor, schemamodel.Catalog):
+        catalog = cursor
+        cache_options = { 'offline' : True, 'catalog' : type(catalog).__name__ }
+    else:
+        if workers > 1:
+            pool = ConnectionPool(workers)
+        catalog = catalog or 'information_schema'
+        cache_options = { 'offline' : False, 'catalog' : catalog }
+        catalog = CATALOGS[catalog](cursor, pool)
 
-    db1tables = set()
-    db2tables = set()
+    try:
+        if pool is not None:
+            catalog.prefetch([db1, db2])
+        for step in _iter_diff_databases(catalog, db1, db2, digests1, digests2,
+                                         use or db1, table_cache, cache_options):
+            yield step
+    finally:
+        if pool is not None:
+            pool.close()
+
+def iter_diff_databases(cursor, db1, db2, digests1=None, digests2=None,
+                        workers=None, catalog=None, use=None, table_cache=None):
+    """
+    the statements that turn db1 into db2, yielded as each table is
+    diffed, so callers can write or run them without waiting for the
+    rest.  the first one is USE use, or db1.
+
+    cursor:  a cursor on the server holding db1 and db2, or a
+    schemamodel.Catalog that knows about them.  with a cursor, each
+    database's catalog is read in one go (see snapshot_schemas()) rather
+    than table by table.
+    digests1, digests2:  per-table digests of the schemas db1 and db2
+    were loaded from (see schemamanifest()).  common tables whose
+    digests match are not diffed at all.
+    workers:  if more than 1, read the catalogs over this many extra
+    connections, all queries at once.
+    catalog:  with a cursor, how to read the server:  a key of CATALOGS.
+    the default is information_schema.
+    table_cache:  optional schemacache.TableDiffCache.  with digests,
+    common tables diffed in an earlier run, for any pair of schemas, are
+    taken from it instead of being diffed again.
+    """
+    for (table, dml, operations) in _iter_steps(cursor, db1, db2, digests1,
+                                                digests2, workers, catalog, use,
+                                                table_cache):
+        yield dml
 
+def diff_databases(cursor, db1, db2, digests1=None, digests2=None,
+                   workers=None, catalog=None):
+    """
+    list of the statements iter_diff_databases() yields.
+    """
+    return list(iter_diff_databases(cursor, db1, db2, digests1, digests2,
+                                    workers, catalog))
+
+def _table_steps(catalog, table, db1, db2, digests1, digests2, table_cache,
+                 cache_options=None):
+    """
+    (statement, operations) for the ALTER TABLEs on a common table, from
+    table_cache if it's there.  cache_options go into the cache key.
+    """
+    def diff():
+        return [(dml, [_operation(c) for c in changes])
+                for (dml, changes) in _table_statements(catalog, table, db1, db2, True)]
+
+    if (table_cache is None or not digests1 or not digests2 or
+        table not in digests1 or table not in digests2):
+        return diff()
+
+    key = table_cache.key(table, digests1[table], digests2[table], True,
+                          **(cache_options or {}))
+    steps = table_cache.get(key)
+    if steps is None:
+        steps = diff()
+        table_cache.put(key, steps)
+    return steps
+
+def _iter_diff_databases(catalog, db1, db2, digests1, digests2, use,
+                         table_cache=None, cache_options=None):
     logging.debug("getting tables for %s" % db1)
-    cursor.execute(q1)
-    for row in cursor.fetchall():
-        d = dict(zip(['table_name'],
-                     row))
-        db1tables.add(d['table_name'])
+    db1tables = catalog.tables(db1)
 
     logging.debug("getting tables for %s" % db2)
-    cursor.execute(q2)
-    for row in cursor.fetchall():
-        d = dict(zip(['table_name'],
-                     row))
-        db2tables.add(d['table_name'])
+    db2tables = catalog.tables(db2)
+
+    # only now, with both catalogs read, is it safe for a validating
+    # caller to start changing db1
+    yield (None, "USE %s;" % use, [])
 
     common = db1tables & db2tables
     tables_to_drop = db1tables - db2tables
     tables_to_add = db2tables - db1tables
 
-    dmls = []
-    for dropme in tables_to_drop:
-        dmls.append("DROP TABLE %(table)s;" % {
+    unchanged = common & unchanged_tables(digests1, digests2)
+    if len(unchanged) > 0:
+        logging.debug("skipping %d of %d common tables with identical digests" % (
+                len(unchanged), len(common)))
+        common -= unchanged
+
+    for dropme in sorted(tables_to_drop):
+        yield (dropme, "DROP TABLE %(table)s;" % {
                 "db" : db1,
-                "table" : dropme })
-
-    for addme in tables_to_add:
-        replacevalues = {
-            "db1" : db1,
-            "db2" : db2,
-            "table" : addme }
-        cursor.execute("show create table %(db2)s.%(table)s;" % replacevalues)
-        for row in cursor.fetchall():
-            ctable = row[1]
-            dmls.append(ctable + ';')
-
-    common_list = list(common)
-    for c in common_list:
-        dmls += diff_table(cursor, c, db1, db2, True)
-
-    dmls.insert(0, "USE %s;" % db1)
-    return dmls
+                "table" : dropme },
+               [_operation(Change(None, 'drop_table', dropme,
+                                  catalog.table(db1, dropme), None))])
+
+    for addme in sorted(tables_to_add):
+        yield (addme, catalog.create_table(db2, addme) + ';',
+               [_operation(Change(None, 'create_table', addme, None,
+                                  catalog.table(db2, addme)))])
+
+    for c in sorted(common):
+        for (dml, operations) in _table_steps(catalog, c, db1, db2,
+                                              digests1, digests2, table_cache,
+                                              cache_options):
+            yield (c, dml, operations)
+
+# bump whenever the diff changes what it says about a pair of schemas,
+# so cached plans (see schemacache.PlanCache) aren't reused
+PLAN_VERSION = 2
+
+# how much work a statement is for the server, cheapest first.
+#   metadata:  only the data dictionary changes
+#   inplace:   something (an index) is built without copying the table
+#   rebuild:   the table is copied
+PLAN_COSTS = ['none', 'metadata', 'inplace', 'rebuild']
+
+_change_costs = {
+    'create_table' : 'metadata',
+    'drop_table' : 'metadata',
+    'drop_column' : 'rebuild',
+    'add_column' : 'rebuild',
+    'modify_column' : 'rebuild',
+    'drop_index' : 'metadata',
+    'add_index' : 'inplace',
+    'drop_fk' : 'metadata',
+    # only ALGORITHM=COPY with foreign_key_checks on, which is how plans
+    # get run
+    'add_fk' : 'rebuild',
+    'engine' : 'rebuild',
+    }
+
+def _change_cost(change):
+    if change.kind in ('drop_index', 'add_index') and change.name == 'PRIMARY':
+        return 'rebuild'
+    if change.kind == 'modify_column':
+        (s, t) = (change.source, change.target)
+        if (s.column_type, s.nullable, s.extra) == (t.column_type, t.nullable, t.extra):
+            # just the default or comment
+            return 'metadata'
+    return _change_costs[change.kind]
+
+def _definition(d):
+    if d is None or isinstance(d, str):
+        return d
+    if isinstance(d, schemamodel.Table):
+        return d.create_statement()
+    return d.create_definition()
+
+def _operation(change):
+    """
+    what a plan says about one Change:  a dict that goes to json.
+    """
+    return {
+        'kind' : change.kind,
+        'name' : change.name,
+        'source' : _definition(change.source),
+        'target' : _definition(change.target),
+        'cost' : _change_cost(change),
+        }
+
+def plan_record(seq, table, dml, operations):
+    """
+    what a plan says about one statement, made of operations.
+    """
+    cost = 'none'
+    for op in operations:
+        cost = max(cost, op['cost'], key=PLAN_COSTS.index)
+
+    return {
+        'seq' : seq,
+        'table' : table,
+        'sql' : dml,
+        'kinds' : sorted(set(op['kind'] for op in operations)),
+        'operations' : operations,
+        'cost' : cost,
+        'rebuild' : cost == 'rebuild',
+        }
+
+def iter_plan(cursor, db1, db2, digests1=None, digests2=None,
+              workers=None, catalog=None, use=None, table_cache=None):
+    """
+    a plan_record() for each statement iter_diff_databases() would
+    yield, in the same order.  arguments are the same.
+    """
+    steps = _iter_steps(cursor, db1, db2, digests1, digests2, workers,
+                        catalog, use, table_cache)
+    for (seq, (table, dml, operations)) in enumerate(steps):
+        yield plan_record(seq, table, dml, operations)
+
+def write_plan_record(f, record):
+    """
+    one line of an ndjson plan file.
+    """
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+    f.flush()
+
+def json_bytes(o):
+    """
+    o from json.load(), with utf-8 strs where json gave unicode, which is
+    what the rest of schemadiff works in.
+    """
+    if isinstance(o, unicode):
+        return o.encode('utf-8')
+    if isinstance(o, list):
+        return [json_bytes(x) for x in o]
+    if isinstance(o, dict):
+        return dict((json_bytes(k), json_bytes(v)) for (k, v) in o.iteritems())
+    return o
+
+def read_plan_record(line):
+    return json_bytes(json.loads(line))
+
+_references_re = re.compile(
+    r'\bREFERENCES\s+(?:(?:`[^`]+`|\w+)\.)?(?:`([^`]+)`|(\w+))', re.IGNORECASE)
+
+def fk_references(schema):
+    """
+    map each table in schema to the set of tables it references by
+    FOREIGN KEY.
+    """
+    references = {}
+    for ddl in iter_statements(schema):
+        table = statement_table(ddl)
+        if table is None:
+            continue
+        references[table] = set(m.group(1) or m.group(2)
+                                for m in _references_re.finditer(ddl))
+    return references
+
+def _statement_links(schema):
+    """
+    map each table to the other tables named in the same statement, for
+    statements that name more than one.
+    """
+    links = {}
+    for ddl in iter_statements(schema):
+        names = statement_tables(ddl)
+        if len(names) > 1:
+            for table in names:
+                links[table] = links.get(table, set()) | (set(names) - set([table]))
+    return links
+
+def tables_to_load(schema1, schema2, digests1, digests2):
+    """
+    the tables we have to create in order to diff schema1 and schema2:
+    every table whose digest differs, including added and dropped
+    tables, plus everything those reference by FOREIGN KEY, all the
+    way down.
+    """
+    tables = (set(digests1) | set(digests2)) - unchanged_tables(digests1, digests2)
+
+    # a RENAME or DROP naming several tables needs all of them there
+    references = fk_references(schema1)
+    for links in (fk_references(schema2), _statement_links(schema1),
+                  _statement_links(schema2)):
+        for (table, refs) in links.iteritems():
+            references[table] = references.get(table, set()) | refs
+
+    pending = list(tables)
+    while len(pending) > 0:
+        for ref in references.get(pending.pop(), ()):
+            if ref not in tables:
+                tables.add(ref)
+                pending.append(ref)
+
+    return tables
+
+# values of enum_mysql_set_option, for set_server_option()
+MYSQL_OPTION_MULTI_STATEMENTS_ON = 0
+MYSQL_OPTION_MULTI_STATEMENTS_OFF = 1
+
+class StatementError(Exception):
+    """
+    a statement in a schema failed to execute.  statement is the
+    offending statement; error is the exception from MySQLdb.
+    """
+    def __init__(self, statement, error):
+        Exception.__init__(self, "%s\nin statement:\n%s" % (error, statement))
+        self.statement = statement
+        self.error = error
+
+def _schema_statements(schema, tables=None):
+    """
+    generate the statements in a schema that create_db_from_schema()
+    should run.  see there for tables.
+    """
+    for ddl in iter_statements(schema):
+        if tables is not None:
+            names = statement_tables(ddl)
+            if names and not all(t in tables for t in names):
+                continue
+        yield ddl
+
+def _execute_one(cursor, ddl, timings):
+    start = time.time()
+    try:
+        cursor.execute(ddl)
+    except MySQLdb.Error as e:
+        raise StatementError(ddl, e)
+    if timings is not None:
+        timings.append((ddl, time.time() - start))
+
+def _execute_batch(cursor, batch, timings):
+    """
+    send a batch of statements in one round trip.  the server runs them
+    in order and stops at the first failure, so the number of results
+    we get back before an error tells us which statement failed.
+    per-statement timings are the gaps between results arriving.
+    """
+    if len(batch) == 1:
+        _execute_one(cursor, batch[0], timings)
+        return
+
+    done = 0
+    start = time.time()
+    try:
+        cursor.execute(';\n'.join(batch))
+        while True:
+            now = time.time()
+            if timings is not None:
+                timings.append((batch[done], now - start))
+            start = now
+            done += 1
+            if not cursor.nextset():
+                break
+    except MySQLdb.Error as e:
+        raise StatementError(batch[done], e)
+
+def execute_statements(cursor, ddls, batch_size=None, timings=None):
+    """
+    run statements, batch_size of them per round trip to the server.
+    batch_size of None or 1 runs them one at a time.
 
-def create_db_from_schema(cursor, dbname, schema):
+    timings:  if a list, (statement, seconds) is appended to it for
+    each statement run.
+    """
+    if not batch_size or batch_size <= 1:
+        for ddl in ddls:
+            _execute_one(cursor, ddl, timings)
+        return
+
+    conn = cursor.connection
+    conn.set_server_option(MYSQL_OPTION_MULTI_STATEMENTS_ON)
+    try:
+        batch = []
+        for ddl in ddls:
+            batch.append(ddl)
+            if len(batch) >= batch_size:
+                _execute_batch(cursor, batch, timings)
+                batch = []
+        if len(batch) > 0:
+            _execute_batch(cursor, batch, timings)
+    finally:
+        conn.set_server_option(MYSQL_OPTION_MULTI_STATEMENTS_OFF)
+
+def create_db_from_schema(cursor, dbname, schema, tables=None,
+                          batch_size=None, timings=None):
+    """
+    schema is a string or an open file; see iter_statements().
+
+    tables:  if given, only statements creating or changing these
+    tables (see statement_tables()) are run, along with every statement
+    that doesn't name a table.
+    batch_size, timings:  see execute_statements().
+
+    raises StatementError if a statement fails.
+    """
     cursor.execute("drop database if exists %(db)s" % { "db" : dbname })
     cursor.execute("create database %(db)s" % { "db" : dbname })
     cursor.execute("use %(db)s" % { "db" : dbname })
-    
-    ddls = schema.split(';')
-    for ddl in ddls:
-        ddl = ddl.strip()
-        if len(ddl) == 0:
+
+    execute_statements(cursor, _schema_statements(schema, tables),
+                       batch_size, timings)
+
+class ConnectionPool(object):
+    """
+    a fixed number of connections for worker threads to share.  each
+    connection is used by one thread at a time.
+    """
+    def __init__(self, size, connect=None):
+        if connect is None:
+            connect = get_connection
+
+        self.size = size
+        self.connections = Queue.Queue()
+        for i in range(size):
+            self.connections.put(connect())
+
+    def get(self):
+        return self.connections.get()
+
+    def put(self, conn):
+        self.connections.put(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+# mysqldump saves and restores character_set_client around each CREATE
+# TABLE.  the restore belongs with the table before it.
+_saved_cs_client_re = re.compile(r'@saved_cs_client\b', re.IGNORECASE)
+_restore_cs_client_re = re.compile(r'=\s*@saved_cs_client\b', re.IGNORECASE)
+# a SET, possibly in a version comment, after any -- comment lines
+_set_re = re.compile(r'^(?:\s*(?:--|#)[^\n]*\n)*\s*(?:/\*!\d*\s*)?set\b',
+                     re.IGNORECASE)
+
+def _load_units(schema, tables=None):
+    """
+    split the statements of a schema into (preamble, units, trailer),
+    so a unit can run on any connection that has run the preamble.
+
+    preamble:  the session SETs at the top of a dump (SET NAMES,
+    SQL_MODE, FOREIGN_KEY_CHECKS...).
+    units:  one per CREATE TABLE, with whatever statements came between
+    it and the previous one, and the restore of @saved_cs_client after
+    it.
+    trailer:  statements that change tables already created (ALTER
+    TABLE, CREATE INDEX...), in order, then whatever comes after
+    the last CREATE TABLE, which may restore variables the preamble
+    saved.
+
+    tables:  if given, units and changes for other tables are left out.
+    """
+    preamble = []
+    units = []
+    pending = []
+    changes = []
+    created = set()
+    for ddl in iter_statements(schema):
+        if (len(units) == 0 and len(pending) == 0 and _set_re.match(ddl) and
+            not _saved_cs_client_re.search(ddl)):
+            preamble.append(ddl)
+        elif (len(units) > 0 and len(pending) == 0 and
+              _restore_cs_client_re.search(ddl)):
+            units[-1].append(ddl)
+        elif (statement_table(ddl) is None and
+              created.intersection(statement_tables(ddl))):
+            # has to wait for the tables, which may be in any unit.  a
+            # DROP TABLE IF EXISTS before the CREATE stays with it.
+            changes.append(ddl)
+        else:
+            pending.append(ddl)
+            if statement_table(ddl) is not None:
+                created.add(statement_table(ddl))
+                units.append(pending)
+                pending = []
+
+    if tables is not None:
+        units = [unit for unit in units if _unit_table(unit) in tables]
+        changes = [ddl for ddl in changes
+                   if all(t in tables for t in statement_tables(ddl))]
+    return preamble, units, changes + pending
+
+def _unit_table(unit):
+    for ddl in unit:
+        table = statement_table(ddl)
+        if table is not None:
+            return table
+    return None
+
+def _next_unit(work, first):
+    """
+    next (dbname, unit) to load, preferring work[first].  None when
+    everything is taken.
+    """
+    for i in range(len(work)):
+        try:
+            return work[(first + i) % len(work)].get_nowait()
+        except Queue.Empty:
+            pass
+    return None
+
+def _load_worker(pool, work, first, errors, batch_size, preambles):
+    conn = pool.get()
+    cursor = conn.cursor()
+    current = None
+    try:
+        cursor.execute("SET FOREIGN_KEY_CHECKS=0")
+        while len(errors) == 0:
+            item = _next_unit(work, first)
+            if item is None:
+                break
+
+            (dbname, unit) = item
+            if dbname != current:
+                cursor.execute("use %(db)s" % { "db" : dbname })
+                execute_statements(cursor, preambles[dbname], batch_size)
+                cursor.execute("SET FOREIGN_KEY_CHECKS=0")
+                current = dbname
+            execute_statements(cursor, unit, batch_size)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            cursor.execute("SET FOREIGN_KEY_CHECKS=1")
+        except MySQLdb.Error:
+            pass
+        cursor.close()
+        pool.put(conn)
+
+def create_dbs_parallel(pool, loads, tables=None, batch_size=None):
+    """
+    create several databases at once, spreading their tables across the
+    connections in pool.  loads is a list of (dbname, schema).  every
+    worker session runs a schema's preamble (see _load_units()) before
+    its tables.  foreign key checks are off in the worker sessions, so
+    the order tables get created in doesn't matter.
+
+    tables, batch_size:  see create_db_from_schema().  a batch never
+    spans tables, so batch_size only helps when the schema has extra
+    statements around each CREATE TABLE.
+    """
+    trailers = []
+    preambles = {}
+
+    conn = pool.get()
+    try:
+        cursor = conn.cursor()
+        for (dbname, schema) in loads:
+            cursor.execute("drop database if exists %(db)s" % { "db" : dbname })
+            cursor.execute("create database %(db)s" % { "db" : dbname })
+        cursor.close()
+    finally:
+        pool.put(conn)
+
+    # one queue per database.  workers are spread across the queues so
+    # the databases load side by side, and only switch databases when
+    # their own queue runs dry.
+    work = []
+    for (dbname, schema) in loads:
+        (preambles[dbname], units, trailer) = _load_units(schema, tables)
+        q = Queue.Queue()
+        for unit in units:
+            q.put((dbname, unit))
+        work.append(q)
+        trailers.append((dbname, trailer))
+
+    errors = []
+    threads = [threading.Thread(target=_load_worker,
+                                args=(pool, work, i, errors, batch_size,
+                                      preambles))
+               for i in range(pool.size)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    conn = pool.get()
+    try:
+        cursor = conn.cursor()
+        for (dbname, trailer) in trailers:
+            if len(trailer) > 0:
+                # the trailer restores what the preamble saved
+                cursor.execute("use %(db)s" % { "db" : dbname })
+                execute_statements(cursor, preambles[dbname] + trailer,
+                                   batch_size)
+        cursor.close()
+    finally:
+        pool.put(conn)
+
+def _load_schemas(cursor, schema1, schema2, db1, db2, digests1, digests2,
+                  **kwargs):
+    tables = None
+    if kwargs.get('partial'):
+        tables = tables_to_load(schema1, schema2, digests1, digests2)
+        logging.debug("loading %d of %d tables" % (
+                len(tables), len(set(digests1) | set(digests2))))
+
+    batch_size = kwargs.get('batch_size')
+    workers = kwargs.get('workers')
+    if workers > 1:
+        logging.debug("creating databases %s and %s with %d workers" % (
+                db1, db2, workers))
+        pool = ConnectionPool(workers)
+        try:
+            create_dbs_parallel(pool, [(db1, schema1), (db2, schema2)],
+                                tables, batch_size)
+        finally:
+            pool.close()
+    else:
+        logging.debug("creating database %s" % db1)
+        create_db_from_schema(cursor, db1, schema1, tables, batch_size)
+        logging.debug("creating database %s" % db2)
+        create_db_from_schema(cursor, db2, schema2, tables, batch_size)
+
+def _plan_references(record):
+    """
+    set of tables a plan record's foreign keys point at, before or after.
+    """
+    texts = [record['sql']]
+    for op in record['operations']:
+        texts += [op['source'], op['target']]
+    return set(m.group(1) or m.group(2) for text in texts if text
+               for m in _references_re.finditer(text))
+
+def plan_waves(plan):
+    """
+    split the statements of plan (plan_record()s) into waves that can
+    be applied one after another, with the tables in each wave side by
+    side.  each wave is a list of (table, records), records in plan
+    order.
+
+    tables linked by a foreign key, either way round, keep the order
+    the plan has them in, so they can't step on each other; a table
+    goes in the wave after the last earlier table it's linked to.
+    """
+    tables = collections.OrderedDict()
+    references = {}
+    for record in plan:
+        table = record['table']
+        if table is None:
             continue
-        cursor.execute(ddl)
+        tables.setdefault(table, []).append(record)
+        references.setdefault(table, set()).update(_plan_references(record))
+
+    waves = {}
+    for table in tables:
+        wave = 0
+        for earlier in waves:
+            if earlier in references[table] or table in references[earlier]:
+                wave = max(wave, waves[earlier] + 1)
+        waves[table] = wave
+
+    result = [[] for i in range(len(set(waves.values())))]
+    for (table, records) in tables.iteritems():
+        result[waves[table]].append((table, records))
+    return result
+
+def _apply_worker(pool, db, work, errors):
+    conn = pool.get()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("use %(db)s" % { "db" : db })
+        while len(errors) == 0:
+            try:
+                (table, records) = work.get_nowait()
+            except Queue.Empty:
+                break
+            for record in records:
+                logging.debug("EXECUTING: %s" % record['sql'])
+                cursor.execute(record['sql'])
+    except Exception as e:
+        errors.append(e)
+    finally:
+        cursor.close()
+        pool.put(conn)
+
+def apply_plan_parallel(pool, db, plan):
+    """
+    run the statements of plan against db over the connections in
+    pool, a wave at a time (see plan_waves()).  each table's statements
+    run in order on one connection, so a wave takes about as long as its
+    slowest table.
+    """
+    for (n, wave) in enumerate(plan_waves(plan)):
+        logging.debug("applying wave %d:  %d tables" % (n, len(wave)))
+        work = Queue.Queue()
+        for item in wave:
+            work.put(item)
+
+        errors = []
+        threads = [threading.Thread(target=_apply_worker,
+                                    args=(pool, db, work, errors))
+                   for i in range(min(pool.size, len(wave)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+def compare_databases(cursor, db1, db2, workers=None, catalog=None):
+    """
+    sorted list of tables that aren't the same in db1 and db2:  missing
+    from one of them, defined differently as far as the diff can tell
+    (see schemamodel), or with SHOW CREATE TABLE statements that don't
+    normalize() the same.  workers and catalog are as for
+    diff_databases().
+    """
+    pool = None
+    if workers > 1:
+        pool = ConnectionPool(workers)
+    try:
+        c = CATALOGS[catalog or 'information_schema'](cursor, pool)
+        c.prefetch([db1, db2])
+        tables = c.tables(db1) | c.tables(db2)
+        different = set(t for t in tables if c.table(db1, t) != c.table(db2, t))
+
+        # the models leave out what the diff doesn't handle yet (index
+        # kinds, fk actions, charsets, table options), which the dumps
+        # dbchecksum() compares would still show
+        same = sorted(tables - different)
+        ddls1 = show_create_tables(cursor, db1, same, pool)
+        ddls2 = show_create_tables(cursor, db2, same, pool)
+        different.update(t for t in same
+                         if normalize(ddls1[t]) != normalize(ddls2[t]))
+        return sorted(different)
+    finally:
+        if pool is not None:
+            pool.close()
+
+def _cached_plan(plan, plan_cache, key):
+    """
+    pass plan through, and store it in plan_cache once it's all there.
+    """
+    records = []
+    for record in plan:
+        records.append(record)
+        yield record
+    plan_cache.put(key, records)
 
 def diff_schemas(cursor, schema1, schema2, db1, db2, **kwargs):
     """
     kwargs:
-    validate:  True or False
+    validate:  True to apply the changes to db1 and check that it came
+    out the same as db2; see compare_databases().  returns the tables
+    that still differ.
+    disgorge:  with validate, write the dumps of both databases (see
+    disgorge()) even when they came out the same.
     dmlfile:  name of file to which DML statements should be written.
+    planfile:  name of file to write the plan to, as ndjson:  one
+    plan_record() per statement.
+    cache:  optional schemacache.SchemaCache for checksums.
+    partial:  True to load only the tables that differ, plus the tables
+    they reference.  see tables_to_load().
+    batch_size:  number of statements to send per round trip when
+    loading the schemas.
+    workers:  if more than 1, load both schemas at once over this many
+    extra connections, and read their catalogs the same way.  see
+    create_dbs_parallel() and diff_databases().  with validate, the
+    changes are applied the same way; see apply_plan_parallel().
+    offline:  diff the schemas as parsed by ddlparse instead of loading
+    them into a server.  cursor can be None.  can't be combined with
+    validate.
+    catalog:  how to read the loaded databases; see diff_databases().
+    plan_cache:  optional schemacache.PlanCache.  a pair of schemas
+    that has been diffed before isn't loaded or diffed again, unless
+    validating.
+    table_cache:  optional schemacache.TableDiffCache; see
+    iter_diff_databases().  its hits and misses are printed at the end.
+    templates:  optional templatedb.TemplateCache.  the schemas are
+    loaded into template databases named by checksum, or not loaded at
+    all if the templates are already there.  partial is ignored.  with
+    validate, db1 is cloned from its template and the changes are
+    applied to the clone.
     """
 
+    offline = kwargs.get('offline')
+    if offline and kwargs.get('validate'):
+        raise ValueError("can't validate an offline diff")
+
     filterwarnings('ignore', category = MySQLdb.Warning)
-    cs1 = schemachecksum(schema1)
-    cs2 = schemachecksum(schema2)
+    cache = kwargs.get('cache')
+    if cache:
+        (cs1, digests1) = cache.manifest(schema1)
+        (cs2, digests2) = cache.manifest(schema2)
+    else:
+        multisets = None
+        if CHECK_MULTISET:
+            multisets = (MultisetChecksum(), MultisetChecksum())
+        (cs1, digests1) = schemamanifest(schema1, multiset=multisets and multisets[0])
+        (cs2, digests2) = schemamanifest(schema2, multiset=multisets and multisets[1])
+        if multisets and (cs1 == cs2) != (multisets[0] == multisets[1]):
+            logging.warning("schemachecksum() and MultisetChecksum disagree about "
+                            "whether the schemas differ:  %s %s, %s %s" % (
+                    cs1, cs2, multisets[0].hexdigest(), multisets[1].hexdigest()))
     logging.debug("got schema checksums")
 
     if cs1 == cs2:
         print "databases are the same, nothing to do"
         return
 
-    logging.debug("creating database %s" % db1)
-    create_db_from_schema(cursor, db1, schema1)
-    logging.debug("creating database %s" % db2)
-    create_db_from_schema(cursor, db2, schema2)
-    
-    dmls = diff_databases(cursor, db1, db2)
+    validate = kwargs['validate']
+    templates = kwargs.get('templates')
+
+    # the databases we diff, which aren't db1 and db2 when they come
+    # from templates
+    src1 = db1
+    src2 = db2
+
+    plan = None
+    plan_cache = kwargs.get('plan_cache')
+    if plan_cache:
+        plan_key = plan_cache.key(cs1, cs2, offline=bool(offline),
+                                  catalog=kwargs.get('catalog'))
+        # validating means running the plan against loaded databases,
+        # so there's nothing to save by skipping the diff
+        if not validate:
+            plan = plan_cache.get(plan_key)
+        if plan is not None:
+            logging.debug("plan cache hit %s" % plan_key)
+            plan[0]['sql'] = "USE %s;" % db1
+
+    if plan is None:
+        if offline:
+            logging.debug("parsing schemas")
+            cursor = schemamodel.ModelCatalog({
+                    db1 : ddlparse.parse_schema(schema1),
+                    db2 : ddlparse.parse_schema(schema2),
+                    })
+        elif templates:
+            (src1, src2) = templates.load([(cs1, schema1), (cs2, schema2)],
+                                          kwargs.get('batch_size'),
+                                          kwargs.get('workers'))
+            if validate:
+                logging.debug("cloning %s into %s" % (src1, db1))
+                templates.clone(src1, db1, kwargs.get('batch_size'))
+        else:
+            _load_schemas(cursor, schema1, schema2, db1, db2,
+                          digests1, digests2, **kwargs)
+
+        workers = None
+        if not offline:
+            workers = kwargs.get('workers')
+        plan = iter_plan(cursor, src1, src2, digests1, digests2, workers,
+                         kwargs.get('catalog'), use=db1,
+                         table_cache=kwargs.get('table_cache'))
+        if plan_cache:
+            plan = _cached_plan(plan, plan_cache, plan_key)
 
     dmlfile = kwargs['dmlfile']
     if dmlfile:
         logging.debug("opening dml file %s" % dmlfile)
         dmlf = open(dmlfile, 'w')
 
-    validate = kwargs['validate']
-
-    for dml in dmls:
-        if validate:
+    planfile = kwargs.get('planfile')
+    if planfile:
+        logging.debug("opening plan file %s" % planfile)
+        planf = open(planfile, 'w')
+
+    # with workers, validating waits for the whole plan and then applies
+    # it in parallel; see apply_plan_parallel()
+    parallel = validate and kwargs.get('workers') > 1
+    records = []
+
+    # statements go out as soon as they're diffed; flushing each one
+    # means a crash halfway through still leaves what we had
+    for record in plan:
+        dml = record['sql']
+        if parallel:
+            records.append(record)
+        elif validate:
             logging.debug("EXECUTING: %s" % dml)
             cursor.execute(dml)
         if dmlfile:
             dmlf.write(dml + "\n")
+            dmlf.flush()
+        if planfile:
+            write_plan_record(planf, record)
 
     if dmlfile:
         dmlf.close()
         print "wrote file %s" % dmlfile
+    if planfile:
+        planf.close()
+        print "wrote plan %s" % planfile
+
+    table_cache = kwargs.get('table_cache')
+    if table_cache:
+        table_cache.flush()
+        print "table diff cache:  %d hits, %d misses" % (
+            table_cache.hits, table_cache.misses)
 
     if validate:
-        print "aftermath:"
-        print "%s checksum:  %s" % (db1, dbchecksum(db1))
-        print "%s checksum:  %s" % (db2, dbchecksum(db2))
-        disgorge(db1)
-        disgorge(db2)
+        workers = kwargs.get('workers')
+        if parallel:
+            pool = ConnectionPool(workers)
+            try:
+                apply_plan_parallel(pool, db1, records)
+            finally:
+                pool.close()
+
+        different = compare_databases(cursor, db1, src2, workers,
+                                      kwargs.get('catalog'))
+        if different:
+            print "validation failed; tables still different:  %s" % (
+                ', '.join(different))
+        else:
+            print "validation passed"
+
+        if different or kwargs.get('disgorge'):
+            print "aftermath:"
+            print "%s checksum:  %s" % (db1, dbchecksum(db1, cache, cursor, workers))
+            print "%s checksum:  %s" % (db2, dbchecksum(src2, cache, cursor, workers))
+            disgorge(db1, cursor, workers)
+            disgorge(src2, cursor, workers)
+        return different
 
 #    cursor.execute("drop database %(db)s" % { "db" : db1 })
 #    cursor.execute("drop database %(db)s" % { "db" : db2 })
 
+def add_diff_arguments(parser):
+    """
+    add the options every diff tool takes to an argparse parser.  hand
+    what it parses to diff_kwargs().
+    """
+    parser.add_argument("--dmlfile", help="file to write dml statements")
+    parser.add_argument("--planfile",
+                        help="file to write the plan to, one json record per statement")
+    parser.add_argument("--validate", help="verify that the changes work",
+                        action="store_true")
+    parser.add_argument("--cache",
+                        help="cache schema checksums on disk (see schemacache.py)",
+                        action="store_true")
+    parser.add_argument("--plan-cache",
+                        help="cache whole plans on disk (see schemacache.py)",
+                        action="store_true")
+    parser.add_argument("--table-cache",
+                        help="cache single table diffs on disk (see schemacache.py)",
+                        action="store_true")
+    parser.add_argument("--partial",
+                        help="load only changed tables and the tables they reference",
+                        action="store_true")
+    parser.add_argument("--batch-size", type=int,
+                        help="statements per round trip when loading schemas")
+    parser.add_argument("--workers", type=int,
+                        help="connections to use when loading schemas")
+    parser.add_argument("--catalog", choices=sorted(CATALOGS.keys()),
+                        help="how to read table definitions from the server")
+    parser.add_argument("--shell-normalize",
+                        help="normalize schemas with the old shell pipeline",
+                        action="store_true")
+    parser.add_argument("--disgorge",
+                        help="with --validate, dump both databases even if they came out the same",
+                        action="store_true")
+    parser.add_argument("--mysqldump",
+                        help="dump schemas for --validate with mysqldump instead of in-process",
+                        action="store_true")
+    parser.add_argument("--offline",
+                        help="parse the schemas instead of loading them into mysql",
+                        action="store_true")
+    parser.add_argument("--templates",
+                        help="keep loaded schemas on the server for reuse (see templatedb.py)",
+                        action="store_true")
+    parser.add_argument("--sandbox",
+                        help="do scratch work in a throwaway local mysqld (see sandbox.py)",
+                        action="store_true")
+
+def diff_kwargs(args, cursor=None):
+    """
+    the diff_schemas() kwargs for options from add_diff_arguments().
+    cursor is where --templates keeps them; without one there are none.
+
+    --shell-normalize and --mysqldump are module settings, not
+    diff_schemas() arguments, so they're set here.  --sandbox is up to
+    the caller, since it decides what cursor is.
+    """
+    # both import this module
+    import schemacache
+    import templatedb
+
+    global SHELL_NORMALIZE, MYSQLDUMP
+    if args.shell_normalize:
+        SHELL_NORMALIZE = True
+    if args.mysqldump:
+        MYSQLDUMP = True
+
+    kwargs = {
+        'dmlfile' : args.dmlfile,
+        'planfile' : args.planfile,
+        'validate' : args.validate,
+        'partial' : args.partial,
+        'batch_size' : args.batch_size,
+        'workers' : args.workers,
+        'catalog' : args.catalog,
+        'offline' : args.offline,
+        'disgorge' : args.disgorge,
+        'cache' : None,
+        'plan_cache' : None,
+        'table_cache' : None,
+        'templates' : None,
+        }
+    if args.cache:
+        kwargs['cache'] = schemacache.SchemaCache()
+    if args.plan_cache:
+        kwargs['plan_cache'] = schemacache.PlanCache()
+    if args.table_cache:
+        kwargs['table_cache'] = schemacache.TableDiffCache()
+    if args.templates and cursor:
+        kwargs['templates'] = templatedb.TemplateCache(cursor)
+    return kwargs
+
 def log_in_to_p4(p4):
     try:
         # log in with existing ticket, if it's there.
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+# in-memory model of a schema:  tables, columns, indexes, foreign keys.
+#
+# the diff functions in schemadiff don't care where table definitions
+# come from, only that they can get them from a catalog as Table
+# objects.  ddlparse builds them from CREATE TABLE statements and
+# schemadiff.snapshot_schema() builds them from information_schema, and
+# the diff compares them field by field.
+#
+# a big schema means a lot of these, so they use __slots__, intern
+# their identifiers, and keep their column lists in tuples.
+
+import collections
+
+# value of information_schema.tables.engine for each engine name we
+# might see in a CREATE TABLE
+ENGINES = {
+    'innodb' : 'InnoDB',
+    'myisam' : 'MyISAM',
+    'memory' : 'MEMORY',
+    'heap' : 'MEMORY',
+    'csv' : 'CSV',
+    'archive' : 'ARCHIVE',
+    'blackhole' : 'BLACKHOLE',
+    'merge' : 'MRG_MYISAM',
+    'mrg_myisam' : 'MRG_MYISAM',
+    'federated' : 'FEDERATED',
+    'ndb' : 'ndbcluster',
+    'ndbcluster' : 'ndbcluster',
+    }
+
+DEFAULT_ENGINE = 'InnoDB'
+
+def canonical_engine(engine):
+    return ENGINES.get(engine.lower(), engine)
+
+def _quote_name(name):
+    return '`%s`' % name.replace('`', '``')
+
+def _quote_string(s):
+    return "'%s'" % s.replace('\\', '\\\\').replace("'", "''")
+
+def _intern(s):
+    if s is None:
+        return None
+    return intern(str(s))
+
+class _Model(object):
+    """
+    equality is on _key(), so two definitions are the same if they'd
+    come out of information_schema the same.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s%r' % (type(self).__name__, self._key())
+
+class Column(_Model):
+    """
+    one column, as information_schema.columns would describe it.
+
+    column_type:  the full type, e.g. 'int(10) unsigned'.
+    default:  column_default.  None means no default.
+    extra:  '', 'auto_increment' or 'on update CURRENT_TIMESTAMP'
+    """
+    __slots__ = ('name', 'column_type', 'nullable', 'default', 'extra', 'comment')
+
+    def __init__(self, name, column_type, nullable=True, default=None,
+                 extra='', comment=''):
+        self.name = _intern(name)
+        self.column_type = _intern(column_type)
+        self.nullable = nullable
+        self.default = default
+        self.extra = _intern(extra or '')
+        self.comment = comment or ''
+
+    def _key(self):
+        return (self.name, self.column_type, self.nullable, self.default,
+                self.extra, self.comment)
+
+    def definition(self):
+        """
+        the column definition exactly as the query in
+        schemadiff.diff_table_columns builds it.
+        """
+        d = '%s %s' % (self.name, self.column_type)
+        if not self.nullable:
+            d += ' NOT NULL'
+
+        t = self.column_type.lower()
+        if self.default is None:
+            pass
+        elif 'char' in t or t.endswith('text'):
+            d += " DEFAULT '%s'" % self.default
+        elif (t in ('timestamp', 'datetime', 'date', 'time') and
+              self.default.lower() != 'current_timestamp'):
+            d += " DEFAULT '%s'" % self.default
+        else:
+            d += ' DEFAULT %s' % self.default
+
+        if self.extra:
+            d += ' %s' % self.extra
+        if self.comment:
+            d += " COMMENT '%s'" % self.comment.replace("'", "''")
+        return d
+
+    def create_definition(self):
+        """
+        the column the way SHOW CREATE TABLE shows it.
+        """
+        d = '%s %s' % (_quote_name(self.name), self.column_type)
+        t = self.column_type.lower()
+        if not self.nullable:
+            d += ' NOT NULL'
+        elif t == 'timestamp':
+            d += ' NULL'
+
+        if self.default is not None:
+            if self.default.upper() == 'CURRENT_TIMESTAMP':
+                d += ' DEFAULT CURRENT_TIMESTAMP'
+            else:
+                d += ' DEFAULT %s' % _quote_string(self.default)
+        elif self.nullable and 'blob' not in t and 'text' not in t:
+            d += ' DEFAULT NULL'
+
+        if self.extra == 'auto_increment':
+            d += ' AUTO_INCREMENT'
+        elif self.extra:
+            d += ' ' + self.extra.upper()
+        if self.comment:
+            d += ' COMMENT %s' % _quote_string(self.comment)
+        return d
+
+class Index(_Model):
+    """
+    constraint_type is 'PRIMARY KEY', 'UNIQUE' or None for a plain
+    index.  kind is what goes in front of KEY in SHOW CREATE TABLE:
+    'PRIMARY', 'UNIQUE', 'FULLTEXT', 'SPATIAL' or ''.  columns is a
+    sequence of (column name, prefix length or None).
+
+    kind isn't part of equality, since the diff doesn't handle fulltext
+    and spatial indexes yet.
+    """
+    __slots__ = ('name', 'columns', 'constraint_type', 'kind')
+
+    def __init__(self, name, columns, constraint_type=None, kind=''):
+        self.name = _intern(name)
+        self.columns = tuple((_intern(c), sub_part and int(sub_part) or None)
+                             for (c, sub_part) in columns)
+        self.constraint_type = _intern(constraint_type)
+        self.kind = kind
+
+    def _key(self):
+        return (self.name, self.columns, self.constraint_type)
+
+    def _column_list(self, quote=lambda n: n, sep=','):
+        parts = []
+        for (name, sub_part) in self.columns:
+            if sub_part:
+                parts.append('%s(%s)' % (quote(name), sub_part))
+            else:
+                parts.append(quote(name))
+        return sep.join(parts)
+
+    def expr(self):
+        """
+        the ADD clause exactly as the queries in schemadiff build it.
+        """
+        if self.constraint_type == 'PRIMARY KEY':
+            return 'ADD PRIMARY KEY(%s)' % self._column_list()
+        if self.constraint_type == 'UNIQUE':
+            return 'ADD UNIQUE KEY %s(%s)' % (self.name, self._column_list())
+        return 'ADD KEY %s(%s)' % (self.name, self._column_list())
+
+    def create_definition(self):
+        columns = self._column_list(_quote_name)
+        if self.kind == 'PRIMARY':
+            return 'PRIMARY KEY (%s)' % columns
+        kind = self.kind
+        if kind:
+            kind += ' '
+        return '%sKEY %s (%s)' % (kind, _quote_name(self.name), columns)
+
+class ForeignKey(_Model):
+    """
+    on_delete and on_update aren't part of equality; the diff doesn't
+    look at them yet.
+    """
+    __slots__ = ('name', 'columns', 'referenced_table', 'referenced_columns',
+                 'on_delete', 'on_update')
+
+    def __init__(self, name, columns, referenced_table, referenced_columns,
+                 on_delete=None, on_update=None):
+        self.name = _intern(name)
+        self.columns = tuple(_intern(c) for c in columns)
+        self.referenced_table = _intern(referenced_table)
+        self.referenced_columns = tuple(_intern(c) for c in referenced_columns)
+        self.on_delete = on_delete
+        self.on_update = on_update
+
+    def _key(self):
+        return (self.name, self.columns, self.referenced_table,
+                self.referenced_columns)
+
+    def expr(self):
+        """
+        the ADD clause exactly as the query in schemadiff.diff_fks
+        builds it.
+        """
+        return 'ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s(%s)' % (
+            self.name,
+            ','.join(self.columns),
+            self.referenced_table,
+            ','.join(self.referenced_columns))
+
+    def create_definition(self):
+        d = 'CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s)' % (
+            _quote_name(self.name),
+            ','.join(_quote_name(c) for c in self.columns),
+            _quote_name(self.referenced_table),
+            ','.join(_quote_name(c) for c in self.referenced_columns))
+        if self.on_delete and self.on_delete != 'RESTRICT':
+            d += ' ON DELETE %s' % self.on_delete
+        if self.on_update and self.on_update != 'RESTRICT':
+            d += ' ON UPDATE %s' % self.on_update
+        return d
+
+class Table(_Model):
+    """
+    columns, indexes and fks are tuples, in definition order.  options
+    holds whatever table options we want to show in create_statement(),
+    e.g. { 'DEFAULT CHARSET' : 'utf8' }
+    """
+    __slots__ = ('name', 'columns', 'indexes', 'fks', 'engine', 'options',
+                 'comment')
+
+    def __init__(self, name, columns=(), indexes=(), fks=(),
+                 engine=DEFAULT_ENGINE, options=None, comment=''):
+        self.name = _intern(name)
+        self.columns = tuple(columns)
+        self.indexes = tuple(indexes)
+        self.fks = tuple(fks)
+        self.engine = _intern(engine)
+        self.options = options or collections.OrderedDict()
+        self.comment = comment
+
+    def _key(self):
+        return (self.name, self.columns,
+                tuple(sorted(self.indexes, key=lambda i: i.name)),
+                tuple(sorted(self.fks, key=lambda fk: fk.name)),
+                self.engine)
+
+    def plain_indexes(self):
+        """dict of name -> Index, for indexes that aren't constraints"""
+        return dict((i.name, i) for i in self.indexes if i.constraint_type is None)
+
+    def constrained_indexes(self):
+        """dict of name -> Index, for PRIMARY KEY and UNIQUE indexes"""
+        return dict((i.name, i) for i in self.indexes
+                    if i.constraint_type is not None)
+
+    def fks_by_name(self):
+        return dict((fk.name, fk) for fk in self.fks)
+
+    def column(self, name):
+        for c in self.columns:
+            if c.name.lower() == name.lower():
+                return c
+        return None
+
+    def index(self, name):
+        for i in self.indexes:
+            if i.name.lower() == name.lower():
+                return i
+        return None
+
+    def create_statement(self):
+        """
+        approximately what SHOW CREATE TABLE would say about this table.
+        keys come out in the order mysql sorts them:  primary, unique,
+        plain, then fulltext and spatial.
+        """
+        order = { 'PRIMARY' : 0, 'UNIQUE' : 1, '' : 2 }
+        indexes = sorted(enumerate(self.indexes),
+                         key=lambda x: (order.get(x[1].kind, 3), x[0]))
+
+        lines = [c.create_definition() for c in self.columns]
+        lines += [i.create_definition() for (n, i) in indexes]
+        lines += [fk.create_definition() for fk in self.fks]
+
+        s = 'CREATE TABLE %s (\n  %s\n) ENGINE=%s' % (
+            _quote_name(self.name), ',\n  '.join(lines), self.engine)
+        for (option, value) in self.options.iteritems():
+            s += ' %s=%s' % (option, value)
+        if self.comment:
+            s += ' COMMENT=%s' % _quote_string(self.comment)
+        return s
+
+class Schema(object):
+    __slots__ = ('tables',)
+
+    def __init__(self, tables=None):
+        # table name -> Table
+        self.tables = tables or collections.OrderedDict()
+
+    def add(self, table):
+        self.tables[table.name] = table
+
+class Catalog(object):
+    """
+    where the diff functions get table definitions from.  unknown tables
+    come back as None.
+    """
+    def tables(self, db):
+        """set of table names"""
+        raise NotImplementedError
+
+    def table(self, db, table):
+        """a Table, or None"""
+        raise NotImplementedError
+
+    def create_table(self, db, table):
+        """the CREATE TABLE statement for a table, without a ;"""
+        raise NotImplementedError
+
+class ModelCatalog(Catalog):
+    """
+    a catalog over Schema objects.  schemas maps database name to Schema.
+    """
+    def __init__(self, schemas):
+        self.schemas = schemas
+
+    def _schema(self, db):
+        return self.schemas[db]
+
+    def tables(self, db):
+        return set(self._schema(db).tables.keys())
+
+    def table(self, db, table):
+        return self._schema(db).tables.get(table)
+
+    def create_table(self, db, table):
+        return self.table(db, table).create_statement()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# splitting schema files into statements, the way the mysql client
+# does, and telling which table a CREATE TABLE creates.  schemadiff and
+# ddlparse both need this, so it lives here rather than in either.
+
+import re
+
+def schema_lines(src):
+    """
+    iterate over the lines of a schema without their newlines.  src is
+    either a string or an open file.
+    """
+    if isinstance(src, basestring):
+        # walk the string instead of split()ting it, so we never hold a
+        # second copy of the whole thing.
+        start = 0
+        while True:
+            end = src.find('\n', start)
+            if end < 0:
+                yield src[start:]
+                return
+            yield src[start:end]
+            start = end + 1
+
+    for l in src:
+        if l.endswith('\n'):
+            l = l[:-1]
+        yield l
+
+create_table_re = re.compile(
+    r'^\s*create\s+(?:temporary\s+)?table\s+(?:if\s+not\s+exists\s+)?'
+    r'(?:(?:`[^`]+`|\w+)\.)?(?:`([^`]+)`|(\w+))', re.IGNORECASE)
+
+_delimiter_re = re.compile(r'^\s*delimiter\s+(\S+)', re.IGNORECASE)
+
+# in a quoted string, the next character that matters
+_quote_end_re = {
+    "'" : re.compile(r"['\\]"),
+    '"' : re.compile(r'["\\]'),
+    '`' : re.compile(r'`'),
+    }
+
+def _token_re(delimiter):
+    return re.compile(r"['\"`#]|--|/\*|" + re.escape(delimiter))
+
+def iter_statements(src):
+    """
+    generate the statements in a schema, stripped and without their
+    delimiters.  src is a string or an open file, read a line at a
+    time, so only the current statement is ever in memory.
+
+    this follows the mysql client's rules:  delimiters don't count
+    inside quotes, backticks or comments (--, # and /* */), but
+    /*!40101 ... */ version comments are live SQL.  DELIMITER lines
+    change the delimiter and aren't statements themselves.  statements
+    that are nothing but comments are dropped.
+    """
+    delimiter = ';'
+    token_re = _token_re(delimiter)
+
+    pieces = []          # the current statement so far
+    executable = False   # current statement has more than comments in it
+    quote = None         # the quote character we're inside of, if any
+    comment = False      # inside a /* */ comment
+
+    for line in schema_lines(src):
+        if quote is None and not comment and not executable:
+            m = _delimiter_re.match(line)
+            if m:
+                delimiter = m.group(1)
+                token_re = _token_re(delimiter)
+                pieces = []
+                continue
+
+        line += '\n'
+        start = 0
+        i = 0
+        n = len(line)
+        while i < n:
+            if quote is not None:
+                m = _quote_end_re[quote].search(line, i)
+                if m is None:
+                    i = n
+                elif m.group() == '\\':
+                    i = m.end() + 1
+                else:
+                    quote = None
+                    i = m.end()
+                continue
+
+            if comment:
+                j = line.find('*/', i)
+                if j < 0:
+                    i = n
+                else:
+                    comment = False
+                    i = j + 2
+                continue
+
+            m = token_re.search(line, i)
+            if m is None:
+                if line[i:].strip():
+                    executable = True
+                break
+
+            if line[i:m.start()].strip():
+                executable = True
+
+            token = m.group()
+            if token in _quote_end_re:
+                quote = token
+                executable = True
+                i = m.end()
+            elif token == '#':
+                break
+            elif token == '--':
+                if line[m.end()] in ' \t\r\n':
+                    break
+                # just two minus signs
+                executable = True
+                i = m.start() + 1
+            elif token == '/*':
+                if line[m.end()] == '!':
+                    executable = True
+                else:
+                    comment = True
+                i = m.end()
+            else:
+                pieces.append(line[start:m.start()])
+                if executable:
+                    yield ''.join(pieces).strip()
+                pieces = []
+                executable = False
+                start = i = m.end()
+
+        pieces.append(line[start:])
+
+    if executable:
+        yield ''.join(pieces).strip()
+
+def statement_table(ddl):
+    """
+    name of the table a CREATE TABLE statement creates, or None if ddl
+    isn't one.
+    """
+    for l in ddl.split('\n'):
+        m = create_table_re.match(l)
+        if m:
+            return m.group(1) or m.group(2)
+    return None
+
+# a table name, possibly database-qualified and backquoted.  group 1 or
+# 2 is the table.
+_name = r'(?:(?:`[^`]+`|\w+)\.)?(?:`([^`]+)`|(\w+))'
+_name_re = re.compile(_name)
+
+# statements after a CREATE TABLE that change the table.  each gives
+# the table, or for DROP and RENAME, the start of a list of them.
+_alter_table_re = re.compile(
+    r'^\s*alter\s+(?:online\s+|offline\s+)?(?:ignore\s+)?table\s+' + _name,
+    re.IGNORECASE)
+_index_re = re.compile(
+    r'^\s*(?:create\s+(?:online\s+|offline\s+)?(?:unique\s+|fulltext\s+|spatial\s+)?|'
+    r'drop\s+(?:online\s+|offline\s+)?)index\s+(?:`[^`]+`|\w+)\s+on\s+' + _name,
+    re.IGNORECASE)
+_table_list_re = re.compile(
+    r'^\s*(?:drop\s+(?:temporary\s+)?tables?\s+(?:if\s+exists\s+)?|rename\s+tables?\s+)(.*)',
+    re.IGNORECASE)
+
+def _line_tables(l):
+    m = create_table_re.match(l) or _alter_table_re.match(l) or _index_re.match(l)
+    if m:
+        return [m.group(1) or m.group(2)]
+    m = _table_list_re.match(l)
+    if m:
+        return [n.group(1) or n.group(2) for n in _name_re.finditer(m.group(1))
+                if n.group(1) or n.group(2).lower() not in ('to', 'restrict', 'cascade')]
+    return []
+
+def statement_tables(ddl):
+    """
+    names of the tables a statement creates or changes:  CREATE, ALTER,
+    DROP or RENAME TABLE, or CREATE or DROP INDEX.  empty for anything
+    else.  only the first line of each is looked at, so a long DROP or
+    RENAME list may come back short.
+    """
+    for l in ddl.split('\n'):
+        tables = _line_tables(l)
+        if tables:
+            return tables
+    return []
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+# catalog snapshots kept in files, so a database has to be read only
+# once (say off-peak, for production) and can then be diffed as often
+# as we like without going near the server.
+#
+#   snapshotfile.py capture db file
+#   snapshotfile.py diff [--db name] [--dmlfile file] [--planfile file]
+#                        source1 source2
+#
+# a diff source is either a snapshot file or a schema file of CREATE
+# TABLE statements, which is parsed with ddlparse.
+#
+# a snapshot file is gzipped json:
+#
+#   format     always SNAPSHOT_FORMAT
+#   version    VERSION when it was written; newer files are refused
+#   database   the database that was captured
+#   server     version() of the server it was captured from
+#   captured   when, in seconds since the epoch
+#   tables     one object per table:  name, engine, comment, options,
+#              columns, indexes, fks, and create, the server's own
+#              CREATE TABLE statement
+
+import argparse
+import collections
+import gzip
+import json
+import logging
+import time
+import ddlparse
+import schemadiff
+import schemamodel
+
+SNAPSHOT_FORMAT = 'schemadiff-snapshot'
+
+VERSION = 1
+
+# what capture() reads the server with.  show_create gets us the
+# CREATE TABLE statements without asking again for each table.
+DEFAULT_CATALOG = 'show_create'
+
+def _table_to_json(table, create):
+    return {
+        'name' : table.name,
+        'engine' : table.engine,
+        'comment' : table.comment,
+        'options' : table.options.items(),
+        'columns' : [[c.name, c.column_type, c.nullable, c.default, c.extra,
+                      c.comment]
+                     for c in table.columns],
+        'indexes' : [[i.name, i.columns, i.constraint_type, i.kind]
+                     for i in table.indexes],
+        'fks' : [[fk.name, fk.columns, fk.referenced_table,
+                  fk.referenced_columns, fk.on_delete, fk.on_update]
+                 for fk in table.fks],
+        'create' : create,
+        }
+
+def _table_from_json(t):
+    columns = [schemamodel.Column(name, column_type, nullable, default,
+                                  extra, comment)
+               for (name, column_type, nullable, default, extra, comment)
+               in t['columns']]
+    indexes = [schemamodel.Index(name, parts, constraint_type, kind)
+               for (name, parts, constraint_type, kind) in t['indexes']]
+    fks = [schemamodel.ForeignKey(name, fk_columns, referenced_table,
+                                  referenced_columns, on_delete, on_update)
+           for (name, fk_columns, referenced_table, referenced_columns,
+                on_delete, on_update) in t['fks']]
+    return schemamodel.Table(t['name'], columns, indexes, fks, t['engine'],
+                             collections.OrderedDict(t['options']), t['comment'])
+
+def save(filename, db, schema, ddls=None, server=None):
+    """
+    write schema, a schemamodel.Schema for database db, to filename.
+    ddls:  optional dict of table name -> CREATE TABLE statement.
+    """
+    if ddls is None:
+        ddls = {}
+    snapshot = {
+        'format' : SNAPSHOT_FORMAT,
+        'version' : VERSION,
+        'database' : db,
+        'server' : server,
+        'captured' : int(time.time()),
+        'tables' : [_table_to_json(table, ddls.get(name))
+                    for (name, table) in schema.tables.iteritems()],
+        }
+    f = gzip.open(filename, 'wb')
+    try:
+        json.dump(snapshot, f, separators=(',', ':'))
+    finally:
+        f.close()
+
+def read(filename):
+    """
+    (db, schema, ddls) from a snapshot file, as save() was given them.
+    """
+    f = gzip.open(filename, 'rb')
+    try:
+        snapshot = schemadiff.json_bytes(json.load(f))
+    finally:
+        f.close()
+
+    if snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError("%s isn't a schema snapshot" % filename)
+    if snapshot['version'] > VERSION:
+        raise ValueError("%s is snapshot version %d; we only know up to %d" % (
+                filename, snapshot['version'], VERSION))
+
+    schema = schemamodel.Schema()
+    ddls = {}
+    for t in snapshot['tables']:
+        table = _table_from_json(t)
+        schema.add(table)
+        if t['create'] is not None:
+            ddls[table.name] = t['create']
+    return (snapshot['database'], schema, ddls)
+
+def is_snapshot(filename):
+    f = open(filename, 'rb')
+    try:
+        return f.read(2) == '\x1f\x8b'
+    finally:
+        f.close()
+
+def capture(cursor, db, filename, catalog=None, workers=None):
+    """
+    read db from the server cursor is on and save it to filename.
+    catalog is a key of schemadiff.CATALOGS; workers as for
+    schemadiff.diff_databases().
+    """
+    pool = None
+    if workers > 1:
+        pool = schemadiff.ConnectionPool(workers)
+    try:
+        c = schemadiff.CATALOGS[catalog or DEFAULT_CATALOG](cursor, pool)
+        c.prefetch([db])
+        schema = schemamodel.Schema()
+        ddls = {}
+        for name in sorted(c.tables(db)):
+            schema.add(c.table(db, name))
+            ddls[name] = c.create_table(db, name)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    cursor.execute("select version()")
+    server = cursor.fetchall()[0][0]
+
+    logging.debug("saving %d tables from %s to %s" % (
+            len(schema.tables), db, filename))
+    save(filename, db, schema, ddls, server)
+
+class SnapshotFileCatalog(schemamodel.ModelCatalog):
+    """
+    a catalog over snapshot files and schema files, loaded with add().
+    tables from a snapshot are created the way the server showed them.
+    """
+    def __init__(self):
+        schemamodel.ModelCatalog.__init__(self, {})
+        # db -> table name -> CREATE TABLE statement
+        self.ddls = {}
+
+    def add(self, db, source):
+        """
+        load source, a snapshot or schema file, as database db.  returns
+        the database name recorded in a snapshot, or None.
+        """
+        if is_snapshot(source):
+            (captured, schema, ddls) = read(source)
+        else:
+            f = open(source, 'r')
+            src = f.read().replace('%DB_COLLATION_CREATE_TABLE_COMMON%', '')
+            f.close()
+            (captured, schema, ddls) = (None, ddlparse.parse_schema(src), {})
+        self.schemas[db] = schema
+        self.ddls[db] = ddls
+        return captured
+
+    def create_table(self, db, table):
+        if table in self.ddls[db]:
+            return self.ddls[db][table]
+        return schemamodel.ModelCatalog.create_table(self, db, table)
+
+def _catalog(source1, source2, db):
+    catalog = SnapshotFileCatalog()
+    captured = catalog.add('source1', source1)
+    catalog.add('source2', source2)
+    return (catalog, db or captured or 'source1')
+
+def diff(source1, source2, db=None):
+    """
+    the DML iter_diff_databases() yields for turning source1 into
+    source2, each a snapshot or schema file.  db is the database for the
+    USE statement; it defaults to the one source1 was captured from.
+    """
+    (catalog, use) = _catalog(source1, source2, db)
+    return schemadiff.iter_diff_databases(catalog, 'source1', 'source2', use=use)
+
+def plan(source1, source2, db=None):
+    """
+    the same, as schemadiff.plan_record()s.
+    """
+    (catalog, use) = _catalog(source1, source2, db)
+    return schemadiff.iter_plan(catalog, 'source1', 'source2', use=use)
+
+if __name__ == '__main__':
+    FORMAT = "%(asctime)-15s %(funcName)s %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('capture', help="save a database's catalog to a file")
+    p.add_argument("--catalog", choices=sorted(schemadiff.CATALOGS.keys()),
+                   help="how to read table definitions from the server")
+    p.add_argument("--workers", type=int,
+                   help="connections to read the catalog with")
+    p.add_argument("db", help="database to capture")
+    p.add_argument("file", help="snapshot file to write")
+
+    p = subparsers.add_parser('diff', help="diff snapshot or schema files")
+    p.add_argument("--db", help="database for the USE statement")
+    p.add_argument("--dmlfile", help="file to write dml statements")
+    p.add_argument("--planfile",
+                   help="file to write the plan to, one json record per statement")
+    p.add_argument("source1", help="snapshot or schema file")
+    p.add_argument("source2", help="snapshot or schema file")
+    args = parser.parse_args()
+
+    if args.command == 'capture':
+        conn = schemadiff.get_connection()
+        cursor = conn.cursor()
+        capture(cursor, args.db, args.file, args.catalog, args.workers)
+        cursor.close()
+        conn.close()
+    else:
+        dmlf = None
+        if args.dmlfile:
+            dmlf = open(args.dmlfile, 'w')
+        planf = None
+        if args.planfile:
+            planf = open(args.planfile, 'w')
+
+        for record in plan(args.source1, args.source2, args.db):
+            if planf:
+                schemadiff.write_plan_record(planf, record)
+            if dmlf:
+                dmlf.write(record['sql'] + "\n")
+            elif not planf:
+                print record['sql']
+
+        if dmlf:
+            dmlf.close()
+            print "wrote file %s" % args.dmlfile
+        if planf:
+            planf.close()
+            print "wrote plan %s" % args.planfile
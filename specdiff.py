@@ -9,6 +9,7 @@ import logging
 import re
 import P4
 import schemadiff
+import sandbox
 import dsn
 import string
 import p4credentials
@@ -25,19 +26,15 @@ if __name__ == '__main__':
                         help="p4 filespec for old version of schema")
     parser.add_argument("newspec",
                         help="p4 filespec for new version of schema")
-    parser.add_argument("--dmlfile", help="file to write dml statements")
-    parser.add_argument("--validate", help="verify that the changes work",
-                        action="store_true")
+    schemadiff.add_diff_arguments(parser)
 
     args = parser.parse_args()
 
-    validate = False
-    if args.validate:
-        validate = True
+    if args.offline and args.validate:
+        parser.error("--offline and --validate don't go together")
 
     oldspec = args.oldspec
     newspec = args.newspec
-    dmlfile = args.dmlfile
 
     p4 = P4.P4()
     conn = None
@@ -46,8 +43,11 @@ if __name__ == '__main__':
     try:
         schemadiff.log_in_to_p4(p4)
 
-        conn = dsn.getConnection()
-        cursor = conn.cursor()
+        if args.sandbox and not args.offline:
+            schemadiff.SANDBOX = sandbox.Sandbox().start()
+        if not args.offline:
+            conn = schemadiff.get_connection()
+            cursor = conn.cursor()
 
         schema1 = schemadiff.get_schema_from_filespec(p4, oldspec)
         schema2 = schemadiff.get_schema_from_filespec(p4, newspec)
@@ -57,8 +57,7 @@ if __name__ == '__main__':
                                 schema2,
                                 "specdiff_old",
                                 "specdiff_new",
-                                dmlfile=dmlfile,
-                                validate=validate)
+                                **schemadiff.diff_kwargs(args, cursor))
 
     except P4.P4Exception as p4e:
         logging.error(p4e)
@@ -76,4 +75,6 @@ if __name__ == '__main__':
             conn.close()
         if cursor:
             cursor.close()
+        if schemadiff.SANDBOX:
+            schemadiff.SANDBOX.stop()
 
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+# scratch databases that outlive a single run.  a schema is loaded into
+# a template database named after its checksum, and the next diff that
+# needs the same schema uses the template instead of loading it again.
+#
+# templates are tracked in a registry table on the server:
+#
+#   schemadiff_templates.templates
+#     checksum    schemachecksum() of the schema
+#     dbname      the template database
+#     state       'loading' while someone is creating it, then 'ready'
+#     owner       connection_id() of whoever is loading it
+#     created, last_used
+#
+# whoever inserts the registry row gets to load the template; everybody
+# else waits for it to become ready.  if the loader's connection goes
+# away while loading, the row is taken over.  telling whether it has
+# means reading information_schema.processlist, which only shows other
+# users' connections to those with the PROCESS privilege; without it
+# nothing is taken over, and we wait out LOAD_TIMEOUT instead.
+#
+# templates are evicted least recently used first once there are more
+# than max_templates of them, or when they haven't been used for ttl
+# seconds.  a template used within the last GRACE seconds is never
+# evicted, since somebody may still be diffing against it.
+
+import argparse
+import logging
+import re
+import time
+import MySQLdb
+import dsn
+import schemadiff
+
+REGISTRY_DB = 'schemadiff_templates'
+
+TEMPLATE_PREFIX = 'sdt_'
+
+DEFAULT_MAX_TEMPLATES = 20
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+GRACE = 60 * 60
+
+# how long to wait for somebody else to finish loading a template
+LOAD_TIMEOUT = 30 * 60
+
+POLL_INTERVAL = 1
+
+class TemplateCache(object):
+    def __init__(self, cursor, max_templates=None, ttl=None):
+        if max_templates is None:
+            max_templates = DEFAULT_MAX_TEMPLATES
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        self.cursor = cursor
+        self.max_templates = max_templates
+        self.ttl = ttl
+        self.see_processes = None
+
+        cursor.execute("create database if not exists %s" % REGISTRY_DB)
+        cursor.execute("""
+create table if not exists %s.templates (
+    checksum char(40) not null primary key,
+    dbname varchar(64) not null,
+    state enum('loading', 'ready') not null,
+    owner bigint unsigned not null,
+    created datetime not null,
+    last_used datetime not null
+) ENGINE=InnoDB""" % REGISTRY_DB)
+
+    def _execute(self, query):
+        # the registry is how concurrent runs see each other, so every
+        # change has to be visible right away, and polling mustn't read
+        # from a stale snapshot.
+        self.cursor.execute(query)
+        rows = self.cursor.fetchall()
+        self.cursor.connection.commit()
+        return rows
+
+    def name(self, checksum):
+        return TEMPLATE_PREFIX + checksum
+
+    def _row(self, checksum):
+        for row in self._execute(
+            "select state, owner from %s.templates where checksum = '%s'" % (
+                REGISTRY_DB, checksum)):
+            return row
+        return None
+
+    def _has_process(self):
+        for (grant,) in self._execute("show grants"):
+            m = re.match(r'grant (.*) on \*\.\* to ', grant, re.IGNORECASE)
+            if m and re.search(r'\b(process|all privileges)\b', m.group(1),
+                               re.IGNORECASE):
+                return True
+        return False
+
+    def _alive(self, owner):
+        if self.see_processes is None:
+            self.see_processes = self._has_process()
+            if not self.see_processes:
+                logging.warning("no PROCESS privilege, so templates left loading by "
+                                "dead connections won't be taken over")
+        if not self.see_processes:
+            return True
+
+        rows = self._execute(
+            "select count(*) from information_schema.processlist where id = %d" % owner)
+        return rows[0][0] > 0
+
+    def _touch(self, checksum):
+        self._execute(
+            "update %s.templates set last_used = now() where checksum = '%s'" % (
+                REGISTRY_DB, checksum))
+
+    def _forget(self, checksum):
+        self._execute("delete from %s.templates where checksum = '%s'" % (
+                REGISTRY_DB, checksum))
+
+    def _take_over(self, checksum, owner):
+        """
+        delete the registry row owner left loading, unless somebody
+        else got to it first.  True if we deleted it.
+        """
+        self.cursor.execute("""
+delete from %s.templates
+ where checksum = '%s' and state = 'loading' and owner = %d""" % (
+                REGISTRY_DB, checksum, owner))
+        deleted = self.cursor.rowcount
+        self.cursor.connection.commit()
+        return deleted > 0
+
+    def claim(self, checksum):
+        """
+        True if the caller has to load the template for checksum, False
+        once somebody else has loaded it.
+        """
+        deadline = time.time() + LOAD_TIMEOUT
+        while True:
+            try:
+                self._execute("""
+insert into %s.templates (checksum, dbname, state, owner, created, last_used)
+values ('%s', '%s', 'loading', connection_id(), now(), now())""" % (
+                        REGISTRY_DB, checksum, self.name(checksum)))
+                return True
+            except MySQLdb.IntegrityError:
+                pass
+
+            row = self._row(checksum)
+            if row is None:
+                # evicted or abandoned between our insert and select
+                continue
+
+            (state, owner) = row
+            if state == 'ready':
+                self._touch(checksum)
+                return False
+
+            if not self._alive(owner):
+                # only the run whose delete takes the row away gets to
+                # insert it again.  another that saw the same dead
+                # loader and got there first keeps the row.
+                if self._take_over(checksum, owner):
+                    logging.warning("took over template %s from dead loader %d" % (
+                            checksum, owner))
+                continue
+
+            if time.time() > deadline:
+                raise RuntimeError("timed out waiting for template %s" % checksum)
+            time.sleep(POLL_INTERVAL)
+
+    def ready(self, checksum):
+        self._execute(
+            "update %s.templates set state = 'ready', last_used = now() where checksum = '%s'" % (
+                REGISTRY_DB, checksum))
+
+    def abandon(self, checksum):
+        """
+        give up on a template we claimed but couldn't load.
+        """
+        self.cursor.execute("drop database if exists %s" % self.name(checksum))
+        self._forget(checksum)
+
+    def load(self, loads, batch_size=None, workers=None):
+        """
+        make sure there are templates for loads, a list of (checksum,
+        schema), loading the ones nobody has loaded yet.  returns the
+        template names in the same order.  batch_size and workers are as
+        for schemadiff.diff_schemas().
+        """
+        names = [self.name(checksum) for (checksum, schema) in loads]
+        schemas = dict(loads)
+
+        mine = []
+        try:
+            # claim in checksum order, whatever order loads is in, so two
+            # runs that both need a pair of templates can't each hold one
+            # and wait on the other for the rest
+            for checksum in sorted(schemas):
+                schema = schemas[checksum]
+                if self.claim(checksum):
+                    mine.append((checksum, schema))
+                else:
+                    logging.debug("reusing template %s" % self.name(checksum))
+
+            if len(mine) == 0:
+                return names
+
+            if workers > 1:
+                logging.debug("loading %d templates with %d workers" % (
+                        len(mine), workers))
+                pool = schemadiff.ConnectionPool(workers)
+                try:
+                    schemadiff.create_dbs_parallel(
+                        pool,
+                        [(self.name(checksum), schema) for (checksum, schema) in mine],
+                        batch_size=batch_size)
+                finally:
+                    pool.close()
+            else:
+                for (checksum, schema) in mine:
+                    logging.debug("loading template %s" % self.name(checksum))
+                    schemadiff.create_db_from_schema(self.cursor, self.name(checksum),
+                                                     schema, batch_size=batch_size)
+        except:
+            for (checksum, schema) in mine:
+                self.abandon(checksum)
+            raise
+
+        for (checksum, schema) in mine:
+            self.ready(checksum)
+
+        self.evict()
+        return names
+
+    def clone(self, template, dbname, batch_size=None):
+        """
+        (re)create dbname with the same tables as template, for changes
+        that mustn't touch the template itself.
+        """
+        catalog = schemadiff.ServerCatalog(self.cursor)
+        ddls = [catalog.create_table(template, table)
+                for table in sorted(catalog.tables(template))]
+
+        self.cursor.execute("drop database if exists %s" % dbname)
+        self.cursor.execute("create database %s" % dbname)
+        self.cursor.execute("use %s" % dbname)
+        self.cursor.execute("SET FOREIGN_KEY_CHECKS=0")
+        try:
+            schemadiff.execute_statements(self.cursor, ddls, batch_size)
+        finally:
+            self.cursor.execute("SET FOREIGN_KEY_CHECKS=1")
+
+    def templates(self):
+        """
+        list of (checksum, dbname, state, last_used), most recently used
+        first.
+        """
+        return list(self._execute("""
+select checksum, dbname, state, last_used
+ from %s.templates
+ order by last_used desc""" % REGISTRY_DB))
+
+    def _drop(self, checksum, dbname):
+        logging.debug("dropping template %s" % dbname)
+        self.cursor.execute("drop database if exists %s" % dbname)
+        self._forget(checksum)
+
+    def evict(self):
+        rows = self._execute("""
+select checksum, dbname,
+       last_used < now() - interval %d second,
+       last_used < now() - interval %d second
+ from %s.templates
+ where state = 'ready'
+ order by last_used desc""" % (self.ttl, GRACE, REGISTRY_DB))
+
+        for (n, (checksum, dbname, expired, idle)) in enumerate(rows):
+            if idle and (expired or n >= self.max_templates):
+                self._drop(checksum, dbname)
+
+    def clear(self):
+        for (checksum, dbname, state, last_used) in self.templates():
+            if state == 'ready':
+                self._drop(checksum, dbname)
+
+if __name__ == '__main__':
+    FORMAT = "%(asctime)-15s %(funcName)s %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=['list', 'evict', 'clear'])
+    args = parser.parse_args()
+
+    conn = dsn.getConnection()
+    cursor = conn.cursor()
+    templates = TemplateCache(cursor)
+
+    if args.command == 'evict':
+        templates.evict()
+    elif args.command == 'clear':
+        templates.clear()
+    else:
+        for (checksum, dbname, state, last_used) in templates.templates():
+            print "%-44s %-8s %s" % (dbname, state, last_used)
+
+    cursor.close()
+    conn.close()
@@ -4,15 +4,32 @@ import MySQLdb
 # docs at http://mysql-python.sourceforge.net/MySQLdb.html
 
 import logging
+import argparse
 import ast
+import random
 import sys
 import time
 import os
 import string
+import StringIO
 import unittest
 import schemadiff
+import schemacache
+import templatedb
+import sandbox
+import asynccatalog
+import distutils.spawn
+import schemamodel
+import ddlparse
+import snapshotfile
+import schemastatements
 import hashlib
+import tempfile
+import gzip
+import json
+import shutil
 import dsn
+import threading
 from warnings import filterwarnings
 
 def create_tables(cursor, create_table_statements, db):
@@ -39,7 +56,7 @@ class SchemaDiffTest(unittest.TestCase):
     cursor = None
 
     def setUp(self):
-        self.dbconn = dsn.getConnection()
+        self.dbconn = schemadiff.get_connection()
         self.cursor = self.dbconn.cursor()
 
         self.cursor.execute("drop database if exists %(db)s" % { "db" : self.db1 })
@@ -1904,10 +1921,1708 @@ class TestDiffDatabases(SchemaDiffTest):
         cs2 = schemadiff.dbchecksum(self.db2)
             
         self.assertEqual(cs1, cs2)
+
+    def testPlanKeys(self):
+        self.cursor.execute("use %s" % self.db1)
+        self.cursor.execute("CREATE TABLE t (id int NOT NULL, a int, "
+                            "PRIMARY KEY (id), UNIQUE KEY ua (a)) ENGINE=InnoDB")
+
+        for catalog in sorted(schemadiff.CATALOGS.keys()):
+            plan = list(schemadiff.iter_plan(self.cursor, self.db1, self.db2,
+                                             catalog=catalog))
+            [op] = plan[1]['operations']
+            self.assertTrue('  PRIMARY KEY (`id`),\n  UNIQUE KEY `ua` (`a`)\n'
+                            in op['source'], op['source'])
+
+    def testSkipUnchanged(self):
+        """
+        tables with matching digests don't get diffed, even if the
+        databases disagree about them.
+        """
+        t1 = """CREATE TABLE `%(table)s` (
+  column1 int not null
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+        t2 = """CREATE TABLE `%(table)s` (
+  column1 int not null,
+  column2 int not null
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+        create_tables(self.cursor,
+                      [t1 % { "table" : "same" }, t1 % { "table" : "changed" }],
+                      self.db1)
+        create_tables(self.cursor,
+                      [t2 % { "table" : "same" }, t2 % { "table" : "changed" }],
+                      self.db2)
+
+        digests1 = { "same" : "x", "changed" : "y" }
+        digests2 = { "same" : "x", "changed" : "z" }
+        dmls = schemadiff.diff_databases(
+            self.cursor, self.db1, self.db2, digests1, digests2)
+
+        self.assertEqual(2, len(dmls))
+        self.assertTrue(dmls[1].startswith("ALTER TABLE changed"))
+
+    def testSnapshot(self):
+        """
+        the snapshot has to say exactly what the per-table queries say,
+        in the same number of queries however many tables there are.
+        """
+        tables = ["""CREATE TABLE parent (
+  id int NOT NULL,
+  code varchar(10) NOT NULL DEFAULT '',
+  PRIMARY KEY (id, code)
+) ENGINE=InnoDB""",
+                  """CREATE TABLE child (
+  id int unsigned NOT NULL AUTO_INCREMENT,
+  parent_id int,
+  parent_code varchar(10),
+  name varchar(100) COMMENT 'it''s a name',
+  updated timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (id),
+  UNIQUE KEY name_u (name(20), parent_id),
+  KEY parent_code (parent_code),
+  CONSTRAINT fk_child_parent FOREIGN KEY (parent_id, parent_code) REFERENCES parent (id, code)
+) ENGINE=InnoDB""",
+                  """CREATE TABLE plain (
+  x int
+) ENGINE=MyISAM"""]
+        create_tables(self.cursor, tables, self.db1)
+
+        server = schemadiff.ServerCatalog(self.cursor)
+        snapshot = schemadiff.SnapshotCatalog(self.cursor)
+        self.assertEqual(server.tables(self.db1), snapshot.tables(self.db1))
+        for table in server.tables(self.db1):
+            self.assertEqual(server.table(self.db1, table),
+                             snapshot.table(self.db1, table))
+
+        class CountingCursor(object):
+            def __init__(self, cursor):
+                self.cursor = cursor
+                self.count = 0
+            def execute(self, q):
+                self.count += 1
+                return self.cursor.execute(q)
+            def fetchall(self):
+                return self.cursor.fetchall()
+
+        create_tables(self.cursor, tables, self.db2)
+        cursor = CountingCursor(self.cursor)
+        self.assertEqual(["USE %s;" % self.db1],
+                         schemadiff.diff_databases(cursor, self.db1, self.db2))
+        self.assertEqual(2 * len(schemadiff._snapshot_queries), cursor.count)
+
+    def testParallelSnapshot(self):
+        t1 = """CREATE TABLE `t%d` (
+  column1 int not null,
+  KEY k (column1)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+        t2 = """CREATE TABLE `t%d` (
+  column1 bigint not null,
+  column2 int,
+  UNIQUE KEY k (column1, column2)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+        create_tables(self.cursor, [t1 % i for i in range(10)], self.db1)
+        create_tables(self.cursor, [t2 % i for i in range(10)], self.db2)
+
+        serial = schemadiff.diff_databases(self.cursor, self.db1, self.db2)
+        parallel = schemadiff.diff_databases(self.cursor, self.db1, self.db2,
+                                             workers=4)
+        self.assertEqual(11, len(serial))
+        self.assertEqual(serial, parallel)
+
+    def testShowCreate(self):
+        """
+        parsing SHOW CREATE TABLE has to come out the same as reading
+        information_schema, batched or not.  views too, though there's
+        nothing to parse for them.
+        """
+        tables = ["""CREATE TABLE parent (
+  id int NOT NULL,
+  code varchar(10) NOT NULL DEFAULT '',
+  PRIMARY KEY (id, code)
+) ENGINE=InnoDB""",
+                  """CREATE TABLE child (
+  id int unsigned NOT NULL AUTO_INCREMENT,
+  parent_id int,
+  parent_code varchar(10),
+  name varchar(100) COMMENT 'it''s a name',
+  created timestamp NOT NULL DEFAULT '0000-00-00 00:00:00',
+  updated timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (id),
+  UNIQUE KEY name_u (name(20), parent_id),
+  CONSTRAINT fk_child_parent FOREIGN KEY (parent_id, parent_code) REFERENCES parent (id, code)
+) ENGINE=InnoDB""",
+                  """CREATE TABLE plain (
+  x int
+) ENGINE=MyISAM""",
+                  """CREATE VIEW names AS SELECT id, name FROM child"""]
+        create_tables(self.cursor, tables, self.db1)
+
+        snapshot = schemadiff.SnapshotCatalog(self.cursor)
+        for batch_size in (1, None):
+            parsed = schemadiff.ShowCreateCatalog(self.cursor, batch_size=batch_size)
+            self.assertEqual(snapshot.tables(self.db1), parsed.tables(self.db1))
+            for table in snapshot.tables(self.db1):
+                self.assertEqual(snapshot.table(self.db1, table),
+                                 parsed.table(self.db1, table))
+
+        self.assertEqual(schemadiff.diff_databases(self.cursor, self.db2, self.db1),
+                         schemadiff.diff_databases(self.cursor, self.db2, self.db1,
+                                                   catalog='show_create'))
+
+    @unittest.skipIf(asynccatalog.gevent is None, "needs gevent and PyMySQL")
+    def testAsync(self):
+        t1 = """CREATE TABLE `t%d` (
+  column1 int not null,
+  KEY k (column1)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+        t2 = """CREATE TABLE `t%d` (
+  column1 bigint not null,
+  column2 int,
+  UNIQUE KEY k (column1, column2)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+        create_tables(self.cursor, [t1 % i for i in range(5)], self.db1)
+        create_tables(self.cursor, [t2 % i for i in range(10)], self.db2)
+
+        # the test run doesn't patch socket, so this checks what comes
+        # out, not that the queries overlap
+        reader = asynccatalog.AsyncCatalogReader(max_in_flight=4)
+        try:
+            (forward, backward) = reader.diff_databases([(self.db1, self.db2),
+                                                         (self.db2, self.db1)])
+        finally:
+            reader.close()
+
+        self.assertEqual(schemadiff.diff_databases(self.cursor, self.db1, self.db2),
+                         forward)
+        self.assertEqual(schemadiff.diff_databases(self.cursor, self.db2, self.db1),
+                         backward)
     
+class TestDump(SchemaDiffTest):
+    db1 = 'TestDump_old'
+    db2 = 'TestDump_new'
+
+    tables = ["""CREATE TABLE `t%d` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(10) DEFAULT 'x' COMMENT 'a name',
+  PRIMARY KEY (`id`),
+  KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8""" % i for i in range(5)]
+
+    def testDump(self):
+        create_tables(self.cursor, self.tables, self.db1)
+        create_tables(self.cursor, self.tables, self.db2)
+        self.cursor.execute("insert into %s.t0 (name) values ('y')" % self.db1)
+
+        dump = schemadiff.dump_schema(self.cursor, self.db1)
+        self.assertEqual(5, dump.count('CREATE TABLE'))
+        self.assertEqual(dump, schemadiff.dump_schema(self.cursor, self.db1,
+                                                      batch_size=2))
+        self.assertEqual(dump, schemadiff.dbdump(self.db1, workers=2))
+
+        # AUTO_INCREMENT doesn't count
+        self.assertEqual(schemadiff.dbchecksum(self.db1, cursor=self.cursor),
+                         schemadiff.dbchecksum(self.db2, cursor=self.cursor))
+
+        self.cursor.execute("alter table %s.t3 add column c int" % self.db2)
+        self.assertNotEqual(schemadiff.dbchecksum(self.db1),
+                            schemadiff.dbchecksum(self.db2))
+
+    def testCompare(self):
+        create_tables(self.cursor, self.tables, self.db1)
+        create_tables(self.cursor, self.tables[:4], self.db2)
+        self.assertEqual(['t4'], schemadiff.compare_databases(self.cursor,
+                                                              self.db1, self.db2))
+
+        self.cursor.execute("alter table %s.t1 add column c int" % self.db2)
+        self.cursor.execute("drop table %s.t4" % self.db1)
+        for catalog in sorted(schemadiff.CATALOGS.keys()):
+            self.assertEqual(['t1'], schemadiff.compare_databases(
+                    self.cursor, self.db1, self.db2, workers=2, catalog=catalog))
+
+        # the diff doesn't see charsets, but validation has to
+        self.cursor.execute("alter table %s.t2 default charset latin1" % self.db2)
+        self.assertEqual(['t1', 't2'], schemadiff.compare_databases(
+                self.cursor, self.db1, self.db2))
+
+    def testApplyParallel(self):
+        create_tables(self.cursor, self.tables, self.db1)
+        create_tables(self.cursor, self.tables[1:], self.db2)
+        for i in range(1, 4):
+            self.cursor.execute("alter table %s.t%d add column c int" % (self.db2, i))
+        self.cursor.execute("alter table %s.t4 add column t1_id int, "
+                            "add constraint t4_fk foreign key (t1_id) "
+                            "references t1 (id)" % self.db2)
+
+        plan = list(schemadiff.iter_plan(self.cursor, self.db1, self.db2))
+        pool = schemadiff.ConnectionPool(3)
+        try:
+            schemadiff.apply_plan_parallel(pool, self.db1, plan)
+        finally:
+            pool.close()
+        self.assertEqual([], schemadiff.compare_databases(self.cursor,
+                                                          self.db1, self.db2))
+
+    @unittest.skipUnless(distutils.spawn.find_executable('mysqldump'),
+                         "no mysqldump to compare with")
+    def testSameAsMysqldump(self):
+        create_tables(self.cursor, self.tables, self.db1)
+        self.assertEqual(schemadiff.normalize(schemadiff._mysqldump(self.db1)),
+                         schemadiff.normalize(schemadiff.dbdump(self.db1)))
+
+
+class TestLoad(SchemaDiffTest):
+    db1 = 'TestLoad_old'
+    db2 = 'TestLoad_new'
+
+    schema = """CREATE TABLE t1 (
+  c1 int NOT NULL COMMENT 'has a %s in it'
+) ENGINE=InnoDB;
+CREATE TABLE t2 (
+  c1 int NOT NULL
+) ENGINE=InnoDB;
+CREATE TABLE t3 (
+  c1 int NOT NULL
+) ENGINE=InnoDB;
+"""
+
+    def testBatched(self):
+        timings = []
+        schemadiff.create_db_from_schema(self.cursor, self.db1, self.schema,
+                                         batch_size=2, timings=timings)
+        schemadiff.create_db_from_schema(self.cursor, self.db2, self.schema)
+        self.assertEqual(3, len(timings))
+        self.assertEqual(schemadiff.dbchecksum(self.db1),
+                         schemadiff.dbchecksum(self.db2))
+
+    def testBatchedFailure(self):
+        """
+        the error has to name the statement that failed, not the batch.
+        """
+        bad = self.schema.replace("CREATE TABLE t2", "CREATE TABLE t1")
+        try:
+            schemadiff.create_db_from_schema(self.cursor, self.db1, bad,
+                                             batch_size=3)
+        except schemadiff.StatementError as e:
+            self.assertTrue(e.statement.startswith("CREATE TABLE t1 (\n  c1 int NOT NULL\n)"))
+        else:
+            self.fail("no StatementError")
+
+    def testParallel(self):
+        """
+        child comes before parent, which only works with foreign key
+        checks off.
+        """
+        schema = """/*!40101 SET NAMES utf8 */;
+CREATE TABLE child (
+  id int NOT NULL,
+  parent_id int,
+  PRIMARY KEY (id),
+  CONSTRAINT fk_child_parent FOREIGN KEY (parent_id) REFERENCES parent (id)
+) ENGINE=InnoDB;
+CREATE TABLE parent (
+  id int NOT NULL,
+  PRIMARY KEY (id)
+) ENGINE=InnoDB;
+""" + self.schema
+
+        pool = schemadiff.ConnectionPool(3)
+        try:
+            schemadiff.create_dbs_parallel(pool,
+                                           [(self.db1, schema), (self.db2, schema)])
+        finally:
+            pool.close()
+
+        self.cursor.execute("select count(*) from information_schema.tables "
+                            "where table_schema in ('%s', '%s')" % (self.db1, self.db2))
+        self.assertEqual(10, self.cursor.fetchall()[0][0])
+        self.assertEqual(schemadiff.dbchecksum(self.db1),
+                         schemadiff.dbchecksum(self.db2))
+
+
+class TestTemplates(SchemaDiffTest):
+    db1 = 'TestTemplates_old'
+    db2 = 'TestTemplates_new'
+
+    def setUp(self):
+        SchemaDiffTest.setUp(self)
+        self.templates = templatedb.TemplateCache(self.cursor)
+        self.schema1 = TestLoad.schema
+        self.schema2 = TestLoad.schema.replace("CREATE TABLE t3 (\n  c1 int",
+                                               "CREATE TABLE t3 (\n  c1 bigint")
+        self.cs1 = schemadiff.schemachecksum(self.schema1)
+        self.cs2 = schemadiff.schemachecksum(self.schema2)
+
+    def tearDown(self):
+        for cs in (self.cs1, self.cs2):
+            self.templates._drop(cs, self.templates.name(cs))
+        SchemaDiffTest.tearDown(self)
+
+    def testReuse(self):
+        names = self.templates.load([(self.cs1, self.schema1), (self.cs2, self.schema2)])
+        self.assertEqual([self.templates.name(self.cs1), self.templates.name(self.cs2)],
+                         names)
+
+        # everything's loaded, so a second load mustn't create anything
+        saved = schemadiff.create_db_from_schema
+        def boom(*args, **kwargs):
+            raise AssertionError("loaded a template twice")
+        schemadiff.create_db_from_schema = boom
+        try:
+            self.assertEqual(names, self.templates.load([(self.cs1, self.schema1)]) +
+                             self.templates.load([(self.cs2, self.schema2)]))
+        finally:
+            schemadiff.create_db_from_schema = saved
+
+        states = dict((row[0], row[2]) for row in self.templates.templates())
+        self.assertEqual('ready', states[self.cs1])
+
+    def testOppositeOrders(self):
+        """
+        two runs loading the same pair the other way round don't wait
+        on each other.
+        """
+        loads = [(self.cs1, self.schema1), (self.cs2, self.schema2)]
+        results = {}
+        def load(n, loads):
+            conn = schemadiff.get_connection()
+            try:
+                results[n] = templatedb.TemplateCache(conn.cursor()).load(loads)
+            except Exception as e:
+                results[n] = e
+            finally:
+                conn.close()
+
+        saved = templatedb.LOAD_TIMEOUT
+        templatedb.LOAD_TIMEOUT = 60
+        try:
+            threads = [threading.Thread(target=load, args=(0, loads)),
+                       threading.Thread(target=load, args=(1, loads[::-1]))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            templatedb.LOAD_TIMEOUT = saved
+
+        names = [self.templates.name(self.cs1), self.templates.name(self.cs2)]
+        self.assertEqual({ 0 : names, 1 : names[::-1] }, results)
+        states = dict((row[0], row[2]) for row in self.templates.templates())
+        self.assertEqual(['ready', 'ready'], [states[self.cs1], states[self.cs2]])
+
+    def testTakeOver(self):
+        """
+        a template left loading by a dead connection is taken over, but
+        only by whoever deletes its row first.
+        """
+        def left_loading():
+            self.cursor.execute("""
+insert into %s.templates (checksum, dbname, state, owner, created, last_used)
+values ('%s', '%s', 'loading', 0, now(), now())""" % (
+                    templatedb.REGISTRY_DB, self.cs1, self.templates.name(self.cs1)))
+            self.dbconn.commit()
+
+        self.templates.see_processes = True
+        left_loading()
+        self.assertTrue(self.templates.claim(self.cs1))
+        self.templates.abandon(self.cs1)
+
+        # somebody else takes it over and finishes between our looking
+        # and our delete
+        left_loading()
+        saved = self.templates._alive
+        def alive(owner):
+            self.templates._forget(self.cs1)
+            other = schemadiff.get_connection()
+            try:
+                other.cursor().execute("""
+insert into %s.templates (checksum, dbname, state, owner, created, last_used)
+values ('%s', '%s', 'ready', connection_id(), now(), now())""" % (
+                        templatedb.REGISTRY_DB, self.cs1, self.templates.name(self.cs1)))
+                other.commit()
+            finally:
+                other.close()
+            return False
+        self.templates._alive = alive
+        try:
+            self.assertFalse(self.templates.claim(self.cs1))
+        finally:
+            self.templates._alive = saved
+
+        # without PROCESS nobody looks dead
+        self.templates.see_processes = False
+        self.assertTrue(self.templates._alive(0))
+
+    def testValidate(self):
+        """
+        validate clones db1 and leaves the template alone.
+        """
+        self.assertEqual([], schemadiff.diff_schemas(self.cursor, self.schema1,
+                                                     self.schema2, self.db1, self.db2,
+                                                     dmlfile=None, validate=True,
+                                                     templates=self.templates))
+        template1 = self.templates.name(self.cs1)
+        self.assertEqual(schemadiff.dbchecksum(self.db1),
+                         schemadiff.dbchecksum(self.templates.name(self.cs2)))
+        self.assertNotEqual(schemadiff.dbchecksum(self.db1),
+                            schemadiff.dbchecksum(template1))
+
+        # nothing to look at when it worked
+        self.assertFalse(os.path.exists('%s.sql' % self.db1))
+
+    def testEvict(self):
+        self.templates.load([(self.cs1, self.schema1), (self.cs2, self.schema2)])
+        self.cursor.execute("update %s.templates set last_used = now() - interval 2 hour "
+                            "where checksum = '%s'" % (templatedb.REGISTRY_DB, self.cs1))
+        self.dbconn.commit()
+
+        # cs2 was just used, so it stays even though it doesn't fit
+        self.templates.max_templates = 0
+        self.templates.evict()
+        checksums = [row[0] for row in self.templates.templates()]
+        self.assertFalse(self.cs1 in checksums)
+        self.assertTrue(self.cs2 in checksums)
+
+        self.cursor.execute("show databases like '%s'" % self.templates.name(self.cs1))
+        self.assertEqual(0, len(self.cursor.fetchall()))
+
+
+class TestStatements(unittest.TestCase):
+    def statements(self, s):
+        return list(schemadiff.iter_statements(s))
+
+    def testSimple(self):
+        self.assertEqual(['create table a (x int)', 'create table b (y int)'],
+                         self.statements("create table a (x int);\n"
+                                         "create table b (y int);\n"))
+        self.assertEqual(['select 1'], self.statements("select 1"))
+
+    def testQuotes(self):
+        s = """CREATE TABLE `a;b` (
+  x varchar(10) DEFAULT ';' COMMENT 'it''s; really',
+  y varchar(10) DEFAULT "\\";" COMMENT 'back\\\\slash;\\';'
+);
+CREATE TABLE c (z int);"""
+        statements = self.statements(s)
+        self.assertEqual(2, len(statements))
+        self.assertTrue(statements[0].startswith("CREATE TABLE `a;b`"))
+        self.assertTrue(statements[0].endswith("'back\\\\slash;\\';'\n)"))
+        self.assertEqual("CREATE TABLE c (z int)", statements[1])
+
+    def testComments(self):
+        s = """-- a comment; with a semicolon
+# another one;
+/* and a
+   block; comment */
+CREATE TABLE a (
+  x int -- trailing; comment
+);
+SELECT 3--1;
+-- Dump completed
+"""
+        statements = self.statements(s)
+        self.assertEqual(2, len(statements))
+        self.assertTrue(statements[0].endswith("x int -- trailing; comment\n)"))
+        self.assertEqual("SELECT 3--1", statements[1])
+
+    def testVersionComments(self):
+        s = """/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET NAMES utf8 */;
+"""
+        self.assertEqual(
+            ["/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */",
+             "/*!40101 SET NAMES utf8 */"],
+            self.statements(s))
+
+    def testDelimiter(self):
+        s = """CREATE TABLE a (x int);
+DELIMITER ;;
+CREATE TRIGGER t BEFORE INSERT ON a FOR EACH ROW BEGIN
+  SET NEW.x = 1;
+END ;;
+delimiter ;
+CREATE TABLE b (y int);
+"""
+        statements = self.statements(s)
+        self.assertEqual(3, len(statements))
+        self.assertEqual("CREATE TABLE a (x int)", statements[0])
+        self.assertTrue(statements[1].endswith("SET NEW.x = 1;\nEND"))
+        self.assertEqual("CREATE TABLE b (y int)", statements[2])
+
+    def testFile(self):
+        s = "create table a (x int);\ncreate table b (y int)\n"
+        self.assertEqual(self.statements(s),
+                         self.statements(StringIO.StringIO(s)))
+
+    def testLoadUnits(self):
+        schema = "SET x = 1;\n" + TestLoad.schema + "SET y = 2;\n"
+        (preamble, units, trailer) = schemadiff._load_units(schema)
+        self.assertEqual(["SET x = 1"], preamble)
+        self.assertEqual(3, len(units))
+        self.assertEqual(["SET y = 2"], trailer)
+
+    def testLoadUnitsDump(self):
+        """
+        a unit from mysqldump has to run on a connection that has only
+        run the preamble.
+        """
+        table = """/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `%s` (
+  `id` int(11) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+"""
+        dump = """-- MySQL dump 10.13  Distrib 5.6.51, for Linux (x86_64)
+--
+-- Host: localhost    Database: db
+-- ------------------------------------------------------
+-- Server version	5.6.51
+
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET @OLD_CHARACTER_SET_RESULTS=@@CHARACTER_SET_RESULTS */;
+/*!40101 SET @OLD_COLLATION_CONNECTION=@@COLLATION_CONNECTION */;
+/*!40101 SET NAMES utf8 */;
+/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE */;
+/*!40103 SET TIME_ZONE='+00:00' */;
+/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;
+/*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;
+
+--
+-- Table structure for table `a`
+--
+
+""" + table % 'a' + """--
+-- Table structure for table `b`
+--
+
+""" + table % 'b' + """/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+
+/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
+/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
+/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;
+/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
+/*!40101 SET CHARACTER_SET_RESULTS=@OLD_CHARACTER_SET_RESULTS */;
+/*!40101 SET COLLATION_CONNECTION=@OLD_COLLATION_CONNECTION */;
+/*!40111 SET SQL_NOTES=@OLD_SQL_NOTES */;
+
+-- Dump completed on 2026-10-18 12:00:00
+"""
+        (preamble, units, trailer) = schemadiff._load_units(dump)
+        self.assertEqual(10, len(preamble))
+        self.assertTrue("/*!40101 SET NAMES utf8 */" in preamble)
+        self.assertEqual(2, len(units))
+        for (name, unit) in zip('ab', units):
+            self.assertEqual(4, len(unit))
+            self.assertTrue(unit[0].endswith("@saved_cs_client     = @@character_set_client */"))
+            self.assertEqual(name, schemastatements.statement_table(unit[2]))
+            self.assertTrue(unit[3].endswith("character_set_client = @saved_cs_client */"))
+        self.assertEqual(8, len(trailer))
+
+        (preamble, units, trailer) = schemadiff._load_units(dump, tables=set(['b']))
+        self.assertEqual(1, len(units))
+        self.assertEqual('b', schemastatements.statement_table(units[0][2]))
+
+    def testStatementTables(self):
+        self.assertEqual(['t'], schemastatements.statement_tables("CREATE TABLE `t` (a int)"))
+        self.assertEqual(['t'], schemastatements.statement_tables("-- x\nALTER TABLE db.t ADD c int"))
+        self.assertEqual(['t'], schemastatements.statement_tables("CREATE UNIQUE INDEX ib ON t (b)"))
+        self.assertEqual(['t'], schemastatements.statement_tables("DROP INDEX ib ON `t`"))
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         schemastatements.statement_tables("RENAME TABLE a TO b, c to `d`"))
+        self.assertEqual(['x', 'y'],
+                         schemastatements.statement_tables("DROP TABLE IF EXISTS `x`, y"))
+        self.assertEqual([], schemastatements.statement_tables("INSERT INTO t VALUES (1)"))
+        self.assertEqual([], schemastatements.statement_tables("SET NAMES utf8"))
+
+    def testLoadUnitsChanges(self):
+        """
+        an ALTER has to run after its table is created, and a DROP TABLE
+        IF EXISTS before it.
+        """
+        schema = """DROP TABLE IF EXISTS a;
+CREATE TABLE a (x int);
+ALTER TABLE a ADD y int;
+CREATE TABLE b (x int);
+CREATE INDEX ix ON b (x);
+"""
+        (preamble, units, trailer) = schemadiff._load_units(schema)
+        self.assertEqual([["DROP TABLE IF EXISTS a", "CREATE TABLE a (x int)"],
+                          ["CREATE TABLE b (x int)"]], units)
+        self.assertEqual(["ALTER TABLE a ADD y int", "CREATE INDEX ix ON b (x)"], trailer)
+
+        (preamble, units, trailer) = schemadiff._load_units(schema, tables=set(['b']))
+        self.assertEqual([["CREATE TABLE b (x int)"]], units)
+        self.assertEqual(["CREATE INDEX ix ON b (x)"], trailer)
+        self.assertEqual(["CREATE TABLE b (x int)", "CREATE INDEX ix ON b (x)"],
+                         list(schemadiff._schema_statements(schema, tables=set(['b']))))
+
+
+class TestNormalize(unittest.TestCase):
+    """
+    the in-process normalizer has to produce exactly what the shell
+    pipeline produces.  no database needed for these.
+    """
+
+    corpus = [
+        "",
+        "\n",
+        "a",
+        "a\n\n",
+        " x ( y , z ) = 1 ",
+        """-- MySQL dump 10.13  Distrib 5.6.27, for Linux (x86_64)
+--
+-- Host: localhost    Database: TestMisc_old
+-- ------------------------------------------------------
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET NAMES utf8 */;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `mytable` (
+  `adBrandId` int(11) NOT NULL AUTO_INCREMENT,
+  `title` varchar(128) COLLATE utf8_bin NOT NULL DEFAULT '',
+  `description` text NOT NULL COMMENT 'i don''t like, this (comment)',
+  PRIMARY KEY (`adBrandId`),
+  KEY `idxTitle_AdBrand` (`title`)
+) ENGINE=InnoDB AUTO_INCREMENT=42 DEFAULT CHARSET=utf8 DEFAULT COLLATE=utf8_bin COMMENT='tbl';
+/*!40101 SET character_set_client = @saved_cs_client */;
+""",
+        """CREATE TABLE `t` (
+  `c` int
+) %DB_COLLATION_CREATE_TABLE_COMMON%;
+DELIMITER $$
+  $$
+AUTO_INCREMENT=5
+ AUTO_INCREMENT=5 x
+SETTINGS stay out
+\t\t
+\r
+""",
+        "COMMENT 'a' b 'c'\nx COMMENT='y'\nDEFAULT   COLLATE = latin1_bin , k",
+        ]
+
+    def testCorpus(self):
+        for s in self.corpus:
+            self.assertEqual(schemadiff.normalize(s, shell=True),
+                             schemadiff.normalize(s, shell=False))
+
+    def testGarbage(self):
+        """
+        random text made out of the things the pipeline cares about.
+        """
+        pieces = list("aAbZ sSETc-=,()%'\t\n$_019") + [
+            'COMMENT ', 'comment ', 'COLLATE ', 'DEFAULT ', ' AUTO_INCREMENT=',
+            'SET ', '--', '\r', '\x0b']
+        rng = random.Random(1234)
+        for i in range(200):
+            s = ''.join(rng.choice(pieces) for j in range(rng.randint(0, 80)))
+            self.assertEqual(schemadiff.normalize(s, shell=True),
+                             schemadiff.normalize(s, shell=False))
+
+
+class TestStreaming(unittest.TestCase):
+    """
+    streaming normalization and checksums have to agree with the
+    whole-string versions.
+    """
+
+    def oldChecksum(self, s):
+        lines = schemadiff.normalize(s, shell=True).split('\n')
+        return schemadiff.shacmd('\n'.join(sorted(lines)))
+
+    def testChecksum(self):
+        for s in TestNormalize.corpus:
+            control = self.oldChecksum(s)
+            self.assertEqual(control, schemadiff.schemachecksum(s))
+            self.assertEqual(control,
+                             schemadiff.schemachecksum(StringIO.StringIO(s)))
+
+    def testNormalizedLines(self):
+        for s in TestNormalize.corpus:
+            lines = schemadiff.iter_normalized(StringIO.StringIO(s))
+            self.assertEqual(schemadiff.normalize(s),
+                             ''.join(l + '\n' for l in lines))
+
+    def testExternalSort(self):
+        rng = random.Random(99)
+        lines = [''.join(rng.choice('abcxyz_019') for j in range(rng.randint(0, 12)))
+                 for i in range(1000)]
+        self.assertEqual(sorted(lines),
+                         list(schemadiff._sorted_lines(lines, bufsize=50)))
+
+
+class TestManifest(unittest.TestCase):
+    schema = """CREATE TABLE `t1` (
+  `a` int(11) NOT NULL,
+  PRIMARY KEY (`a`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS t2 (
+  b varchar(10) DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+"""
+
+    def testChecksum(self):
+        (cs, digests) = schemadiff.schemamanifest(self.schema)
+        self.assertEqual(schemadiff.schemachecksum(self.schema), cs)
+        self.assertEqual(set(['t1', 't2']), set(digests.keys()))
+
+    def testOneTableChanged(self):
+        changed = self.schema.replace('varchar(10)', 'varchar(20)')
+        (cs1, digests1) = schemadiff.schemamanifest(self.schema)
+        (cs2, digests2) = schemadiff.schemamanifest(changed)
+        self.assertNotEqual(cs1, cs2)
+        self.assertEqual(digests1['t1'], digests2['t1'])
+        self.assertNotEqual(digests1['t2'], digests2['t2'])
+
+    def testLaterStatements(self):
+        """
+        an index or column added after the CREATE TABLE changes the
+        table's digest, and only that table's.
+        """
+        (cs1, digests1) = schemadiff.schemamanifest(self.schema)
+        for later in ["CREATE INDEX ib ON t2 (b);\n",
+                      "ALTER TABLE `t2`\n  ADD COLUMN c int;\n",
+                      "RENAME TABLE t2 TO t3;\n"]:
+            (cs2, digests2) = schemadiff.schemamanifest(self.schema + later)
+            self.assertNotEqual(cs1, cs2)
+            self.assertEqual(digests1['t1'], digests2['t1'])
+            self.assertNotEqual(digests1['t2'], digests2['t2'])
+            self.assertNotEqual(schemadiff.schemamultiset(self.schema)[1]['t2'],
+                                schemadiff.schemamultiset(self.schema + later)[1]['t2'])
+
+    def testUnchangedTables(self):
+        changed = self.schema.replace('varchar(10)', 'varchar(20)')
+        (cs1, digests1) = schemadiff.schemamanifest(self.schema)
+        (cs2, digests2) = schemadiff.schemamanifest(changed)
+        self.assertEqual(set(['t1']),
+                         schemadiff.unchanged_tables(digests1, digests2))
+        self.assertEqual(set(), schemadiff.unchanged_tables(None, digests2))
+
+    def testTablesToLoad(self):
+        schema1 = """CREATE TABLE a (
+  id int NOT NULL PRIMARY KEY
+);
+CREATE TABLE b (
+  id int NOT NULL PRIMARY KEY,
+  a_id int,
+  CONSTRAINT fk_b_a FOREIGN KEY (a_id) REFERENCES `a` (id)
+);
+CREATE TABLE c (
+  id int NOT NULL PRIMARY KEY,
+  b_id int,
+  CONSTRAINT fk_c_b FOREIGN KEY (b_id) REFERENCES b (id)
+);
+CREATE TABLE d (
+  id int NOT NULL PRIMARY KEY
+);
+CREATE TABLE dropped (
+  id int NOT NULL PRIMARY KEY
+);
+"""
+        schema2 = schema1.replace("c (\n  id int", "c (\n  id bigint")
+        schema2 = schema2.replace("dropped", "added")
+
+        (cs1, digests1) = schemadiff.schemamanifest(schema1)
+        (cs2, digests2) = schemadiff.schemamanifest(schema2)
+        tables = schemadiff.tables_to_load(schema1, schema2, digests1, digests2)
+        self.assertEqual(set(['a', 'b', 'c', 'dropped', 'added']), tables)
+
+    def testTablesToLoadLater(self):
+        """
+        a table changed only by a statement after its CREATE TABLE still
+        has to be loaded, along with every table a RENAME names.
+        """
+        schema1 = """CREATE TABLE t (
+  a int,
+  b int
+);
+CREATE TABLE u (
+  a int
+);
+"""
+        schema2 = schema1 + "CREATE INDEX ib ON t (b);\n"
+        (cs1, digests1) = schemadiff.schemamanifest(schema1)
+        (cs2, digests2) = schemadiff.schemamanifest(schema2)
+        self.assertEqual(set(['t']),
+                         schemadiff.tables_to_load(schema1, schema2, digests1, digests2))
+
+        schema2 = schema1 + "RENAME TABLE u TO v, t TO u, v TO t;\n"
+        (cs2, digests2) = schemadiff.schemamanifest(schema2)
+        self.assertEqual(set(['t', 'u', 'v']),
+                         schemadiff.tables_to_load(schema1, schema2, digests1, digests2))
+
+    def testMultiset(self):
+        (checksum, tables) = schemadiff.schemamultiset(self.schema)
+        self.assertEqual(set(['t1', 't2']), set(tables.keys()))
+
+        # order doesn't matter
+        (t1, t2) = self.schema.split('\n\n')
+        self.assertEqual(checksum, schemadiff.schemamultiset(t2 + '\n' + t1)[0])
+
+        m = schemadiff.MultisetChecksum()
+        schemadiff.schemamanifest(self.schema, multiset=m)
+        self.assertEqual(checksum, m)
+
+        # taking out a table, by its lines or its checksum, leaves the
+        # checksum of what's left
+        m = checksum.copy()
+        m.remove_table(t1)
+        self.assertEqual(schemadiff.schemamultiset(t2)[0], m)
+        m = checksum.copy()
+        m.remove(tables['t1'])
+        self.assertEqual(schemadiff.schemamultiset(t2)[0], m)
+
+        # applying a change keeps it current without renormalizing
+        changed = self.schema.replace('varchar(10)', 'varchar(20)')
+        m = checksum.copy()
+        m.remove(tables['t2'])
+        m.add_table(t2.replace('varchar(10)', 'varchar(20)'))
+        self.assertEqual(schemadiff.schemamultiset(changed)[0], m)
+        self.assertNotEqual(checksum, m)
+
+        # a repeated line counts twice
+        once = schemadiff.MultisetChecksum()
+        once.add_line('a')
+        twice = schemadiff.MultisetChecksum()
+        twice.add_lines(['a', 'a'])
+        self.assertNotEqual(once, twice)
+        twice.remove_line('a')
+        self.assertEqual(once, twice)
+
+    def testMultisetAgrees(self):
+        """
+        the multiset checksum and schemachecksum() have to agree about
+        which schemas are the same.
+        """
+        variants = [self.schema,
+                    self.schema.replace('varchar(10)', 'varchar(20)'),
+                    self.schema.replace('`a` int(11) NOT NULL,', '`a` int(11) NOT NULL,\n  `c` int,'),
+                    self.schema.replace('  ', '    ').replace('NOT NULL', 'not null'),
+                    self.schema.replace(' AUTO_INCREMENT=5', ''),
+                    self.schema.replace(') ENGINE=InnoDB DEFAULT CHARSET=utf8;',
+                                        ') ENGINE=InnoDB AUTO_INCREMENT=5 DEFAULT CHARSET=utf8;'),
+                    '\n\n'.join(reversed(self.schema.split('\n\n')))]
+        for a in variants:
+            for b in variants:
+                self.assertEqual(schemadiff.schemachecksum(a) == schemadiff.schemachecksum(b),
+                                 schemadiff.schemamultiset(a)[0] == schemadiff.schemamultiset(b)[0])
+
+    def testNormalizedFile(self):
+        nml = StringIO.StringIO()
+        schemadiff.schemamanifest(self.schema, nml)
+        self.assertEqual(schemadiff.normalize(self.schema), nml.getvalue())
+
+
+class TestSchemaCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testHit(self):
+        cache = schemacache.SchemaCache(self.dir)
+        control = schemadiff.schemamanifest(TestManifest.schema)
+        self.assertEqual(control, cache.manifest(TestManifest.schema))
+
+        # a second cache object on the same directory must not
+        # normalize anything.
+        cache = schemacache.SchemaCache(self.dir)
+        saved = schemadiff.schemamanifest
+        def boom(*args):
+            raise AssertionError("normalized on a cache hit")
+        schemadiff.schemamanifest = boom
+        try:
+            self.assertEqual(control, cache.manifest(TestManifest.schema))
+        finally:
+            schemadiff.schemamanifest = saved
+
+        key = cache.key(TestManifest.schema)
+        self.assertEqual(schemadiff.normalize(TestManifest.schema),
+                         cache.normalized(key))
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def testEviction(self):
+        cache = schemacache.SchemaCache(self.dir, max_bytes=1)
+        cache.manifest(TestManifest.schema)
+        self.assertEqual(0, cache.stats()['entries'])
+
+        cache = schemacache.SchemaCache(self.dir)
+        schemas = [TestManifest.schema.replace('t2', 't%d' % i) for i in range(3)]
+        for s in schemas:
+            cache.manifest(s)
+        entries = cache._entries()
+        self.assertEqual(3, len(entries))
+
+        # make the first one the oldest, then shrink the cache to fit two
+        first = cache.key(schemas[0])
+        os.utime(cache._path(first, 'json'), (0, 0))
+        cache.max_bytes = sum(e[1] for e in entries) - 1
+        cache.evict()
+        self.assertEqual(None, cache.get(first))
+        self.assertEqual(2, cache.stats()['entries'])
+
+    def testPlanCache(self):
+        old = TestOffline.ref
+        new = old.replace('column2 int', 'column2 bigint')
+        (fd, dmlfile) = tempfile.mkstemp(dir=self.dir)
+        os.close(fd)
+
+        def diff(db1):
+            schemadiff.diff_schemas(None, old, new, db1, 'new', dmlfile=dmlfile,
+                                    validate=False, offline=True,
+                                    plan_cache=schemacache.PlanCache(self.dir))
+            with open(dmlfile) as f:
+                return f.read()
+
+        first = diff('old')
+        self.assertEqual(1, schemacache.PlanCache(self.dir).stats()['entries'])
+
+        saved = schemadiff.iter_plan
+        def boom(*args, **kwargs):
+            raise AssertionError("diffed on a plan cache hit")
+        schemadiff.iter_plan = boom
+        try:
+            self.assertEqual(first, diff('old'))
+            self.assertEqual(first.replace('USE old;', 'USE other;'), diff('other'))
+        finally:
+            schemadiff.iter_plan = saved
+
+        stats = schemacache.PlanCache(self.dir).stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+        # a different tool version is a different plan
+        cache = schemacache.PlanCache(self.dir)
+        key = cache.key('a', 'b', offline=True)
+        saved = schemadiff.PLAN_VERSION
+        schemadiff.PLAN_VERSION += 1
+        try:
+            self.assertNotEqual(key, cache.key('a', 'b', offline=True))
+        finally:
+            schemadiff.PLAN_VERSION = saved
+
+        cache.max_bytes = 1
+        cache.evict()
+        self.assertEqual(0, cache.stats()['entries'])
+
+    def testTableCache(self):
+        """
+        a table diffed for one pair of schemas isn't diffed again for
+        another pair it's the same in.
+        """
+        shared1 = TestOffline.ref
+        shared2 = shared1.replace('column2 int', 'column2 bigint')
+        other = """CREATE TABLE `other` (
+  x int
+) ENGINE=InnoDB"""
+
+        def diff(schema1, schema2, model2=None):
+            cache = schemacache.TableDiffCache(self.dir)
+            (cs1, digests1) = schemadiff.schemamanifest(schema1)
+            (cs2, digests2) = schemadiff.schemamanifest(schema2)
+            catalog = schemamodel.ModelCatalog({
+                    'a' : ddlparse.parse_schema(schema1),
+                    'b' : ddlparse.parse_schema(model2 or schema2),
+                    })
+            plan = list(schemadiff.iter_plan(catalog, 'a', 'b', digests1, digests2,
+                                             table_cache=cache))
+            cache.flush()
+            return (plan, cache)
+
+        (plan, cache) = diff(shared1, shared2)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+        saved = schemadiff._table_statements
+        def boom(catalog, table, *args):
+            if table == 'reftable':
+                raise AssertionError("diffed reftable again")
+            return saved(catalog, table, *args)
+        schemadiff._table_statements = boom
+        try:
+            (again, cache) = diff(';\n'.join([shared1, other]),
+                                  ';\n'.join([shared2, other.replace('x int', 'x bigint')]))
+        finally:
+            schemadiff._table_statements = saved
+
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual([(r['sql'], r['operations']) for r in plan[1:]],
+                         [(r['sql'], r['operations']) for r in again
+                          if r['table'] == 'reftable'])
+        self.assertEqual(3, len(again))
+
+        stats = cache.stats()
+        self.assertEqual(2, stats['entries'])
+        self.assertEqual((1, 2), (stats['hits'], stats['misses']))
+
+        # a server-backed diff of the same table doesn't get the offline one
+        saved = schemadiff._table_steps
+        options = []
+        def steps(*args):
+            options.append(args[-1])
+            return saved(*args)
+        schemadiff._table_steps = steps
+        try:
+            diff(shared1, shared2)
+        finally:
+            schemadiff._table_steps = saved
+        self.assertEqual([{ 'offline' : True, 'catalog' : 'ModelCatalog' }], options)
+        self.assertNotEqual(cache.key('reftable', 'a', 'b', True, **options[0]),
+                            cache.key('reftable', 'a', 'b', True, offline=False,
+                                      catalog='information_schema'))
+
+        # a column added by an ALTER after the CREATE TABLE isn't a hit
+        # on the diff without it.  ddlparse doesn't apply ALTERs, so the
+        # model comes from the table as the server would have it.
+        altered = shared2 + ";\nALTER TABLE reftable ADD COLUMN c int"
+        (plan, cache) = diff(shared1, altered,
+                             shared2.replace('column2 bigint', 'column2 bigint,\n  c int'))
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        self.assertTrue([r for r in plan if 'ADD COLUMN c ' in r['sql']])
+
+
+class TestOffline(unittest.TestCase):
+    """
+    diff schemas without a server.  the expected DML is the same the
+    server-backed tests above expect.
+    """
+    db1 = 'TestOffline_old'
+    db2 = 'TestOffline_new'
+
+    ref = """CREATE TABLE `reftable` (
+  column1 int not null default 0,
+  column2 int not null default 0,
+  PRIMARY KEY(column1, column2)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+    def catalog(self, schema1, schema2):
+        return schemamodel.ModelCatalog({
+                self.db1 : ddlparse.parse_schema(schema1),
+                self.db2 : ddlparse.parse_schema(schema2),
+                })
+
+    def testImplicitDefaults(self):
+        t = ddlparse.parse_create_table("""CREATE TABLE t (
+  id int unsigned auto_increment primary key,
+  a timestamp,
+  b timestamp,
+  c decimal(5,2) default 1.5,
+  d bool,
+  KEY (a),
+  KEY (a, b)
+) ENGINE=innodb""")
+        self.assertEqual(['id int(10) unsigned NOT NULL auto_increment',
+                          'a timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP',
+                          "b timestamp NOT NULL DEFAULT '0000-00-00 00:00:00'",
+                          'c decimal(5,2) DEFAULT 1.50',
+                          'd tinyint(1)'],
+                         [c.definition() for c in t.columns])
+        self.assertEqual(['PRIMARY', 'a', 'a_2'], [i.name for i in t.indexes])
+        self.assertEqual('InnoDB', t.engine)
+
+    def testImplicitFKIndex(self):
+        t = ddlparse.parse_create_table("""CREATE TABLE mytable (
+  column1 int not null default 0,
+  column2 int not null default 0,
+  foreign key (column1, column2) REFERENCES reftable(column1, column2)
+) ENGINE=InnoDB""")
+        self.assertEqual(['column1'], [i.name for i in t.indexes])
+        self.assertEqual(['mytable_ibfk_1'], [fk.name for fk in t.fks])
+
+        # MyISAM keeps the index but not the constraint
+        t = ddlparse.parse_create_table(t.create_statement().replace(
+                'InnoDB', 'MyISAM'))
+        self.assertEqual(['column1'], [i.name for i in t.indexes])
+        self.assertEqual((), t.fks)
+
+    def testUnnamedIndexes(self):
+        t = ddlparse.parse_create_table("""CREATE TABLE t (
+  userId int,
+  KEY (userId),
+  KEY (userId),
+  UNIQUE KEY (userId)
+) ENGINE=InnoDB""")
+        self.assertEqual(['userId', 'userId_2', 'userId_3'],
+                         [i.name for i in t.indexes])
+        self.assertEqual(2, len(t.plain_indexes()))
+
+    def testCompare(self):
+        """
+        definitions compare field by field, however they were spelled.
+        """
+        t1 = ddlparse.parse_create_table("""CREATE TABLE t (
+  id INT NOT NULL,
+  name VARCHAR(10) DEFAULT 'x',
+  PRIMARY KEY (id),
+  KEY name (name(5))
+)""")
+        t2 = ddlparse.parse_create_table("""create table `t` (
+  `id` int(11) not null primary key,
+  `name` varchar(10) default "x",
+  index `name` (`name`(5))
+) engine=InnoDB""")
+        self.assertEqual(t1, t2)
+        self.assertFalse(hasattr(t1.columns[0], '__dict__'))
+
+        t3 = ddlparse.parse_create_table("""CREATE TABLE t (
+  id int NOT NULL PRIMARY KEY,
+  name varchar(10) DEFAULT 'y',
+  KEY name (name(5))
+)""")
+        self.assertNotEqual(t1, t3)
+        self.assertEqual(t1.columns[0], t3.columns[0])
+        self.assertNotEqual(t1.columns[1], t3.columns[1])
+        self.assertEqual(t1.indexes, t3.indexes)
+
+    def testChangeFK(self):
+        t1 = """CREATE TABLE `mytable` (
+  column1 int not null default 0,
+  column2 int not null default 0,
+  KEY fk (column1, column2),
+  CONSTRAINT `fk` foreign key(column1, column2) REFERENCES reftable(column1, column2)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+        t2 = t1.replace("foreign key(column1, column2) REFERENCES reftable(column1, column2)",
+                        "foreign key(column1) REFERENCES reftable(column1)")
+
+        catalog = self.catalog(';\n'.join([self.ref, t1]),
+                               ';\n'.join([self.ref, t2]))
+        dmls = schemadiff.diff_table(catalog, 'mytable', self.db1, self.db2)
+        self.assertEqual(["ALTER TABLE mytable DROP FOREIGN KEY fk;",
+                          "ALTER TABLE mytable ADD CONSTRAINT fk FOREIGN KEY (column1) REFERENCES reftable(column1);"],
+                         dmls)
+
+    def testDiffDatabases(self):
+        t1 = """CREATE TABLE `mytable` (
+  `objectType` int(11) NOT NULL,
+  `objectId` bigint(20) NOT NULL,
+  `deleteDate` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+        t2 = t1.replace("  `objectId` bigint(20) NOT NULL,\n", "")
+
+        catalog = self.catalog(t1, ';\n'.join([t2, self.ref]))
+        dmls = schemadiff.diff_databases(catalog, self.db1, self.db2)
+        self.assertEqual("USE %s;" % self.db1, dmls[0])
+        self.assertEqual(3, len(dmls))
+        self.assertEqual(ddlparse.parse_create_table(self.ref).create_statement() + ';',
+                         dmls[1])
+        self.assertEqual("ALTER TABLE mytable\n\tDROP COLUMN objectId\n\t;", dmls[2])
+
+        # what we say about the new table has to parse back to itself
+        t = ddlparse.parse_create_table(dmls[1])
+        self.assertEqual(dmls[1], t.create_statement() + ';')
+
+    def testStream(self):
+        """
+        statements come out table by table, before later tables are even
+        looked at.
+        """
+        t = """CREATE TABLE `t%d` (
+  column1 int not null
+) ENGINE=InnoDB"""
+        catalog = self.catalog(';\n'.join(t % i for i in range(3)),
+                               ';\n'.join((t % i).replace('int', 'bigint')
+                                          for i in range(3)))
+        expected = schemadiff.diff_databases(catalog, self.db1, self.db2)
+        self.assertEqual(4, len(expected))
+
+        diffed = []
+        table = catalog.table
+        def counting_table(db, name):
+            diffed.append(name)
+            return table(db, name)
+        catalog.table = counting_table
+
+        dmls = schemadiff.iter_diff_databases(catalog, self.db1, self.db2,
+                                              use='elsewhere')
+        self.assertEqual("USE elsewhere;", dmls.next())
+        self.assertEqual([], diffed)
+        self.assertEqual(expected[1], dmls.next())
+        self.assertEqual(1, len(set(diffed)))
+        self.assertEqual(expected[2:], list(dmls))
+
+    def testOrder(self):
+        """
+        the same schemas always give the same statements in the same
+        order, however python happens to order its sets.
+        """
+        t = """CREATE TABLE `%s` (
+  c int not null,
+  k1 int,
+  k2 int
+) ENGINE=InnoDB"""
+        names = ['t%d' % i for i in range(20)]
+        old = ';\n'.join(t % n for n in names[:10])
+        new = ';\n'.join((t % n).replace('  k2 int', '  k2 int,\n  KEY b (k1),\n  KEY a (k2)')
+                         for n in names[5:])
+        dmls = schemadiff.diff_databases(self.catalog(old, new), self.db1, self.db2)
+
+        self.assertEqual(["DROP TABLE %s;" % n for n in sorted(names[:5])], dmls[1:6])
+        self.assertEqual(sorted(names[10:]),
+                         [ddlparse.parse_create_table(d).name for d in dmls[6:16]])
+        self.assertEqual(["ALTER TABLE %s\n\tADD KEY a(k2),\n\tADD KEY b(k1)\n\t;" % n
+                          for n in sorted(names[5:10])],
+                         dmls[16:])
+
+    def testPlan(self):
+        t1 = """CREATE TABLE `mytable` (
+  column1 int not null default 0,
+  column2 int not null default 0,
+  column3 int,
+  PRIMARY KEY (column1),
+  KEY k2 (column2)
+) ENGINE=InnoDB"""
+        t2 = """CREATE TABLE `mytable` (
+  column1 int not null default 1,
+  column2 int not null default 0,
+  column3 bigint,
+  PRIMARY KEY (column1),
+  KEY k3 (column3)
+) ENGINE=InnoDB"""
+        gone = "CREATE TABLE `gone` (x int) ENGINE=InnoDB"
+
+        catalog = self.catalog(';\n'.join([t1, gone]), ';\n'.join([t2, self.ref]))
+        plan = list(schemadiff.iter_plan(catalog, self.db1, self.db2))
+        self.assertEqual(schemadiff.diff_databases(catalog, self.db1, self.db2),
+                         [r['sql'] for r in plan])
+        self.assertEqual(range(len(plan)), [r['seq'] for r in plan])
+
+        records = dict(((r['table'], tuple(r['kinds'])), r) for r in plan)
+        self.assertEqual('none', records[(None, ())]['cost'])
+        self.assertEqual('metadata', records[('gone', ('drop_table',))]['cost'])
+        self.assertEqual('metadata', records[('reftable', ('create_table',))]['cost'])
+        self.assertEqual('metadata', records[('mytable', ('drop_index',))]['cost'])
+
+        r = records[('mytable', ('add_index', 'modify_column'))]
+        self.assertEqual('rebuild', r['cost'])
+        self.assertTrue(r['rebuild'])
+        ops = dict((op['name'], op) for op in r['operations'])
+        self.assertEqual({ 'kind' : 'modify_column',
+                           'name' : 'column3',
+                           'source' : '`column3` int(11) DEFAULT NULL',
+                           'target' : '`column3` bigint(20) DEFAULT NULL',
+                           'cost' : 'rebuild' },
+                         ops['column3'])
+        self.assertEqual('KEY `k3` (`column3`)', ops['k3']['target'])
+
+        # a new default alone doesn't copy the table
+        change = schemadiff.Change(None, 'modify_column', 'column1',
+                                   catalog.table(self.db1, 'mytable').columns[0],
+                                   catalog.table(self.db2, 'mytable').columns[0])
+        self.assertEqual('metadata', schemadiff._change_cost(change))
+
+        # adding a foreign key copies the table unless fk checks are off
+        self.assertEqual('rebuild', schemadiff._change_cost(
+                schemadiff.Change(None, 'add_fk', 'fk', None, None)))
+
+        # records have to survive json
+        out = StringIO.StringIO()
+        for r in plan:
+            schemadiff.write_plan_record(out, r)
+        self.assertEqual(plan, [json.loads(l) for l in out.getvalue().splitlines()])
+
+    def testSnapshotPlan(self):
+        """
+        plans from information_schema rows describe keys the way SHOW
+        CREATE TABLE would.
+        """
+        def rows(indexes):
+            return ([('t', 'InnoDB')],
+                    [('t', 'id', 'int(11)', 'NO', None, '', ''),
+                     ('t', 'a', 'int(11)', 'YES', None, '', '')],
+                    [('t', 'PRIMARY', 'PRIMARY KEY'), ('t', 'ua', 'UNIQUE')],
+                    [('t', name, 'a' if name != 'PRIMARY' else 'id', None)
+                     for name in indexes],
+                    [])
+        schemas = schemadiff.build_schemas(
+            [self.db1, self.db2],
+            rows(['PRIMARY', 'ua']) + ([], [], [], [], []))
+        plan = list(schemadiff.iter_plan(schemamodel.ModelCatalog(schemas),
+                                         self.db1, self.db2))
+
+        [op] = plan[1]['operations']
+        self.assertEqual('drop_table', op['kind'])
+        self.assertEqual("CREATE TABLE `t` (\n"
+                         "  `id` int(11) NOT NULL,\n"
+                         "  `a` int(11) DEFAULT NULL,\n"
+                         "  PRIMARY KEY (`id`),\n"
+                         "  UNIQUE KEY `ua` (`a`)\n"
+                         ") ENGINE=InnoDB", op['source'])
+
+        schemas = schemadiff.build_schemas(
+            [self.db1, self.db2], rows(['PRIMARY']) + rows(['PRIMARY', 'ua']))
+        plan = list(schemadiff.iter_plan(schemamodel.ModelCatalog(schemas),
+                                         self.db1, self.db2))
+        [op] = plan[1]['operations']
+        self.assertEqual('UNIQUE KEY `ua` (`a`)', op['target'])
+
+    def testWaves(self):
+        old = """CREATE TABLE parent (id int not null, PRIMARY KEY (id)) ENGINE=InnoDB;
+CREATE TABLE child (id int not null, parent_id int) ENGINE=InnoDB;
+CREATE TABLE other (x int) ENGINE=InnoDB;
+CREATE TABLE gone (parent_id int,
+  CONSTRAINT gone_fk FOREIGN KEY (parent_id) REFERENCES parent (id)) ENGINE=InnoDB"""
+        new = """CREATE TABLE parent (id int not null, name int, PRIMARY KEY (id)) ENGINE=InnoDB;
+CREATE TABLE child (id int not null, parent_id int, KEY p (parent_id),
+  CONSTRAINT child_fk FOREIGN KEY (parent_id) REFERENCES parent (id)) ENGINE=InnoDB;
+CREATE TABLE other (x bigint) ENGINE=InnoDB;
+CREATE TABLE added (x int) ENGINE=InnoDB"""
+
+        plan = list(schemadiff.iter_plan(self.catalog(old, new), self.db1, self.db2))
+        waves = schemadiff.plan_waves(plan)
+        self.assertEqual([['gone', 'added', 'child', 'other'], ['parent']],
+                         [[table for (table, records) in wave] for wave in waves])
+
+        # nothing lost or reordered
+        self.assertEqual([r for r in plan if r['table'] is not None],
+                         sorted([r for wave in waves for (table, records) in wave
+                                 for r in records], key=lambda r: r['seq']))
+        self.assertEqual(set(['parent']),
+                         schemadiff._plan_references(dict(waves[0])['child'][0]))
+
+        self.assertEqual([], schemadiff.plan_waves(plan[:1]))
+
+        fk = ("CONSTRAINT `c_fk` FOREIGN KEY (`p`) REFERENCES `my-parent` (`id`)")
+        self.assertEqual(set(['my-parent']), schemadiff._plan_references(
+                { 'sql' : 'ALTER TABLE c DROP FOREIGN KEY c_fk;',
+                  'operations' : [{ 'source' : fk, 'target' : None }] }))
+        self.assertEqual({ 'c' : set(['my-parent']) }, schemadiff.fk_references(
+                "CREATE TABLE `c` (\n  `p` int,\n  %s\n) ENGINE=InnoDB;\n" % fk))
+
+    def testDiffSchemas(self):
+        (fd, dmlfile) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            schemadiff.diff_schemas(None, self.ref,
+                                    self.ref.replace('column2 int', 'column2 bigint'),
+                                    self.db1, self.db2,
+                                    dmlfile=dmlfile, validate=False, offline=True)
+            with open(dmlfile) as f:
+                dmls = f.read()
+        finally:
+            os.remove(dmlfile)
+
+        self.assertEqual("USE %s;\n"
+                         "ALTER TABLE reftable\n\tMODIFY COLUMN column2 bigint(20) NOT NULL DEFAULT 0\n\t;\n" % self.db1,
+                         dmls)
+
+        self.assertRaises(ValueError, schemadiff.diff_schemas, None, self.ref, '',
+                          self.db1, self.db2, dmlfile=None, validate=True,
+                          offline=True)
+
+    def testDiffArguments(self):
+        """
+        what the command line tools hand diff_schemas().
+        """
+        parser = argparse.ArgumentParser()
+        schemadiff.add_diff_arguments(parser)
+        (fd, dmlfile) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            args = parser.parse_args(['--offline', '--templates', '--workers', '2',
+                                      '--dmlfile', dmlfile])
+            kwargs = schemadiff.diff_kwargs(args)
+            self.assertEqual((dmlfile, True, 2, None, None),
+                             (kwargs['dmlfile'], kwargs['offline'], kwargs['workers'],
+                              kwargs['cache'], kwargs['templates']))
+            schemadiff.diff_schemas(None, self.ref,
+                                    self.ref.replace('column2 int', 'column2 bigint'),
+                                    self.db1, self.db2, **kwargs)
+            with open(dmlfile) as f:
+                self.assertTrue("MODIFY COLUMN column2 bigint(20)" in f.read())
+        finally:
+            os.remove(dmlfile)
+
+
+class RecordingCursor(object):
+    """
+    a cursor that remembers the CREATE TABLEs run in each database, so
+    the tables a test builds on the server can also be parsed offline.
+    once anything else changes a table, nothing is trusted any more.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.db = None
+        self.creates = {}
+        self.dirty = False
+
+    def execute(self, query, *args):
+        words = query.split(None, 2)
+        verb = ' '.join(words[:2]).lower()
+        if words[0].lower() == 'use':
+            self.db = words[1].rstrip(';')
+        elif verb == 'create table':
+            self.creates.setdefault(self.db, []).append(query)
+        elif verb.split()[0] in ('alter', 'drop', 'rename') and verb != 'drop database':
+            self.dirty = True
+        return self.cursor.execute(query, *args)
+
+    def catalog(self, *dbs):
+        return schemamodel.ModelCatalog(dict(
+                (db, ddlparse.parse_schema(';\n'.join(self.creates.get(db, []))))
+                for db in dbs))
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class NullCursor(object):
+    """
+    a cursor with no server behind it:  statements go nowhere and
+    queries come back empty.
+    """
+    connection = None
+    rowcount = 0
+
+    def execute(self, query, *args):
+        return 0
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class NullConnection(object):
+    def cursor(self):
+        return NullCursor()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay(cases, diff_table):
+    """
+    run the tests in cases with self.cursor a RecordingCursor and
+    diff_table() standing in for schemadiff.diff_table.  returns the
+    unittest.TestResult.
+    """
+    def setUp(self):
+        SchemaDiffTest.setUp(self)
+        self.cursor = RecordingCursor(self.cursor)
+
+    saved = schemadiff.diff_table
+    schemadiff.diff_table = diff_table
+    try:
+        suite = unittest.TestSuite()
+        for case in cases:
+            replayed = type(case.__name__, (case,), { 'setUp' : setUp })
+            suite.addTests(unittest.TestLoader().loadTestsFromTestCase(replayed))
+        result = unittest.TestResult()
+        suite.run(result)
+    finally:
+        schemadiff.diff_table = saved
+    return result
+
+
+class TestOfflineParity(unittest.TestCase):
+    """
+    replay the server-backed diff tests, and check that every
+    diff_table() they do comes out the same when the tables are parsed
+    with ddlparse instead.
+    """
+    cases = [TestColumnDiffDML, TestColumnDiff, TestIndexDiffDML, TestIndexDiff,
+             TestDrop, TestUniqueIndex, TestFKDiffDML, TestFKDiff, TestEngine]
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            schemadiff.get_connection().close()
+        except Exception as e:
+            raise unittest.SkipTest("no server to replay against: %s" % e)
+
+    def testParity(self):
+        compared = []
+        saved = schemadiff.diff_table
+        def diff_table(cursor, table, db1, db2, *args):
+            dmls = saved(cursor, table, db1, db2, *args)
+            if isinstance(cursor, RecordingCursor) and not cursor.dirty:
+                compared.append((table, dmls,
+                                 saved(cursor.catalog(db1, db2), table, db1, db2,
+                                       *args)))
+            return dmls
+
+        result = replay(self.cases, diff_table)
+        self.assertEqual([], [str(test) for (test, e) in result.errors + result.failures])
+        self.assertTrue(len(compared) > 0)
+        for (table, server, offline) in compared:
+            self.assertEqual(server, offline, table)
+
+
+class TestOfflineDML(unittest.TestCase):
+    """
+    replay the tests that check diff_table()'s DML without a server:
+    nothing is run, and diff_table() diffs what ddlparse makes of the
+    CREATE TABLEs the tests would have run, so it has to come up with
+    the DML they expect.
+    """
+    cases = [TestColumnDiffDML, TestIndexDiffDML, TestFKDiffDML]
+
+    def testReplay(self):
+        tables = []
+        saved = schemadiff.diff_table
+        def diff_table(cursor, table, db1, db2, *args):
+            self.assertFalse(cursor.dirty)
+            tables.append(table)
+            return saved(cursor.catalog(db1, db2), table, db1, db2, *args)
+
+        saved_connection = schemadiff.get_connection
+        schemadiff.get_connection = NullConnection
+        try:
+            result = replay(self.cases, diff_table)
+        finally:
+            schemadiff.get_connection = saved_connection
+
+        self.assertEqual([], [str(test) for (test, e) in result.errors + result.failures])
+        self.assertEqual(sum(unittest.TestLoader().loadTestsFromTestCase(case).countTestCases()
+                             for case in self.cases), result.testsRun)
+        self.assertTrue(len(tables) > 0)
+
+
+class TestSnapshotFile(unittest.TestCase):
+    old = """CREATE TABLE `mytable` (
+  `id` int(11) NOT NULL,
+  `name` varchar(20) DEFAULT 'caf\xc3\xa9' COMMENT 'it''s a name',
+  `parent` int(11),
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name_u` (`name`(10), `id`),
+  CONSTRAINT `fk_parent` FOREIGN KEY (`parent`) REFERENCES `mytable` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+    new = """CREATE TABLE `mytable` (
+  `id` bigint(20) NOT NULL,
+  `name` varchar(20) DEFAULT 'caf\xc3\xa9' COMMENT 'it''s a name',
+  `parent` int(11),
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+CREATE TABLE `other` (
+  `x` int(11) DEFAULT NULL
+) ENGINE=MyISAM"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def testRoundTrip(self):
+        schema = ddlparse.parse_schema(self.old)
+        path = os.path.join(self.dir, 'old.snap')
+        snapshotfile.save(path, 'prod', schema, {'mytable' : self.old})
+
+        self.assertTrue(snapshotfile.is_snapshot(path))
+        (db, read, ddls) = snapshotfile.read(path)
+        self.assertEqual('prod', db)
+        self.assertEqual(schema.tables.keys(), read.tables.keys())
+        t = read.tables['mytable']
+        self.assertEqual(schema.tables['mytable'], t)
+        self.assertEqual(schema.tables['mytable'].create_statement(),
+                         t.create_statement())
+        self.assertEqual(str, type(t.columns[1].default))
+        self.assertEqual({'mytable' : self.old}, ddls)
+
+    def testDiff(self):
+        """
+        snapshots diff the same as the schemas they were taken from.
+        """
+        old = os.path.join(self.dir, 'old.snap')
+        snapshotfile.save(old, 'prod', ddlparse.parse_schema(self.old))
+        new = os.path.join(self.dir, 'new.snap')
+        snapshotfile.save(new, 'golden', ddlparse.parse_schema(self.new))
+        old_sql = self.write('old.sql', self.old)
+        new_sql = self.write('new.sql', self.new)
+
+        catalog = schemamodel.ModelCatalog({
+                'prod' : ddlparse.parse_schema(self.old),
+                'golden' : ddlparse.parse_schema(self.new),
+                })
+        expected = schemadiff.diff_databases(catalog, 'prod', 'golden')
+        self.assertEqual(4, len(expected))
+
+        self.assertEqual(expected, list(snapshotfile.diff(old, new)))
+        self.assertEqual(expected, list(snapshotfile.diff(old, new_sql)))
+        self.assertEqual(expected, list(snapshotfile.diff(old_sql, new, 'prod')))
+
+    def testVersion(self):
+        path = os.path.join(self.dir, 'future.snap')
+        snapshotfile.save(path, 'prod', ddlparse.parse_schema(self.old))
+
+        f = gzip.open(path, 'rb')
+        snapshot = json.load(f)
+        f.close()
+        snapshot['version'] = snapshotfile.VERSION + 1
+        f = gzip.open(path, 'wb')
+        json.dump(snapshot, f)
+        f.close()
+        self.assertRaises(ValueError, snapshotfile.read, path)
+
+        self.assertFalse(snapshotfile.is_snapshot(self.write('old.sql', self.old)))
+
+
+@unittest.skipUnless(distutils.spawn.find_executable(sandbox.MYSQLD),
+                     "no mysqld to run sandboxes with")
+class TestSandbox(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSandbox(self):
+        sb = sandbox.Sandbox(self.dir).start()
+        try:
+            conn = sb.connect()
+            cursor = conn.cursor()
+            cursor.execute("create database TestSandbox")
+            cursor.execute("select @@innodb_flush_log_at_trx_commit, @@sql_mode")
+            self.assertEqual((0, 'NO_ENGINE_SUBSTITUTION'), cursor.fetchall()[0])
+            conn.close()
+
+            # reset() leaves it empty for the next user
+            sb.reset()
+            conn = sb.connect()
+            cursor = conn.cursor()
+            cursor.execute("show databases like 'TestSandbox'")
+            self.assertEqual(0, len(cursor.fetchall()))
+            conn.close()
+        finally:
+            sb.stop()
+
+        self.assertEqual(['pristine', 'pristine.lock'], sorted(os.listdir(self.dir)))
+
+
 if __name__ == '__main__':
     FORMAT = "%(asctime)-15s %(funcName)s %(levelname)s %(message)s"
     logging.basicConfig(format=FORMAT, level=logging.DEBUG)
     filterwarnings('ignore', category = MySQLdb.Warning)
-    unittest.main()
+
+    # SCHEMADIFF_SANDBOX=1 runs everything against a throwaway mysqld
+    # instead of the server in dsn
+    if os.environ.get('SCHEMADIFF_SANDBOX'):
+        schemadiff.SANDBOX = sandbox.Sandbox().start()
+    try:
+        unittest.main()
+    finally:
+        if schemadiff.SANDBOX:
+            schemadiff.SANDBOX.stop()
         